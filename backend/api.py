@@ -1,89 +1,50 @@
-from fastapi import APIRouter, HTTPException, Query, WebSocket, WebSocketDisconnect, Response
+from fastapi import APIRouter, HTTPException, Query, Request, WebSocket, WebSocketDisconnect, Response
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Any
-from moviebox_api import Session, Search, SubjectType, MovieAuto, TVSeriesDetails
-from moviebox_api.download import (
-    MediaFileDownloader, 
-    DownloadableMovieFilesDetail, 
-    DownloadableTVSeriesFilesDetail,
-    resolve_media_file_to_be_downloaded
-)
-from moviebox_api.extractor._core import ItemJsonDetailsModel
-from moviebox_api.extractor.models.json import SubjectModel, SubjectTrailerModel
-from typing import Optional, Union, get_args, get_origin
-import pydantic
+# moviebox_api and httpx are imported on first use, so importing this module stays cheap
 import asyncio
 import uuid
 import json
+import time
+import importlib
+import proxy
+import hls
+import downloads
+import events
+import sessions
+import limiter
+import upstream
+import recorder
+import model_patches
+import shared_state
+from responses import FastJSONResponse
 
-# --- Monkeypatch for Pydantic Validation Error ---
-def unwrap_annotation(annotation):
-    origin = get_origin(annotation)
-    if origin is Union:
-        args = get_args(annotation)
-        for arg in args:
-            if isinstance(arg, type) and arg is not type(None):
-                return arg
-    return annotation
-
-def patch_moviebox_models():
-    try:
-        # Patch SubjectModel directly since we imported it
-        if hasattr(SubjectModel, 'model_fields') and 'trailer' in SubjectModel.model_fields:
-            # Replace FieldInfo object to allow None
-            from pydantic.fields import FieldInfo
-            SubjectModel.model_fields['trailer'] = FieldInfo(annotation=Optional[Union[dict, SubjectTrailerModel]], default=None)
-            
-            if hasattr(SubjectModel, 'model_rebuild'):
-                SubjectModel.model_rebuild(force=True)
-            
-            # Rebuild parents
-            # We need to find ResDataModel to rebuild it
-            if 'resData' in ItemJsonDetailsModel.model_fields:
-                ResDataModel = unwrap_annotation(ItemJsonDetailsModel.model_fields['resData'].annotation)
-                if hasattr(ResDataModel, 'model_rebuild'):
-                    ResDataModel.model_rebuild(force=True)
-            
-            if hasattr(ItemJsonDetailsModel, 'model_rebuild'):
-                ItemJsonDetailsModel.model_rebuild(force=True)
-                
-            print("Successfully patched SubjectModel.trailer and rebuilt models")
-    except Exception as e:
-        print(f"Failed to patch models: {e}")
-        import traceback
-        traceback.print_exc()
-
-# Apply patch immediately
-patch_moviebox_models()
+# moviebox_api's models are patched (see model_patches) from the app lifespan
 
 router = APIRouter()
 
-# Global session
-session = Session()
+# Pool of upstream sessions, least loaded first, behind an adaptive concurrency limit
+upstream_limiter = limiter.AdaptiveLimiter()
+# UPSTREAM_MODE=record/replay captures or serves upstream traffic from fixtures
+def new_session():
+    from moviebox_api import Session
 
-# Simple in-memory cache: {uuid: item_object}
-search_cache = {}
+    return recorder.install(Session())
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+session_pool = sessions.SessionPool(new_session, limiter=upstream_limiter)
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+# Simple in-memory cache: {uuid: item_object}
+search_cache = {}
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+# SHARED_STATE lets other uvicorn workers resolve these IDs and receive our events.
+# Built by open_state() from the app lifespan, opening it may touch SQLite or Redis.
+worker_state: Optional[shared_state.MemoryState] = None
 
-    async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except Exception:
-                pass
+# Last good search/details responses, served while upstream is down
+stale_responses = upstream.StaleCache()
 
-manager = ConnectionManager()
+manager: Optional[events.ConnectionManager] = None
 
 class SearchResultItem(BaseModel):
     id: str
@@ -94,15 +55,142 @@ class SearchResultItem(BaseModel):
 
 @router.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+    """
+    Event stream. Send {"action": "subscribe", "topics": ["job:<id>", "downloads"]}
+    to receive only those topics; until then every event is delivered.
+
+    On connect and on each subscribe the current state of the subscribed jobs
+    is sent first. Pass `replay=<n>` for the last n events as well, or
+    `since=<seq>` to get exactly the events missed since that sequence number.
+    """
+    params = websocket.query_params
+    await manager.connect(websocket, since=events.parse_seq(params.get("since")),
+                          replay=events.parse_seq(params.get("replay")) or 0)
     try:
         while True:
-            await websocket.receive_text()
+            text = await websocket.receive_text()
+            try:
+                data = json.loads(text)
+            except ValueError:
+                continue
+            if isinstance(data, dict):
+                await manager.handle(websocket, data)
     except WebSocketDisconnect:
         manager.disconnect(websocket)
 
-@router.get("/search", response_model=dict)
-async def search(query: str, page: int = 1, content_type: str = "all"):
+@router.get("/events")
+async def event_stream(request: Request, topics: Optional[str] = None, since: Optional[int] = None, replay: int = 0):
+    """
+    Server-Sent Events feed of the same events as /ws. `topics` is a comma
+    separated filter (default: everything). Reconnecting clients resume from
+    the Last-Event-ID header; a comment is sent every SSE_HEARTBEAT_SECONDS
+    while idle.
+    """
+    last_event_id = events.parse_seq(request.headers.get("last-event-id"))
+    if last_event_id is not None:
+        since = last_event_id
+    topic_list = [t.strip() for t in (topics or "").split(",") if t.strip()] or [events.ALL_TOPICS]
+    stream = manager.open_stream(topic_list, since=since, replay=max(replay, 0))
+
+    async def body():
+        try:
+            yield "retry: 3000\n\n"
+            while not stream.closed:
+                message = await stream.next()
+                if message is None:
+                    if not stream.closed:
+                        yield ": keepalive\n\n"
+                    continue
+                yield events.format_sse(message)
+        finally:
+            manager.close_stream(stream)
+
+    return StreamingResponse(body(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+_moviebox_download = None
+
+def load_moviebox_download():
+    """moviebox_api.download, imported on first use since it is only needed to resolve files"""
+    global _moviebox_download
+    if _moviebox_download is None:
+        import moviebox_api.download
+        # Point the modules this import brought in at the patched models, once
+        model_patches.register()
+        _moviebox_download = moviebox_api.download
+    return _moviebox_download
+
+async def run_search(query: str, subject_type, page: int = 1, deadline: Optional[float] = None):
+    """Hedged, retried upstream search. Returns the session, search instance and results"""
+    from moviebox_api import Search
+
+    async def attempt():
+        async with session_pool.use() as session:
+            search_instance = Search(session=session, query=query, page=page, subject_type=subject_type)
+            return session, search_instance, await search_instance.get_content_model()
+    return await upstream.call("search", attempt, deadline)
+
+async def fetch_files_metadata(item, season: Optional[int] = None, episode: Optional[int] = None, deadline: Optional[float] = None):
+    """Hedged, retried lookup of the downloadable files of a movie, or of an episode if season and episode are given"""
+    moviebox_download = load_moviebox_download()
+    
+    async def attempt():
+        async with session_pool.use() as session:
+            if season is not None and episode is not None:
+                files_provider = moviebox_download.DownloadableTVSeriesFilesDetail(session=session, item=item)
+                return await files_provider.get_content_model(season=season, episode=episode)
+            files_provider = moviebox_download.DownloadableMovieFilesDetail(session=session, item=item)
+            return await files_provider.get_content_model()
+    return await upstream.call("files", attempt, deadline)
+
+def item_record(item, query: str, page: int, subject_type, item_type: str) -> dict:
+    """What another worker needs to rebuild the search_cache entry of an item"""
+    model = type(item)
+    return {
+        "item": item.model_dump(mode="json", by_alias=True),
+        "model": f"{model.__module__}:{model.__qualname__}",
+        "query": query,
+        "page": page,
+        "subject_type": subject_type.name,
+        "type": item_type
+    }
+
+async def cached_item(item_id: Optional[str]) -> Optional[dict]:
+    """The search_cache entry of an item, rebuilt from the shared state if another worker searched it"""
+    if not item_id:
+        return None
+    cached = search_cache.get(item_id)
+    if cached is not None or not worker_state.shared:
+        return cached
+    try:
+        record = await worker_state.get_item(item_id)
+        if record is None:
+            return None
+        from moviebox_api import Search, SubjectType
+
+        module_name, _, class_name = record["model"].partition(":")
+        model = importlib.import_module(module_name)
+        for part in class_name.split("."):
+            model = getattr(model, part)
+        session = session_pool.pick()
+        cached = {
+            "item": model.model_validate(record["item"]),
+            "search_instance": Search(session=session, query=record["query"], page=record["page"],
+                                      subject_type=SubjectType[record["subject_type"]]),
+            "session": session,
+            "type": record["type"]
+        }
+    except Exception as e:
+        print(f"[STATE] Could not restore item {item_id}: {e}")
+        return None
+    search_cache[item_id] = cached
+    return cached
+
+@router.get("/search", response_class=FastJSONResponse)
+async def search(request: Request, query: str, page: int = 1, content_type: str = "all"):
+    from moviebox_api import SubjectType
+
+    deadline = upstream.deadline_from(request.headers.get("x-request-deadline"), "search")
     try:
         subject_type = SubjectType.ALL
         if content_type.lower() == "movie":
@@ -113,10 +201,18 @@ async def search(query: str, page: int = 1, content_type: str = "all"):
             # moviebox_api doesn't have ANIME type, so use TV_SERIES
             subject_type = SubjectType.TV_SERIES
             
-        search_instance = Search(session=session, query=query, page=page, subject_type=subject_type)
-        results_model = await search_instance.get_content_model()
+        stale_key = ("search", query, page, content_type.lower())
+        try:
+            session, search_instance, results_model = await run_search(query, subject_type, page, deadline)
+        except Exception as e:
+            stale = stale_responses.get(stale_key)
+            if stale is None or not upstream.is_upstream_failure(e):
+                raise
+            print(f"[UPSTREAM] Serving stale search results: {e}")
+            return FastJSONResponse({**stale, "stale": True})
         
         items = []
+        records = {}
         if hasattr(results_model, 'items'):
             for item in results_model.items:
                 # Generate a temporary ID for this item
@@ -161,8 +257,11 @@ async def search(query: str, page: int = 1, content_type: str = "all"):
                 search_cache[item_id] = {
                     "item": item,
                     "search_instance": search_instance,
+                    "session": session,
                     "type": item_type
                 }
+                if worker_state.shared:
+                    records[item_id] = item_record(item, query, page, subject_type, item_type)
                 
                 # Try multiple possible poster field names
                 poster_url = None
@@ -197,7 +296,18 @@ async def search(query: str, page: int = 1, content_type: str = "all"):
                     "type": item_type
                 })
         
-        return {"results": items}
+        if records:
+            try:
+                await worker_state.put_items(records)
+            except Exception as e:
+                print(f"[STATE] Could not share search results, other workers will not find them: {e}")
+        
+        response = {"results": items}
+        stale_responses.put(stale_key, response)
+        # Already shaped for the client, encode it once without another validation pass
+        return FastJSONResponse(response)
+    except upstream.DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except UnicodeDecodeError as e:
         import traceback
         error_details = traceback.format_exc()
@@ -211,23 +321,45 @@ async def search(query: str, page: int = 1, content_type: str = "all"):
         print(f"Traceback:\n{error_details}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Outcome of the startup warmup and of the keepalive rounds since
+warmup_stats = {"duration_ms": None, "sessions_ready": 0, "keepalives": 0, "keepalive_failures": 0}
+
+async def probe_session(session):
+    from moviebox_api import Search
+
+    # Perform a lightweight search
+    search_instance = Search(session=session, query="test")
+    await search_instance.get_content_model()
+
 async def warmup_session():
-    """Warm up the session by performing a dummy search"""
+    """Warm up every pooled session by performing a dummy search"""
     print("Warming up session...")
+    started = time.monotonic()
     try:
-        # Perform a lightweight search
-        search_instance = Search(session=session, query="test")
-        await search_instance.get_content_model()
-        print("Session warmed up successfully.")
+        ready, _ = await asyncio.wait_for(session_pool.warm(probe_session), sessions.WARMUP_TIMEOUT)
+        warmup_stats["sessions_ready"] = ready
+        print(f"Session warmed up successfully ({ready}/{len(session_pool.members)} sessions).")
     except Exception as e:
-        print(f"Warmup failed: {e}")
+        print(f"Warmup failed: {e!r}")
+    warmup_stats["duration_ms"] = round((time.monotonic() - started) * 1000)
+
+async def session_keepalive():
+    """Periodically touch idle sessions so their connections and cookies stay fresh"""
+    while True:
+        await asyncio.sleep(sessions.SESSION_KEEPALIVE_SECONDS / 2)
+        ok, attempted = await session_pool.warm(probe_session, idle_for=sessions.SESSION_KEEPALIVE_SECONDS)
+        warmup_stats["keepalives"] += ok
+        warmup_stats["keepalive_failures"] += attempted - ok
 
 @router.get("/debug/search")
 async def debug_search(query: str):
     """Debug endpoint to see raw search result structure"""
+    from moviebox_api import Search
+
     try:
-        search_instance = Search(session=session, query=query)
-        results_model = await search_instance.get_content_model()
+        async with session_pool.use() as session:
+            search_instance = Search(session=session, query=query)
+            results_model = await search_instance.get_content_model()
         
         if hasattr(results_model, 'items') and results_model.items:
             item = results_model.items[0]
@@ -247,20 +379,90 @@ async def debug_search(query: str):
     except Exception as e:
         return {"error": str(e)}
 
-@router.get("/details/{item_id}")
-async def details(item_id: str):
-    if item_id not in search_cache:
+def extract_seasons(details_model) -> list:
+    """Season numbers and episode counts from a details model"""
+    seasons_data = []
+    try:
+        # Try multiple paths to find season data
+        seasons_list = None
+        
+        # Path 1: details_model.resData.resource.seasons
+        if hasattr(details_model, 'resData'):
+            if hasattr(details_model.resData, 'resource') and hasattr(details_model.resData.resource, 'seasons'):
+                seasons_list = details_model.resData.resource.seasons
+            elif hasattr(details_model.resData, 'seasons'):
+                seasons_list = details_model.resData.seasons
+        
+        # Path 2: details_model.resource.seasons (fallback)
+        elif hasattr(details_model, 'resource') and hasattr(details_model.resource, 'seasons'):
+            seasons_list = details_model.resource.seasons
+        
+        # Path 3: details_model.seasons
+        elif hasattr(details_model, 'seasons'):
+            seasons_list = details_model.seasons
+        
+        # Path 4: Try to get from dict representation
+        elif hasattr(details_model, 'dict'):
+            try:
+                model_dict = details_model.dict()
+                if 'resData' in model_dict:
+                    if 'resource' in model_dict['resData'] and 'seasons' in model_dict['resData']['resource']:
+                        seasons_list = model_dict['resData']['resource']['seasons']
+                    elif 'seasons' in model_dict['resData']:
+                        seasons_list = model_dict['resData']['seasons']
+                elif 'resource' in model_dict and 'seasons' in model_dict['resource']:
+                    seasons_list = model_dict['resource']['seasons']
+            except:
+                pass
+        
+        # Extract season data
+        if seasons_list:
+            for season in seasons_list:
+                # Handle both object and dict formats
+                if isinstance(season, dict):
+                    season_num = season.get('se', season.get('season_number', 0))
+                    max_ep = season.get('maxEp', season.get('max_episodes', season.get('episode_count', 0)))
+                else:
+                    season_num = getattr(season, 'se', getattr(season, 'season_number', 0))
+                    max_ep = getattr(season, 'maxEp', getattr(season, 'max_episodes', getattr(season, 'episode_count', 0)))
+                
+                if season_num and max_ep:
+                    seasons_data.append({
+                        "season_number": season_num,
+                        "max_episodes": max_ep,
+                    })
+    except Exception as e:
+        # Log error but don't fail the entire request
+        print(f"Error extracting seasons: {e}")
+    
+    return seasons_data
+
+@router.get("/details/{item_id}", response_class=FastJSONResponse)
+async def details(item_id: str, request: Request):
+    deadline = upstream.deadline_from(request.headers.get("x-request-deadline"), "details")
+    cached = await cached_item(item_id)
+    if cached is None:
         raise HTTPException(status_code=404, detail="Item not found in cache. Please search again.")
     
-    cached = search_cache[item_id]
     item = cached["item"]
     search_instance = cached["search_instance"]
     item_type = cached.get("type", "movie")
     
+    async def attempt():
+        async with session_pool.use(cached.get("session")):
+            details_provider = search_instance.get_item_details(item)
+            return await details_provider.get_content_model()
+    
     try:
         # Use the search instance to get details for this item
-        details_provider = search_instance.get_item_details(item)
-        details_model = await details_provider.get_content_model()
+        try:
+            details_model = await upstream.call("details", attempt, deadline)
+        except Exception as e:
+            stale = stale_responses.get(("details", item_id))
+            if stale is None or not upstream.is_upstream_failure(e):
+                raise
+            print(f"[UPSTREAM] Serving stale details: {e}")
+            return FastJSONResponse({**stale, "stale": True})
         
         response = {
             "title": getattr(details_model, 'title', getattr(item, 'title', 'Unknown')),
@@ -273,172 +475,314 @@ async def details(item_id: str):
         
         # Extract seasons for TV series and anime
         if item_type in ["series", "anime"]:
-            seasons_data = []
-            try:
-                # Try multiple paths to find season data
-                seasons_list = None
-                
-                # Path 1: details_model.resData.resource.seasons
-                if hasattr(details_model, 'resData'):
-                    if hasattr(details_model.resData, 'resource') and hasattr(details_model.resData.resource, 'seasons'):
-                        seasons_list = details_model.resData.resource.seasons
-                    elif hasattr(details_model.resData, 'seasons'):
-                        seasons_list = details_model.resData.seasons
-                
-                # Path 2: details_model.resource.seasons (fallback)
-                elif hasattr(details_model, 'resource') and hasattr(details_model.resource, 'seasons'):
-                    seasons_list = details_model.resource.seasons
-                
-                # Path 3: details_model.seasons
-                elif hasattr(details_model, 'seasons'):
-                    seasons_list = details_model.seasons
-                
-                # Path 4: Try to get from dict representation
-                elif hasattr(details_model, 'dict'):
-                    try:
-                        model_dict = details_model.dict()
-                        if 'resData' in model_dict:
-                            if 'resource' in model_dict['resData'] and 'seasons' in model_dict['resData']['resource']:
-                                seasons_list = model_dict['resData']['resource']['seasons']
-                            elif 'seasons' in model_dict['resData']:
-                                seasons_list = model_dict['resData']['seasons']
-                        elif 'resource' in model_dict and 'seasons' in model_dict['resource']:
-                            seasons_list = model_dict['resource']['seasons']
-                    except:
-                        pass
-                
-                # Extract season data
-                if seasons_list:
-                    for season in seasons_list:
-                        # Handle both object and dict formats
-                        if isinstance(season, dict):
-                            season_num = season.get('se', season.get('season_number', 0))
-                            max_ep = season.get('maxEp', season.get('max_episodes', season.get('episode_count', 0)))
-                        else:
-                            season_num = getattr(season, 'se', getattr(season, 'season_number', 0))
-                            max_ep = getattr(season, 'maxEp', getattr(season, 'max_episodes', getattr(season, 'episode_count', 0)))
-                        
-                        if season_num and max_ep:
-                            seasons_data.append({
-                                "season_number": season_num,
-                                "max_episodes": max_ep,
-                            })
-            except Exception as e:
-                # Log error but don't fail the entire request
-                print(f"Error extracting seasons: {e}")
-            
-            response["seasons"] = seasons_data
+            response["seasons"] = extract_seasons(details_model)
             
-        return response
+        stale_responses.put(("details", item_id), response)
+        return FastJSONResponse(response)
+    except upstream.DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-async def download_task(item_id: Optional[str] = None, query: Optional[str] = None, season: Optional[int] = None, episode: Optional[int] = None):
+def upstream_headers() -> dict:
+    """Headers of the moviebox session, needed by CDNs that reject bare requests"""
+    session = session_pool.pick()
+    headers = {}
+    if hasattr(session, '_headers'):
+        headers.update(session._headers)
+    if hasattr(session, '_client') and hasattr(session._client, 'headers'):
+        headers.update(session._client.headers)
+    
+    # Ensure we have a User-Agent
+    if 'User-Agent' not in headers and 'user-agent' not in headers:
+        headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+    return headers
+
+async def broadcast_job(job_id: Optional[str], parent_id: Optional[str], status: str, message: str, **fields):
+    """Publish an event of a download job; an episode's events also reach its season job's topic"""
+    event = {"job_id": job_id, "status": status, **fields, "message": message}
+    if parent_id:
+        event["parent_id"] = parent_id
+    await manager.broadcast(event)
+
+async def find_item(item_id: Optional[str], query: Optional[str], season: Optional[int], job_id: Optional[str] = None, parent_id: Optional[str] = None):
+    """Item, search instance and its session from the cache, or from a fresh search"""
+    from moviebox_api import SubjectType
+
+    item = None
+    search_instance = None
+    session = None
+    
+    cached = await cached_item(item_id)
+    if cached is not None:
+        # Use cached item
+        item = cached["item"]
+        search_instance = cached["search_instance"]
+        session = cached.get("session")
+        print(f"[DOWNLOAD] Using cached item: {getattr(item, 'title', 'Unknown')}")
+    elif query:
+        # Fallback: Search
+        await broadcast_job(job_id, parent_id, "searching", f"Searching for {query}...")
+        
+        subject_type = SubjectType.ALL
+        if season is not None:
+             subject_type = SubjectType.TV_SERIES
+             
+        session, search_instance, results = await run_search(query, subject_type)
+        
+        if not results.items:
+            raise RuntimeError("No results found")
+
+        item = results.items[0]
+        print(f"[DOWNLOAD] Using search result: {getattr(item, 'title', 'Unknown')}")
+    else:
+        raise RuntimeError("No item ID or query provided")
+    return item, search_instance, session
+
+def item_dedupe_key(item, season: Optional[int], episode: Optional[int]) -> Optional[str]:
+    return downloads.dedupe_key(getattr(item, 'subjectId', None), season, episode)
+
+async def resolve_media_file(item, season: Optional[int], episode: Optional[int], job_id: Optional[str] = None, parent_id: Optional[str] = None):
+    """Resolve the best media file of a movie or episode"""
+    await broadcast_job(job_id, parent_id, "resolving", "Resolving files...")
+    
+    resolve_media_file_to_be_downloaded = load_moviebox_download().resolve_media_file_to_be_downloaded
+    
+    files_metadata = await fetch_files_metadata(item, season, episode)
+    media_file = resolve_media_file_to_be_downloaded("BEST", files_metadata)
+    if not media_file or not media_file.url:
+        raise RuntimeError("No downloadable file found")
+    return media_file
+
+# Attempts per transfer; network drops resume from the last checkpoint after a backoff
+TRANSFER_ATTEMPTS = 3
+TRANSFER_RETRY_DELAY = 1.0
+
+async def transfer(job_id: str, url: str, headers: dict, path: str, connections: int, progress_hook, resolve_again=None):
+    """fetch_segmented with retries. An expired link is resolved again with `resolve_again`, or raised without one."""
+    import httpx
+
+    for attempt in range(TRANSFER_ATTEMPTS):
+        try:
+            return await downloads.fetch_segmented(download_queue, job_id, url, headers, path, connections, progress_hook)
+        except downloads.LinkExpired:
+            if resolve_again is None or attempt == TRANSFER_ATTEMPTS - 1:
+                raise
+            url = await resolve_again()
+        except httpx.TransportError as e:
+            if attempt == TRANSFER_ATTEMPTS - 1:
+                raise
+            print(f"[DOWNLOAD] Connection lost ({e}), resuming")
+            await asyncio.sleep(TRANSFER_RETRY_DELAY * 2 ** attempt)
+
+async def download_task(item_id: Optional[str] = None, query: Optional[str] = None, season: Optional[int] = None, episode: Optional[int] = None, job_id: Optional[str] = None, connections: Optional[int] = None):
+    """Resolve and download one item. Raises on failure so the queue can record it."""
+    reporter = None
+    parent_id = None
     try:
-        # 1. Get item from cache or search
-        item = None
-        search_instance = None
+        headers = upstream_headers()
+        checkpoint = await download_queue.get(job_id) or {}
+        parent_id = checkpoint.get("parent_id")
+        # Progress ticks are coalesced into a few structured updates per second
+        reporter = events.ProgressReporter(manager.broadcast, job_id, parent_id=parent_id)
+        progress_hook = reporter.update
+        if connections is None:
+            connections = downloads.DOWNLOAD_CONNECTIONS
         
-        if item_id and item_id in search_cache:
-            # Use cached item
-            cached = search_cache[item_id]
-            item = cached["item"]
-            search_instance = cached["search_instance"]
-            print(f"[DOWNLOAD] Using cached item: {getattr(item, 'title', 'Unknown')}")
-        elif query:
-            # Fallback: Search
-            await manager.broadcast({"status": "searching", "message": f"Searching for {query}..."})
-            
-            subject_type = SubjectType.ALL
-            if season is not None:
-                 subject_type = SubjectType.TV_SERIES
-                 
-            search_instance = Search(session=session, query=query, subject_type=subject_type)
-            results = await search_instance.get_content_model()
-            
-            if not results.items:
-                await manager.broadcast({"status": "error", "message": "No results found"})
+        # Resume with the checkpointed URL first, it may still be valid
+        if checkpoint.get("url") and checkpoint.get("path"):
+            await broadcast_job(job_id, parent_id, "started", f"Resuming download: {checkpoint.get('title')}")
+            try:
+                await transfer(job_id, checkpoint["url"], headers, checkpoint["path"], connections, progress_hook)
+                await reporter.close()
+                await broadcast_job(job_id, parent_id, "completed", "Download complete!")
                 return
-
-            item = results.items[0]
-            print(f"[DOWNLOAD] Using search result: {getattr(item, 'title', 'Unknown')}")
-        else:
-            await manager.broadcast({"status": "error", "message": "No item ID or query provided"})
-            return
+            except downloads.LinkExpired:
+                print("[DOWNLOAD] Signed link expired, resolving it again")
         
-        # 2. Get Files
-        await manager.broadcast({"status": "resolving", "message": "Resolving files..."})
+        item, _, _ = await find_item(item_id, query, season, job_id, parent_id)
+        title = getattr(item, 'title', None)
+        await download_queue.update(job_id, title=title)
         
-        media_file = None
-        filename = item
-        
-        if season is not None and episode is not None:
-             # TV Series
-             files_provider = DownloadableTVSeriesFilesDetail(session=session, item=item)
-             files_metadata = await files_provider.get_content_model(season=season, episode=episode)
-             media_file = resolve_media_file_to_be_downloaded("BEST", files_metadata)
-             # For filename, we might need to adjust or let downloader handle it
-        else:
-             # Movie
-             files_provider = DownloadableMovieFilesDetail(session=session, item=item)
-             files_metadata = await files_provider.get_content_model()
-             media_file = resolve_media_file_to_be_downloaded("BEST", files_metadata)
-        
-        # 4. Download
-        downloader = MediaFileDownloader()
-        
-        def progress_hook(progress):
-            # progress is likely a dict or object. inspect it.
-            # If it's from throttlebuster, it might be complex.
-            # Let's assume it has percentage or similar.
-            # We'll send the whole thing as string or dict if possible.
-            try:
-                # Convert to dict if it's an object
-                data = progress if isinstance(progress, dict) else str(progress)
-                # If it's a string, try to parse? 
-                # Or just send as message.
-                asyncio.run_coroutine_threadsafe(
-                    manager.broadcast({"status": "downloading", "progress": data}),
-                    asyncio.get_event_loop()
-                )
-            except Exception as e:
-                print(f"Progress error: {e}")
+        # Someone else may already be downloading (or have downloaded) the same file
+        duplicate = await download_queue.claim(job_id, item_dedupe_key(item, season, episode))
+        if duplicate and "file" in duplicate:
+            record = duplicate["file"]
+            await download_queue.update(job_id, message=f"Duplicate of {record['job_id']}", path=record["path"])
+            await broadcast_job(job_id, parent_id, "completed", f"Already downloaded {title}", path=record["path"])
+            return
+        if duplicate:
+            # Not finished yet: claim() attached this job, it ends when that one completes or fails
+            other_id = duplicate["job"]["id"]
+            await broadcast_job(job_id, parent_id, "attached", f"Already downloading {title}", attached_to=other_id)
+            return
+        
+        media_file = await resolve_media_file(item, season, episode, job_id, parent_id)
+        url = str(media_file.url)
+        path = checkpoint.get("path") or downloads.target_path(title, season, episode, url)
 
-        await manager.broadcast({"status": "started", "message": f"Starting download: {item.title}"})
+        await broadcast_job(job_id, parent_id, "started", f"Starting download: {title}")
         
-        if season is not None and episode is not None:
-            await downloader.run(
-                media_file=media_file, 
-                filename=item, 
-                progress_hook=progress_hook,
-                season=season,
-                episode=episode
-            )
-        else:
-            await downloader.run(media_file=media_file, filename=item, progress_hook=progress_hook)
-            
-        await manager.broadcast({"status": "completed", "message": "Download complete!"})
+        async def resolve_again() -> str:
+            return str((await resolve_media_file(item, season, episode, job_id, parent_id)).url)
+        
+        await transfer(job_id, url, headers, path, connections, progress_hook, resolve_again)
+        
+        await reporter.close()
+        await broadcast_job(job_id, parent_id, "completed", "Download complete!")
 
     except Exception as e:
         print(f"Download failed: {e}")
-        await manager.broadcast({"status": "error", "message": f"Download failed: {str(e)}"})
+        if reporter:
+            await reporter.close()
+        await broadcast_job(job_id, parent_id, "error", f"Download failed: {str(e)}")
+        raise
+
+async def season_download_task(job_id: str, item_id: Optional[str] = None, query: Optional[str] = None, season: int = 1, episode_from: Optional[int] = None, episode_to: Optional[int] = None, connections: Optional[int] = None):
+    """Resolve every episode in the range once and enqueue one child job per episode"""
+    try:
+        job = await download_queue.get(job_id)
+        if job.get("children"):
+            # Children were already enqueued before a restart
+            return
+        
+        item, search_instance, session = await find_item(item_id, query, season, job_id)
+        title = getattr(item, 'title', None)
+        await download_queue.update(job_id, title=title)
+        
+        if episode_to is None:
+            async with session_pool.use(session):
+                details_model = await search_instance.get_item_details(item).get_content_model()
+            for season_info in extract_seasons(details_model):
+                if season_info["season_number"] == season:
+                    episode_to = season_info["max_episodes"]
+            if episode_to is None:
+                raise RuntimeError(f"Season {season} not found")
+        episodes = range(episode_from or 1, episode_to + 1)
+        
+        await manager.broadcast({"job_id": job_id, "status": "resolving", "message": f"Resolving {len(episodes)} episodes..."})
+        
+        resolve_media_file_to_be_downloaded = load_moviebox_download().resolve_media_file_to_be_downloaded
+        
+        # Episode lookups run concurrently with a cap, spread over the session pool
+        limit = asyncio.Semaphore(downloads.SEASON_RESOLVE_CONCURRENCY)
+        
+        async def resolve_episode(episode: int):
+            async with limit:
+                try:
+                    files_metadata = await fetch_files_metadata(item, season, episode)
+                    return episode, resolve_media_file_to_be_downloaded("BEST", files_metadata)
+                except Exception as e:
+                    # The child job resolves it again when it runs
+                    print(f"[DOWNLOAD] Could not resolve S{season}E{episode}: {e}")
+                    return episode, None
+        
+        # Episodes that are already downloaded or queued are not downloaded twice
+        pending = []
+        for episode in episodes:
+            if await download_queue.find(item_dedupe_key(item, season, episode)):
+                print(f"[DOWNLOAD] S{season}E{episode} already downloaded or queued, skipping")
+            else:
+                pending.append(episode)
+        
+        resolved = await asyncio.gather(*(resolve_episode(episode) for episode in pending))
+        for episode, media_file in resolved:
+            fields = {"title": title, "dedupe_key": item_dedupe_key(item, season, episode)}
+            if media_file and media_file.url:
+                url = str(media_file.url)
+                fields.update(url=url, path=downloads.target_path(title, season, episode, url))
+            await download_queue.enqueue(
+                {"item_id": item_id, "query": query or title, "season": season, "episode": episode, "connections": connections},
+                priority=job["priority"],
+                parent_id=job_id,
+                **fields
+            )
+        
+        await manager.broadcast({"job_id": job_id, "status": "queued", "message": f"Queued {len(pending)} of {len(episodes)} episodes of {title}"})
+    except Exception as e:
+        print(f"Season download failed: {e}")
+        await manager.broadcast({"job_id": job_id, "status": "error", "message": f"Download failed: {str(e)}"})
+        raise
+
+async def run_download_job(job: dict):
+    params = dict(job["params"])
+    if params.pop("kind", None) == "season":
+        await season_download_task(job_id=job["id"], **params)
+    else:
+        await download_task(job_id=job["id"], **params)
+
+download_queue: Optional[downloads.DownloadQueue] = None
+
+def open_state():
+    """Open the shared state, the event manager and the download queue, once per worker from the app lifespan"""
+    global worker_state, manager, download_queue
+    worker_state = shared_state.create()
+    manager = events.ConnectionManager(worker_state)
+    download_queue = downloads.DownloadQueue(run_download_job)
 
 @router.post("/download")
-async def download(id: Optional[str] = None, query: Optional[str] = None, season: Optional[int] = None, episode: Optional[int] = None):
-    # Start background task
-    asyncio.create_task(download_task(id, query, season, episode))
-    return {"status": "started", "message": f"Download started"}
+async def download(id: Optional[str] = None, query: Optional[str] = None, season: Optional[int] = None, episode: Optional[int] = None, priority: str = "normal", connections: Optional[int] = Query(None, ge=1, le=16), episode_from: Optional[int] = Query(None, ge=1), episode_to: Optional[int] = Query(None, ge=1)):
+    """
+    Queue a download. With a season but no episode the whole season (or
+    episode_from..episode_to) is downloaded as one parent job with a child per episode.
+    """
+    if priority not in downloads.PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Unknown priority: {priority}")
+    
+    if season is not None and episode is None:
+        if episode_from and episode_to and episode_from > episode_to:
+            raise HTTPException(status_code=400, detail="episode_from must not be after episode_to")
+        job = await download_queue.enqueue(
+            {"kind": "season", "item_id": id, "query": query, "season": season,
+             "episode_from": episode_from, "episode_to": episode_to, "connections": connections},
+            priority=priority
+        )
+        return {"status": "queued", "job_id": job["id"], "message": f"Season {season} download queued"}
+    
+    # Attach to an identical download instead of transferring the same bytes twice
+    key = None
+    cached = await cached_item(id)
+    if cached is not None:
+        key = item_dedupe_key(cached["item"], season, episode)
+    existing = await download_queue.find(key)
+    if existing and "file" in existing:
+        record = existing["file"]
+        return {"status": "completed", "job_id": record["job_id"], "path": record["path"], "message": "Already downloaded"}
+    if existing:
+        return {"status": "attached", "job_id": existing["job"]["id"], "message": "Already downloading"}
+    
+    # Queue the job, a worker picks it up when a slot is free
+    job = await download_queue.enqueue(
+        {"item_id": id, "query": query, "season": season, "episode": episode, "connections": connections},
+        priority=priority,
+        dedupe_key=key
+    )
+    return {"status": "queued", "job_id": job["id"], "message": "Download queued"}
+
+@router.get("/downloads")
+async def list_downloads(state: Optional[str] = None, parent_id: Optional[str] = None, limit: int = Query(downloads.DOWNLOAD_LIST_LIMIT, ge=1, le=500)):
+    return {"jobs": await download_queue.list(state, parent_id, limit)}
+
+@router.get("/downloads/{job_id}")
+async def get_download(job_id: str):
+    job = await download_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Download job not found")
+    return job
 
 @router.post("/stream")
-async def stream(query: str, id: Optional[str] = None, content_type: str = "all", season: Optional[int] = None, episode: Optional[int] = None, mode: str = "play"):
+async def stream(request: Request, query: str, id: Optional[str] = None, content_type: str = "all", season: Optional[int] = None, episode: Optional[int] = None, mode: str = "play", client: Optional[str] = None):
+    from moviebox_api import SubjectType
+
+    deadline = upstream.deadline_from(request.headers.get("x-request-deadline"), "stream")
     try:
         # 1. Try to use cached item first (avoids re-search and ID mismatch)
         target_item = None
         search_instance = None
         
-        if id and id in search_cache:
+        cached = await cached_item(id)
+        if cached is not None:
             # Use cached item directly
-            cached = search_cache[id]
             target_item = cached["item"]
             search_instance = cached["search_instance"]
             print(f"[STREAM] Using cached item: {getattr(target_item, 'title', 'Unknown')}")
@@ -452,8 +796,7 @@ async def stream(query: str, id: Optional[str] = None, content_type: str = "all"
             elif content_type.lower() == "anime":
                 subject_type = SubjectType.TV_SERIES
 
-            search_instance = Search(session=session, query=query, subject_type=subject_type)
-            results = await search_instance.get_content_model()
+            _, search_instance, results = await run_search(query, subject_type, deadline=deadline)
             
             if not results.items:
                 raise HTTPException(status_code=404, detail="Content not found")
@@ -463,21 +806,18 @@ async def stream(query: str, id: Optional[str] = None, content_type: str = "all"
             print(f"[STREAM] Using search result: {getattr(target_item, 'title', 'Unknown')}")
             
         # 4. Resolve Media File with encoding error handling
+        # TV Series / Anime when season and episode are given, otherwise Movie.
+        # Upstream failures are retried within the request deadline, the
+        # quality fallbacks below only pick from what was returned.
+        resolve_media_file_to_be_downloaded = load_moviebox_download().resolve_media_file_to_be_downloaded
+        
+        files_metadata = await fetch_files_metadata(target_item, season, episode, deadline)
         media_file = None
         quality_options = ["BEST", "WORST", "720P", "480P", "360P"]
         
         for quality in quality_options:
             try:
-                if season is not None and episode is not None:
-                    # TV Series / Anime
-                    files_provider = DownloadableTVSeriesFilesDetail(session=session, item=target_item)
-                    files_metadata = await files_provider.get_content_model(season=season, episode=episode)
-                    media_file = resolve_media_file_to_be_downloaded(quality, files_metadata)
-                else:
-                    # Movie
-                    files_provider = DownloadableMovieFilesDetail(session=session, item=target_item)
-                    files_metadata = await files_provider.get_content_model()
-                    media_file = resolve_media_file_to_be_downloaded(quality, files_metadata)
+                media_file = resolve_media_file_to_be_downloaded(quality, files_metadata)
                 
                 # If we got a media file, break out of the loop
                 if media_file and media_file.url:
@@ -501,7 +841,9 @@ async def stream(query: str, id: Optional[str] = None, content_type: str = "all"
             # Return a proxy URL that routes through our backend
             # This bypasses 403 Forbidden errors from streaming providers
             from urllib.parse import quote
-            proxy_url = f"/api/proxy-stream?url={quote(str(media_file.url))}"
+            # The player cannot send X-Client-Id, so the viewer's id goes in the URL
+            client_id = client or request.headers.get('x-client-id') or uuid.uuid4().hex
+            proxy_url = f"/api/proxy-stream?url={quote(str(media_file.url))}&client={quote(client_id, safe='')}"
             return {"status": "success", "url": proxy_url, "title": target_item.title, "direct_url": str(media_file.url)}
 
         # 5. Launch MPV
@@ -512,11 +854,7 @@ async def stream(query: str, id: Optional[str] = None, content_type: str = "all"
             raise HTTPException(status_code=500, detail="mpv player not found. Please install mpv to stream.")
             
         # Extract headers from session
-        headers = {}
-        if hasattr(session, '_headers'):
-            headers.update(session._headers)
-        if hasattr(session, '_client') and hasattr(session._client, 'headers'):
-            headers.update(session._client.headers)
+        headers = upstream_headers()
             
         # Construct mpv command
         cmd = ["mpv", str(media_file.url), f"--title={target_item.title}"]
@@ -559,6 +897,8 @@ async def stream(query: str, id: Optional[str] = None, content_type: str = "all"
 
     except HTTPException:
         raise
+    except upstream.DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         import traceback
         error_details = traceback.format_exc()
@@ -574,50 +914,80 @@ async def stream(query: str, id: Optional[str] = None, content_type: str = "all"
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/proxy-stream")
-async def proxy_stream(url: str):
+async def proxy_stream(url: str, request: Request, connections: Optional[int] = Query(None, ge=1, le=16), client: Optional[str] = None):
     """
     Proxy endpoint that streams video content with proper headers.
     This bypasses 403 Forbidden errors from streaming providers.
+    Clients watching the same URL share one upstream connection.
+    Pass `connections` > 1 to fetch from upstream over parallel ranged requests.
+    HLS playlists are rewritten so their segments come back through here too.
+    `client` (or the X-Client-Id header) identifies the viewer for bandwidth
+    sharing and seek detection; /stream?mode=url puts it in the URL it returns.
     """
     try:
-        import httpx
+        headers = upstream_headers()
+        client_id = client or request.headers.get('x-client-id')
+        client_key = client_id or (request.client.host if request.client else None)
         
-        # Extract headers from session
-        headers = {}
-        if hasattr(session, '_headers'):
-            headers.update(session._headers)
-        if hasattr(session, '_client') and hasattr(session._client, 'headers'):
-            headers.update(session._client.headers)
-        
-        # Ensure we have a User-Agent
-        if 'User-Agent' not in headers and 'user-agent' not in headers:
-            headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        
-        # Stream the content from the source
-        async with httpx.AsyncClient(follow_redirects=True, timeout=30.0) as client:
-            async with client.stream('GET', url, headers=headers) as response:
-                if response.status_code != 200:
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail=f"Failed to fetch stream: {response.status_code}"
-                    )
-                
-                # Get content type from response
-                content_type = response.headers.get('content-type', 'video/mp4')
-                
-                # Stream the response
-                async def generate():
-                    async for chunk in response.aiter_bytes(chunk_size=8192):
-                        yield chunk
-                
-                return StreamingResponse(
-                    generate(),
-                    media_type=content_type,
-                    headers={
-                        'Accept-Ranges': 'bytes',
-                        'Content-Type': content_type,
-                    }
+        # HLS segments referenced by a playlist we rewrote are served from the segment cache
+        if hls.is_segment(url):
+            data = await hls.serve_segment(url, headers)
+            return Response(content=data, media_type=hls.segment_type(url))
+        
+        if hls.looks_like_playlist(url):
+            status_code, playlist = await hls.fetch_playlist(url, headers, request.url.path, client_id)
+            if status_code != 200:
+                raise HTTPException(
+                    status_code=status_code,
+                    detail=f"Failed to fetch stream: {status_code}"
                 )
+            return Response(content=playlist, media_type=hls.PLAYLIST_TYPES[0])
+        
+        status_code, response_headers, body = await proxy.open_stream(
+            url, headers, request.headers.get('range'), client_key, connections
+        )
+        if body is None:
+            raise HTTPException(
+                status_code=status_code,
+                detail=f"Failed to fetch stream: {status_code}",
+                headers=response_headers or None
+            )
+        
+        # Playlists without an .m3u8 extension are only recognisable by their content type
+        if hls.is_playlist_type(response_headers.get('Content-Type')):
+            # Relative URIs resolve against where the redirects ended up
+            playlist_url = proxy.final_url(url)
+            raw = b"".join([chunk async for chunk in body])
+            playlist = hls.rewrite_playlist(raw.decode("utf-8", errors="replace"), playlist_url, request.url.path, client_id)
+            return Response(content=playlist, media_type=hls.PLAYLIST_TYPES[0])
+        
+        return StreamingResponse(
+            body,
+            status_code=status_code,
+            media_type=response_headers.get('Content-Type'),
+            headers=response_headers
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Proxy stream error: {str(e)}")
 
+@router.get("/proxy/bandwidth")
+async def proxy_bandwidth():
+    """Current bandwidth allocation per proxy client and upstream reader"""
+    return proxy.bandwidth_stats()
+
+@router.get("/sessions")
+async def session_stats():
+    """Load and health of the upstream session pool"""
+    return session_pool.stats()
+
+@router.get("/metrics")
+async def metrics():
+    """Upstream concurrency limit, call latencies, session pool and warmup state"""
+    return {
+        "upstream_limiter": upstream_limiter.stats(),
+        "upstream_calls": upstream.stats(),
+        "warmup": warmup_stats,
+        "sessions": session_pool.stats(),
+    }
@@ -0,0 +1,702 @@
+"""
+Download job queue.
+
+Jobs get an ID, a priority and are run by a fixed number of workers.
+Job state lives in SQLite so queued (and interrupted) jobs survive a
+backend restart, and the /api/downloads endpoints read from it. Workers
+sharing the database hold a lease on the jobs they run.
+
+Transfers write to a `.part` file and checkpoint the bytes written and the
+response validators (ETag / Last-Modified) on the job row, so a resumed
+job continues with a Range request instead of starting over.
+
+Large files can be split into ranged parts fetched in parallel and written
+at their offsets into a preallocated file. Each part is retried on its own
+and its progress is part of the checkpoint.
+
+A season download is a parent job that enqueues one child job per
+episode; the parent reports the aggregate state and progress of its
+children.
+
+Downloads are deduplicated by (subject, season, episode, quality): a
+request for something already queued or running attaches to that job,
+and finished files are kept in an index so a repeat request is answered
+from disk. A job that only finds out once it runs that the file is
+already being downloaded stays "attached" to that job and ends the way
+it does.
+"""
+import asyncio
+import itertools
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+DOWNLOAD_DB = os.environ.get("DOWNLOAD_DB", "downloads.db")
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", "2"))
+DOWNLOAD_DIR = os.environ.get("DOWNLOAD_DIR", ".")
+# Persist the resume point at least this often
+CHECKPOINT_BYTES = 4 * 1024 * 1024
+CHECKPOINT_SECONDS = 2.0
+CHUNK_SIZE = 256 * 1024
+# Parallel ranged connections per download, overridable per job
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "4"))
+PART_ATTEMPTS = 4
+# A worker renews the leases of its running jobs every third of this; a job
+# whose lease ran out is requeued, its worker is assumed to be dead
+DOWNLOAD_LEASE_SECONDS = float(os.environ.get("DOWNLOAD_LEASE_SECONDS", "30"))
+# Most jobs returned by one listing
+DOWNLOAD_LIST_LIMIT = 200
+# Episodes of a season resolved at the same time
+SEASON_RESOLVE_CONCURRENCY = int(os.environ.get("SEASON_RESOLVE_CONCURRENCY", "4"))
+
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+PRIORITY_NAMES = {value: name for name, value in PRIORITIES.items()}
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+# Waiting for another job producing the same file, ends in that job's state
+ATTACHED = "attached"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    params TEXT NOT NULL,
+    title TEXT,
+    message TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+)
+"""
+
+_FILES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER,
+    job_id TEXT,
+    completed_at REAL
+)
+"""
+
+# Columns added after the first release of the jobs table
+_ADDED_COLUMNS = {
+    "parent_id": "TEXT",
+    "dedupe_key": "TEXT",
+    "url": "TEXT",
+    "path": "TEXT",
+    "bytes_written": "INTEGER",
+    "total_bytes": "INTEGER",
+    "etag": "TEXT",
+    "last_modified": "TEXT",
+    "parts": "TEXT",
+    "attached_to": "TEXT",
+    "owner": "TEXT",
+    "lease_until": "REAL",
+}
+
+
+class DownloadQueue:
+    """
+    Priority queue of download jobs backed by SQLite.
+
+    Several workers can share one database. A worker owns the jobs it
+    claimed for as long as it renews their lease, and only jobs whose
+    lease ran out (their worker died) go back to the queue. Every database
+    call runs in a thread, one at a time on the connection, so a busy
+    database never blocks the event loop.
+    """
+
+    def __init__(self, runner: Callable[[dict], Awaitable[None]], db_path: str = DOWNLOAD_DB,
+                 concurrency: int = DOWNLOAD_CONCURRENCY, lease_seconds: float = DOWNLOAD_LEASE_SECONDS):
+        self.runner = runner
+        self.concurrency = max(concurrency, 1)
+        self.lease_seconds = lease_seconds
+        # Identifies this worker's leases
+        self.owner = uuid.uuid4().hex
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self._migrate()
+        self.lock = threading.Lock()
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.workers: List[asyncio.Task] = []
+        self.heartbeat: Optional[asyncio.Task] = None
+        self._order = itertools.count()
+
+    def _migrate(self):
+        # Every uvicorn worker opens the database at the same time; the write
+        # lock makes the others wait and then find the columns already there
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute(_SCHEMA)
+            existing = {row["name"] for row in self.db.execute("PRAGMA table_info(jobs)")}
+            for column, kind in _ADDED_COLUMNS.items():
+                if column not in existing:
+                    self.db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_parent ON jobs (parent_id)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_dedupe ON jobs (dedupe_key)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+            self.db.execute(_FILES_SCHEMA)
+        except BaseException:
+            self.db.rollback()
+            raise
+        self.db.commit()
+
+    async def _run(self, function: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, self._locked, function, *args)
+
+    def _locked(self, function: Callable, *args):
+        with self.lock:
+            return function(*args)
+
+    def _transaction(self, function: Callable, *args):
+        # Under the write lock, so other workers see all of it or none of it
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            result = function(*args)
+        except BaseException:
+            self.db.rollback()
+            raise
+        self.db.commit()
+        return result
+
+    async def start(self):
+        """Start the workers and requeue jobs left over from a previous run."""
+        self.queue = asyncio.PriorityQueue()
+        # Jobs whose worker died go back to the queue, the ones other workers are running stay theirs
+        rows = await self._run(self._transaction, self._restore, time.time())
+        for row in rows:
+            self.queue.put_nowait((row["priority"], next(self._order), row["id"]))
+        if rows:
+            print(f"[QUEUE] Restored {len(rows)} queued download(s)")
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self.heartbeat = asyncio.create_task(self._heartbeat())
+
+    async def stop(self):
+        tasks = self.workers + ([self.heartbeat] if self.heartbeat else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.workers = []
+        self.heartbeat = None
+
+    def _requeue_expired(self, now: float) -> list:
+        rows = self.db.execute(
+            "SELECT id, priority FROM jobs WHERE state = ? AND (lease_until IS NULL OR lease_until < ?) ORDER BY created_at",
+            (RUNNING, now),
+        ).fetchall()
+        self.db.executemany(
+            "UPDATE jobs SET state = ?, started_at = NULL, owner = NULL, lease_until = NULL WHERE id = ?",
+            [(QUEUED, row["id"]) for row in rows],
+        )
+        return rows
+
+    def _restore(self, now: float) -> list:
+        self._requeue_expired(now)
+        return self.db.execute(
+            "SELECT id, priority FROM jobs WHERE state = ? ORDER BY created_at", (QUEUED,)
+        ).fetchall()
+
+    def _renew(self, now: float):
+        self.db.execute(
+            "UPDATE jobs SET lease_until = ? WHERE owner = ? AND state = ?",
+            (now + self.lease_seconds, self.owner, RUNNING),
+        )
+        self.db.commit()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                now = time.time()
+                await self._run(self._renew, now)
+                for row in await self._run(self._transaction, self._requeue_expired, now):
+                    print(f"[QUEUE] Requeued {row['id']}, its worker stopped renewing the lease")
+                    self.queue.put_nowait((row["priority"], next(self._order), row["id"]))
+            except sqlite3.Error as e:
+                print(f"[QUEUE] Renewing leases failed: {e}")
+
+    def _enqueue(self, params: dict, level: int, parent_id: Optional[str], fields: dict) -> dict:
+        job_id = uuid.uuid4().hex
+        self.db.execute(
+            "INSERT INTO jobs (id, state, priority, params, created_at, parent_id) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, QUEUED, level, json.dumps(params), time.time(), parent_id),
+        )
+        self._update(job_id, fields)
+        return self._get(job_id)
+
+    async def enqueue(self, params: dict, priority: str = "normal", parent_id: Optional[str] = None, **fields) -> dict:
+        """Add a job. Extra fields (e.g. a pre-resolved url/path/title) are stored on the row."""
+        level = PRIORITIES.get(priority, PRIORITIES["normal"])
+        job = await self._run(self._enqueue, params, level, parent_id, fields)
+        # Before start() the job is simply picked up from the database
+        if self.queue is not None:
+            self.queue.put_nowait((level, next(self._order), job["id"]))
+        return job
+
+    def _update(self, job_id: str, fields: dict):
+        if fields:
+            columns = ", ".join(f"{name} = ?" for name in fields)
+            self.db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+        self.db.commit()
+
+    async def update(self, job_id: str, **fields):
+        if fields:
+            await self._run(self._update, job_id, fields)
+
+    def _claim(self, job_id: str, now: float) -> Optional[dict]:
+        """Take a queued job with a fresh lease; None if it is not queued anymore (e.g. another worker took it)."""
+        cursor = self.db.execute(
+            "UPDATE jobs SET state = ?, started_at = ?, owner = ?, lease_until = ? WHERE id = ? AND state = ?",
+            (RUNNING, now, self.owner, now + self.lease_seconds, job_id, QUEUED),
+        )
+        self.db.commit()
+        return self._get(job_id) if cursor.rowcount == 1 else None
+
+    def _find(self, key: Optional[str], exclude: Optional[str] = None) -> Optional[dict]:
+        if not key:
+            return None
+        record = self.db.execute("SELECT * FROM files WHERE key = ?", (key,)).fetchone()
+        if record is not None:
+            if os.path.exists(record["path"]):
+                return {"file": dict(record)}
+            # The file was moved or deleted, forget it
+            self.db.execute("DELETE FROM files WHERE key = ?", (key,))
+        row = self.db.execute(
+            "SELECT id FROM jobs WHERE dedupe_key = ? AND state IN (?, ?) AND id IS NOT ? "
+            "ORDER BY state = ? DESC, created_at LIMIT 1",
+            (key, QUEUED, RUNNING, exclude, RUNNING),
+        ).fetchone()
+        return {"job": self._get(row["id"])} if row else None
+
+    async def find(self, key: Optional[str]) -> Optional[dict]:
+        """
+        Existing download for a dedupe key: {"file": record} for a finished
+        file still on disk, {"job": job} for a queued or running job.
+        """
+        if not key:
+            return None
+        return await self._run(self._transaction, self._find, key)
+
+    def _claim_key(self, job_id: str, key: Optional[str]) -> Optional[dict]:
+        existing = self._find(key, exclude=job_id)
+        if existing is None:
+            if key:
+                self.db.execute("UPDATE jobs SET dedupe_key = ? WHERE id = ?", (key, job_id))
+        elif "job" in existing:
+            self._link(job_id, existing["job"]["id"])
+        return existing
+
+    async def claim(self, job_id: str, key: Optional[str]) -> Optional[dict]:
+        """
+        Mark a job as the one producing `key`, unless another download already
+        covers it. A job that duplicates a queued or running one is attached
+        to it in the same transaction, so two jobs can never wait on each other.
+        """
+        return await self._run(self._transaction, self._claim_key, job_id, key)
+
+    def _link(self, job_id: str, other_id: str):
+        self.db.execute(
+            "UPDATE jobs SET state = ?, attached_to = ?, message = ? WHERE id = ?",
+            (ATTACHED, other_id, f"Duplicate of {other_id}", job_id),
+        )
+        # The other job may have ended before the link was in place
+        other = self._get(other_id)
+        if other is None or other["state"] in (COMPLETED, FAILED):
+            self._settle_attached(other_id, other)
+
+    async def attach(self, job_id: str, other_id: str):
+        """Let a running job wait for the one already producing its file, and end the same way."""
+        await self._run(self._transaction, self._link, job_id, other_id)
+
+    def _settle_attached(self, job_id: str, job: Optional[dict]):
+        if job is None:
+            state, path, message = FAILED, None, f"Download {job_id} no longer exists"
+        elif job["state"] == COMPLETED:
+            state, path, message = COMPLETED, job.get("path"), f"Downloaded by {job_id}"
+        else:
+            state, path, message = FAILED, None, f"Download {job_id} failed: {job.get('message')}"
+        self.db.execute(
+            "UPDATE jobs SET state = ?, path = ?, message = ?, finished_at = ? WHERE attached_to = ? AND state = ?",
+            (state, path, message, time.time(), job_id, ATTACHED),
+        )
+
+    def _finish(self, job_id: str, completed: bool, message: Optional[str] = None):
+        if completed and self.db.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()["state"] == ATTACHED:
+            # Ends when the job it is attached to does
+            return
+        fields = {"state": COMPLETED if completed else FAILED, "finished_at": time.time(), "owner": None, "lease_until": None}
+        if message is not None:
+            fields["message"] = message
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        self.db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+        job = self._get(job_id)
+        self._settle_attached(job_id, job)
+        key = job and job.get("dedupe_key")
+        if key and completed and job.get("path") and os.path.exists(job["path"]):
+            self.db.execute(
+                "INSERT OR REPLACE INTO files (key, path, size, job_id, completed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, job["path"], os.path.getsize(job["path"]), job_id, time.time()),
+            )
+
+    def _release(self, job_id: str):
+        self.db.execute(
+            "UPDATE jobs SET state = ?, started_at = NULL, owner = NULL, lease_until = NULL WHERE id = ? AND state = ?",
+            (QUEUED, job_id, RUNNING),
+        )
+        self.db.commit()
+
+    def _get(self, job_id: str) -> Optional[dict]:
+        row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return self._to_dict(row, self._children_summary([job_id]).get(job_id))
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        return await self._run(self._get, job_id)
+
+    def _list(self, state: Optional[str], parent_id: Optional[str], limit: int) -> List[dict]:
+        conditions, params = [], []
+        if parent_id:
+            conditions.append("parent_id = ?")
+            params.append(parent_id)
+        if state:
+            # A parent reports the state of its children, whatever its own row says
+            conditions.append("(state = ? OR (state = ? AND id IN (SELECT parent_id FROM jobs WHERE parent_id IS NOT NULL)))")
+            params += [state, COMPLETED]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = "created_at" if parent_id else "created_at DESC"
+        rows = self.db.execute(f"SELECT * FROM jobs {where} ORDER BY {order} LIMIT ?", (*params, limit)).fetchall()
+        summaries = self._children_summary([row["id"] for row in rows])
+        jobs = [self._to_dict(row, summaries.get(row["id"])) for row in rows]
+        if state:
+            jobs = [job for job in jobs if job["state"] == state]
+        return jobs
+
+    async def list(self, state: Optional[str] = None, parent_id: Optional[str] = None,
+                   limit: int = DOWNLOAD_LIST_LIMIT) -> List[dict]:
+        """The newest `limit` jobs (oldest first for the children of a parent)."""
+        return await self._run(self._list, state, parent_id, limit)
+
+    def _children_summary(self, parent_ids: List[str]) -> dict:
+        if not parent_ids:
+            return {}
+        rows = self.db.execute(
+            "SELECT parent_id, state, COUNT(*) AS count, SUM(COALESCE(bytes_written, 0)) AS written, "
+            "SUM(COALESCE(total_bytes, 0)) AS total FROM jobs "
+            f"WHERE parent_id IN ({', '.join('?' * len(parent_ids))}) GROUP BY parent_id, state",
+            parent_ids,
+        )
+        summaries = {}
+        for row in rows:
+            summary = summaries.setdefault(
+                row["parent_id"],
+                {"total": 0, QUEUED: 0, RUNNING: 0, ATTACHED: 0, COMPLETED: 0, FAILED: 0,
+                 "bytes_written": 0, "total_bytes": 0},
+            )
+            summary["total"] += row["count"]
+            summary[row["state"]] = summary.get(row["state"], 0) + row["count"]
+            summary["bytes_written"] += row["written"]
+            summary["total_bytes"] += row["total"]
+        return summaries
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row, children: Optional[dict] = None) -> dict:
+        job = dict(row)
+        job["priority"] = PRIORITY_NAMES.get(job["priority"], job["priority"])
+        job["params"] = json.loads(job["params"])
+        if children:
+            job["children"] = children
+            # A parent is done once it has enqueued its children; its state follows theirs
+            if job["state"] == COMPLETED:
+                if children[QUEUED] or children[RUNNING] or children[ATTACHED]:
+                    job["state"] = RUNNING
+                elif children[FAILED]:
+                    job["state"] = FAILED
+            job["bytes_written"] = children["bytes_written"]
+            job["total_bytes"] = children["total_bytes"]
+        return job
+
+    async def _worker(self):
+        while True:
+            _, _, job_id = await self.queue.get()
+            try:
+                job = await self._run(self._claim, job_id, time.time())
+                if job is None:
+                    continue
+                try:
+                    await self.runner(job)
+                except asyncio.CancelledError:
+                    # Shutting down, leave the job to be resumed on the next start
+                    self._locked(self._release, job_id)
+                    raise
+                except Exception as e:
+                    await self._run(self._transaction, self._finish, job_id, False, str(e))
+                else:
+                    await self._run(self._transaction, self._finish, job_id, True)
+            finally:
+                self.queue.task_done()
+
+
+def dedupe_key(subject_id, season: Optional[int], episode: Optional[int], quality: str = "BEST") -> Optional[str]:
+    """Identity of a download; None when the subject is unknown."""
+    if not subject_id:
+        return None
+    return f"{subject_id}:{season or 0}:{episode or 0}:{quality}"
+
+
+class LinkExpired(Exception):
+    """The signed media URL is no longer accepted and must be resolved again."""
+
+
+def target_path(title: str, season: Optional[int], episode: Optional[int], url: str) -> str:
+    """Final file path for a download inside DOWNLOAD_DIR."""
+    name = re.sub(r'[<>:"/\\|?*]+', "", title or "download").strip() or "download"
+    if season is not None and episode is not None:
+        name = f"{name} S{season:02d}E{episode:02d}"
+    extension = os.path.splitext(urlparse(url).path)[1] or ".mp4"
+    return os.path.join(DOWNLOAD_DIR, name + extension)
+
+
+def _total_size(response, offset: int) -> Optional[int]:
+    content_range = response.headers.get("content-range")
+    if content_range and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        if total.isdigit():
+            return int(total)
+    length = response.headers.get("content-length")
+    if length and length.isdigit():
+        return int(length) + offset
+    return None
+
+
+async def fetch_resumable(queue: DownloadQueue, job_id: str, url: str, headers: dict, path: str,
+                          progress_hook: Optional[Callable[[int, Optional[int]], None]] = None) -> str:
+    """
+    Download `url` to `path`, resuming from the job's checkpoint if there is one.
+
+    Raises LinkExpired when upstream rejects the (signed) URL so the caller
+    can resolve a fresh one and call again.
+    """
+    from proxy import get_client
+
+    job = await queue.get(job_id) or {}
+    part_path = path + ".part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if job.get("path") != path:
+        # A different target than the checkpoint describes, start clean
+        offset = 0
+
+    request_headers = dict(headers)
+    validator = job.get("etag") or job.get("last_modified")
+    if offset and validator:
+        request_headers["Range"] = f"bytes={offset}-"
+        # Only honour the range if the file has not changed since the checkpoint
+        request_headers["If-Range"] = validator
+    else:
+        offset = 0
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    async with get_client().stream("GET", url, headers=request_headers) as response:
+        if response.status_code in (401, 403, 404, 410):
+            raise LinkExpired(f"Upstream returned {response.status_code}")
+        if response.status_code == 416 and offset and offset == job.get("total_bytes"):
+            # Everything was already written before the restart
+            os.replace(part_path, path)
+            return path
+        if response.status_code not in (200, 206):
+            raise RuntimeError(f"Upstream returned {response.status_code}")
+        if response.status_code == 200:
+            offset = 0
+        if offset:
+            print(f"[DOWNLOAD] Resuming {os.path.basename(path)} at {offset} bytes")
+
+        total = _total_size(response, offset)
+        written = offset
+        await queue.update(
+            job_id,
+            url=url,
+            path=path,
+            bytes_written=written,
+            total_bytes=total,
+            etag=response.headers.get("etag"),
+            last_modified=response.headers.get("last-modified"),
+        )
+
+        last_checkpoint_bytes = written
+        last_checkpoint_time = time.monotonic()
+        with open(part_path, "ab" if offset else "wb") as f:
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                f.write(chunk)
+                written += len(chunk)
+                now = time.monotonic()
+                if (written - last_checkpoint_bytes >= CHECKPOINT_BYTES
+                        or now - last_checkpoint_time >= CHECKPOINT_SECONDS):
+                    f.flush()
+                    await queue.update(job_id, bytes_written=written)
+                    last_checkpoint_bytes = written
+                    last_checkpoint_time = now
+                if progress_hook:
+                    progress_hook(written, total)
+            f.flush()
+
+    if total is not None and written < total:
+        await queue.update(job_id, bytes_written=written)
+        raise RuntimeError(f"Transfer ended early at {written} of {total} bytes")
+    await queue.update(job_id, bytes_written=written, total_bytes=written)
+    os.replace(part_path, path)
+    return path
+
+
+class _SourceChanged(Exception):
+    """The file behind the URL changed since the checkpoint was written."""
+
+
+def _is_retryable(error: Exception) -> bool:
+    import httpx
+
+    if isinstance(error, httpx.TransportError):
+        return True
+    status = getattr(error, "status_code", None)
+    return status is not None and (status == 429 or status >= 500)
+
+
+class _PartError(RuntimeError):
+    def __init__(self, status_code: int):
+        super().__init__(f"Part request returned {status_code}")
+        self.status_code = status_code
+
+
+async def fetch_segmented(queue: DownloadQueue, job_id: str, url: str, headers: dict, path: str,
+                          connections: int = DOWNLOAD_CONNECTIONS,
+                          progress_hook: Optional[Callable[[int, Optional[int]], None]] = None) -> str:
+    """
+    Download `url` to `path` over `connections` parallel ranged requests.
+
+    Falls back to a single resumable connection when upstream does not
+    support ranges, when only one connection is requested, or when the
+    checkpoint belongs to a single-connection transfer.
+    """
+    from proxy import get_client
+
+    client = get_client()
+    job = await queue.get(job_id) or {}
+    part_path = path + ".part"
+    has_checkpoint = job.get("path") == path and os.path.exists(part_path)
+    parts = json.loads(job["parts"]) if has_checkpoint and job.get("parts") else None
+
+    if parts is None and (connections <= 1 or (has_checkpoint and job.get("bytes_written"))):
+        return await fetch_resumable(queue, job_id, url, headers, path, progress_hook)
+
+    if parts is None:
+        # Probe for the size and range support before splitting
+        probe = await client.get(url, headers={**headers, "Range": "bytes=0-0"})
+        if probe.status_code in (401, 403, 404, 410):
+            raise LinkExpired(f"Upstream returned {probe.status_code}")
+        total = _total_size(probe, 0) if probe.status_code == 206 else None
+        if total is None:
+            return await fetch_resumable(queue, job_id, url, headers, path, progress_hook)
+        part_size = -(-total // connections)
+        parts = [[start, min(start + part_size, total) - 1, 0] for start in range(0, total, part_size)]
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(part_path, "wb") as f:
+            f.truncate(total)
+        await queue.update(
+            job_id,
+            url=url,
+            path=path,
+            bytes_written=0,
+            total_bytes=total,
+            etag=probe.headers.get("etag"),
+            last_modified=probe.headers.get("last-modified"),
+            parts=json.dumps(parts),
+        )
+        validator = None
+    else:
+        total = job["total_bytes"]
+        validator = job.get("etag") or job.get("last_modified")
+        await queue.update(job_id, url=url)
+        print(f"[DOWNLOAD] Resuming {os.path.basename(path)} over {len(parts)} parts")
+
+    last_checkpoint = time.monotonic()
+
+    async def checkpoint(force: bool = False):
+        nonlocal last_checkpoint
+        now = time.monotonic()
+        if force or now - last_checkpoint >= CHECKPOINT_SECONDS:
+            last_checkpoint = now
+            f.flush()
+            await queue.update(job_id, bytes_written=sum(part[2] for part in parts), parts=json.dumps(parts))
+
+    async def fetch_part(part: list):
+        for attempt in range(PART_ATTEMPTS):
+            position = part[0] + part[2]
+            if position > part[1]:
+                return
+            part_headers = dict(headers)
+            part_headers["Range"] = f"bytes={position}-{part[1]}"
+            if validator:
+                part_headers["If-Range"] = validator
+            try:
+                async with client.stream("GET", url, headers=part_headers) as response:
+                    if response.status_code in (401, 403, 404, 410):
+                        raise LinkExpired(f"Upstream returned {response.status_code}")
+                    if response.status_code == 200:
+                        raise _SourceChanged()
+                    if response.status_code != 206:
+                        raise _PartError(response.status_code)
+                    async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                        position = part[0] + part[2]
+                        chunk = chunk[:part[1] + 1 - position]
+                        f.seek(position)
+                        f.write(chunk)
+                        part[2] += len(chunk)
+                        await checkpoint()
+                        if progress_hook:
+                            progress_hook(sum(p[2] for p in parts), total)
+                return
+            except Exception as e:
+                if not _is_retryable(e) or attempt == PART_ATTEMPTS - 1:
+                    raise
+                print(f"[DOWNLOAD] Part at {part[0]} failed ({e}), retrying")
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+    source_changed = False
+    with open(part_path, "r+b") as f:
+        tasks = [asyncio.create_task(fetch_part(part)) for part in parts]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for task in done:
+                if task.exception():
+                    raise task.exception()
+        except _SourceChanged:
+            source_changed = True
+        finally:
+            for task in tasks:
+                task.cancel()
+            if not source_changed:
+                await checkpoint(force=True)
+
+    if source_changed:
+        print(f"[DOWNLOAD] {os.path.basename(path)} changed upstream, starting over")
+        os.remove(part_path)
+        await queue.update(job_id, parts=None, bytes_written=0)
+        return await fetch_segmented(queue, job_id, url, headers, path, connections, progress_hook)
+
+    await queue.update(job_id, bytes_written=total, parts=None)
+    os.replace(part_path, path)
+    return path
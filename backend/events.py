@@ -0,0 +1,467 @@
+"""
+Job events and their delivery to WebSocket clients.
+
+Transfers report progress on every chunk. A ProgressReporter per job
+coalesces those ticks and publishes at most PROGRESS_RATE_HZ structured
+updates per second (bytes, total, speed, ETA), so WebSocket clients are
+not flooded with one message per chunk.
+
+Every event belongs to one or more topics ("downloads", "job:<id>", and
+"job:<parent id>" for episodes of a season job). Clients subscribe to the
+topics they care about and only receive those; a client that never
+subscribes gets everything, as before.
+
+Sending never blocks the publisher: each connection has its own bounded
+outbound queue drained by a writer task. When a queue is full the oldest
+progress update is dropped; a connection that fails, times out or cannot
+keep up with non-progress events is evicted. Catch-up messages are queued
+in full and do not count against the bound.
+
+Every event gets a sequence number and the latest one per job (or topic)
+is kept, so a client that connects or subscribes immediately receives the
+current state of what it is watching. It may also ask for the last few
+events, or for everything after the last sequence number it saw.
+
+The same events are also available as Server-Sent Events: an EventStream
+is a buffered, topic-filtered feed that /api/events reads from.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+from fastapi import WebSocket
+
+PROGRESS_RATE_HZ = float(os.environ.get("PROGRESS_RATE_HZ", "4"))
+# Weight of the newest sample in the smoothed speed
+SPEED_SMOOTHING = 0.3
+# Outbound messages buffered per WebSocket connection
+WS_QUEUE_SIZE = int(os.environ.get("WS_QUEUE_SIZE", "64"))
+# A send that takes longer than this marks the connection as dead
+WS_SEND_TIMEOUT = float(os.environ.get("WS_SEND_TIMEOUT", "5"))
+# Recent events kept for replay, and jobs/topics whose last state is kept
+EVENT_REPLAY_SIZE = int(os.environ.get("EVENT_REPLAY_SIZE", "500"))
+EVENT_STATE_SIZE = int(os.environ.get("EVENT_STATE_SIZE", "256"))
+# Idle time after which an SSE comment is sent to keep the connection open
+SSE_HEARTBEAT_SECONDS = float(os.environ.get("SSE_HEARTBEAT_SECONDS", "15"))
+
+
+class ProgressReporter:
+    """
+    Coalesces progress ticks for one job into rate-limited messages.
+
+    Create it inside the event loop; update() may then be called from the
+    loop or from any worker thread.
+    """
+
+    def __init__(self, publish: Callable[[dict], Awaitable[None]], job_id: str,
+                 rate_hz: float = PROGRESS_RATE_HZ, **fields):
+        self.publish = publish
+        self.job_id = job_id
+        self.fields = fields
+        self.interval = 1.0 / rate_hz if rate_hz > 0 else 0.0
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self.downloaded = 0
+        self.total: Optional[int] = None
+        self.speed = 0.0
+        self._last_emit = 0.0
+        self._last_bytes: Optional[int] = None
+        self._last_time = time.monotonic()
+        self._scheduled = None
+        self._sending: Optional[asyncio.Task] = None
+
+    def update(self, downloaded: int, total: Optional[int] = None):
+        if threading.get_ident() == self._loop_thread:
+            self._update(downloaded, total)
+        else:
+            self.loop.call_soon_threadsafe(self._update, downloaded, total)
+
+    def _update(self, downloaded: int, total: Optional[int]):
+        self.downloaded = downloaded
+        if total is not None:
+            self.total = total
+        if self._scheduled is not None:
+            # A flush is already pending, it will pick up the latest numbers
+            return
+        delay = self._last_emit + self.interval - time.monotonic()
+        if delay <= 0:
+            self._flush()
+        else:
+            self._scheduled = self.loop.call_later(delay, self._flush)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        if self._last_bytes is not None and now > self._last_time:
+            sample = max(self.downloaded - self._last_bytes, 0) / (now - self._last_time)
+            self.speed = sample if not self.speed else SPEED_SMOOTHING * sample + (1 - SPEED_SMOOTHING) * self.speed
+        self._last_bytes = self.downloaded
+        self._last_time = now
+
+        eta = None
+        percent = None
+        if self.total:
+            percent = round(self.downloaded * 100 / self.total, 1)
+            if self.speed > 0:
+                eta = round(max(self.total - self.downloaded, 0) / self.speed, 1)
+        return {
+            "bytes": self.downloaded,
+            "total": self.total,
+            "percent": percent,
+            "speed": round(self.speed),
+            "eta": eta,
+        }
+
+    def _flush(self):
+        self._scheduled = None
+        if self._sending is not None and not self._sending.done():
+            # The previous update is still being delivered, try again next interval
+            self._scheduled = self.loop.call_later(self.interval or 0.05, self._flush)
+            return
+        self._last_emit = time.monotonic()
+        message = {"job_id": self.job_id, "status": "downloading", **self.fields, "progress": self.snapshot()}
+        self._sending = self.loop.create_task(self.publish(message))
+
+    async def close(self):
+        """Publish the final numbers and stop any pending update."""
+        if self._scheduled is not None:
+            self._scheduled.cancel()
+            self._scheduled = None
+        if self._sending is not None:
+            await asyncio.gather(self._sending, return_exceptions=True)
+        if self._last_bytes != self.downloaded:
+            self._flush()
+            await asyncio.gather(self._sending, return_exceptions=True)
+
+
+ALL_TOPICS = "*"
+
+
+def message_topics(message: dict) -> List[str]:
+    """Topics an event is routed to."""
+    topics = []
+    if message.get("topic"):
+        topics.append(message["topic"])
+    if message.get("job_id"):
+        topics += ["downloads", f"job:{message['job_id']}"]
+    if message.get("parent_id"):
+        topics.append(f"job:{message['parent_id']}")
+    return topics
+
+
+def parse_seq(value) -> Optional[int]:
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def matches(message: dict, topics: Iterable[str]) -> bool:
+    topics = set(topics)
+    return ALL_TOPICS in topics or not topics.isdisjoint(message_topics(message))
+
+
+def is_progress(message: dict) -> bool:
+    return message.get("status") == "downloading"
+
+
+class EventLog:
+    """Sequence numbers, recent history and the last state per job or topic."""
+
+    def __init__(self, size: int = EVENT_REPLAY_SIZE, states: int = EVENT_STATE_SIZE):
+        self.seq = 0
+        # Kept in seq order, oldest first
+        self.events = deque()
+        self.size = size
+        self.states: "OrderedDict[str, dict]" = OrderedDict()
+        self.max_states = states
+
+    def record(self, message: dict) -> dict:
+        if "seq" in message:
+            # Numbered by the shared state, possibly in another worker
+            self.seq = max(self.seq, message["seq"])
+        else:
+            self.seq += 1
+            message = {**message, "seq": self.seq}
+        index = len(self.events)
+        while index and self.events[index - 1]["seq"] > message["seq"]:
+            # Arrived late, after events numbered after it
+            index -= 1
+        self.events.insert(index, message)
+        while len(self.events) > self.size:
+            self.events.popleft()
+        key = message.get("job_id") or message.get("topic")
+        current = self.states.get(key) if key else None
+        if key and (current is None or current["seq"] < message["seq"]):
+            self.states.pop(key, None)
+            self.states[key] = message
+            while len(self.states) > self.max_states:
+                self.states.popitem(last=False)
+        return message
+
+    def snapshot(self, topics: Iterable[str]) -> List[dict]:
+        """Latest state of every job/topic matching the topics, oldest first."""
+        return sorted((m for m in self.states.values() if matches(m, topics)), key=lambda m: m["seq"])
+
+    def recent(self, count: int, topics: Iterable[str]) -> List[dict]:
+        found = []
+        for message in reversed(self.events):
+            if len(found) >= count:
+                break
+            if matches(message, topics):
+                found.append(message)
+        return found[::-1]
+
+    def since(self, seq: int, topics: Iterable[str]) -> Optional[List[dict]]:
+        """Events after seq, or None if some of them are no longer kept."""
+        if seq > self.seq:
+            # From before a restart, sequence numbers start over
+            return None
+        oldest = self.events[0]["seq"] if self.events else None
+        if seq < self.seq and (oldest is None or oldest > seq + 1):
+            return None
+        return [m for m in self.events if m["seq"] > seq and matches(m, topics)]
+
+    def catch_up(self, topics: Iterable[str], since: Optional[int] = None, replay: int = 0) -> List[dict]:
+        """
+        What a new subscriber should be sent: the events it missed if it
+        knows where it left off, otherwise the last `replay` events plus the
+        current state of everything not covered by them, in order.
+        """
+        topics = list(topics)
+        if since is not None:
+            missed = self.since(since, topics)
+            if missed is not None:
+                return missed
+        history = self.recent(replay, topics) if replay > 0 else []
+        sent = {m["seq"] for m in history}
+        current = [m for m in self.snapshot(topics) if m["seq"] not in sent]
+        return sorted(current + history, key=lambda m: m["seq"])
+
+
+class _Buffer:
+    """Bounded message queue that gives up progress updates first."""
+
+    def __init__(self):
+        self.messages = deque()
+        # Queued catch-up messages; they do not count against the bound
+        self.replayed = 0
+        self.ready = asyncio.Event()
+        self.dropped = 0
+
+    def offer(self, message: dict) -> bool:
+        """Queue a message. Returns False if the connection cannot keep up."""
+        if len(self.messages) - self.replayed >= WS_QUEUE_SIZE:
+            for index, queued in enumerate(self.messages):
+                if is_progress(queued) and not queued.get("replay"):
+                    del self.messages[index]
+                    self.dropped += 1
+                    break
+            else:
+                return False
+        self.messages.append(message)
+        self.ready.set()
+        return True
+
+    def replay(self, messages: Iterable[dict]):
+        """Queue a catch-up in full, however long it is; the event log bounds its size."""
+        for message in messages:
+            self.messages.append({**message, "replay": True})
+            self.replayed += 1
+        if self.messages:
+            self.ready.set()
+
+    def pop(self) -> Optional[dict]:
+        if not self.messages:
+            return None
+        message = self.messages.popleft()
+        if message.get("replay"):
+            self.replayed -= 1
+        return message
+
+
+class _Outbox(_Buffer):
+    """Send queue and writer task for one WebSocket connection."""
+
+    def __init__(self, manager: "ConnectionManager", websocket: WebSocket):
+        super().__init__()
+        self.manager = manager
+        self.websocket = websocket
+        self.task = asyncio.create_task(self._write())
+
+    async def _write(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                message = self.pop()
+                while message is not None:
+                    await asyncio.wait_for(self.websocket.send_json(message), WS_SEND_TIMEOUT)
+                    message = self.pop()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[WS] Evicting connection after failed send: {e!r}")
+            await self.manager.evict(self.websocket)
+
+
+class EventStream(_Buffer):
+    """Topic-filtered event feed for one Server-Sent Events client."""
+
+    def __init__(self, topics: Iterable[str]):
+        super().__init__()
+        self.topics = set(topics)
+        self.closed = False
+
+    async def next(self, timeout: float = SSE_HEARTBEAT_SECONDS) -> Optional[dict]:
+        """The next event, or None if nothing arrived within the timeout."""
+        if not self.messages:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.pop()
+
+
+def format_sse(message: dict) -> str:
+    return f"id: {message['seq']}\ndata: {json.dumps(message)}\n\n"
+
+
+class ConnectionManager:
+    """WebSocket connections and the topics each one is subscribed to."""
+
+    def __init__(self, state=None):
+        self.active_connections: List[WebSocket] = []
+        self.subscriptions: Dict[WebSocket, Set[str]] = {}
+        self.subscribers: Dict[str, Set[WebSocket]] = {}
+        self.outboxes: Dict[WebSocket, _Outbox] = {}
+        self.log = EventLog()
+        self.streams: Set[EventStream] = set()
+        # Connections still on the implicit "everything" subscription
+        self.implicit: Set[WebSocket] = set()
+        # shared_state backend that carries events to the other workers
+        self.state = state
+
+    async def connect(self, websocket: WebSocket, since: Optional[int] = None, replay: int = 0):
+        await websocket.accept()
+        self.active_connections.append(websocket)
+        self.subscriptions[websocket] = set()
+        self.outboxes[websocket] = _Outbox(self, websocket)
+        self.implicit.add(websocket)
+        self._add(websocket, [ALL_TOPICS])
+        self._catch_up(websocket, [ALL_TOPICS], since, replay)
+
+    def _catch_up(self, websocket: WebSocket, topics: Iterable[str], since: Optional[int], replay: int):
+        outbox = self.outboxes.get(websocket)
+        if outbox is not None:
+            outbox.replay(self.log.catch_up(topics, since, replay))
+
+    def disconnect(self, websocket: WebSocket):
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
+        self._remove(websocket, list(self.subscriptions.pop(websocket, ())))
+        self.implicit.discard(websocket)
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox is not None and outbox.task is not asyncio.current_task():
+            outbox.task.cancel()
+
+    async def evict(self, websocket: WebSocket):
+        """Drop a dead or hopelessly slow connection."""
+        self.disconnect(websocket)
+        try:
+            await asyncio.wait_for(websocket.close(), WS_SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    def open_stream(self, topics: Iterable[str], since: Optional[int] = None, replay: int = 0) -> EventStream:
+        stream = EventStream(topics)
+        # The catch-up may be longer than the queue allows, it is delivered in full
+        stream.replay(self.log.catch_up(stream.topics, since, replay))
+        self.streams.add(stream)
+        return stream
+
+    def close_stream(self, stream: EventStream):
+        stream.closed = True
+        stream.ready.set()
+        self.streams.discard(stream)
+
+    def send(self, websocket: WebSocket, message: dict):
+        outbox = self.outboxes.get(websocket)
+        if outbox is not None and not outbox.offer(message):
+            print("[WS] Evicting connection with a full send queue")
+            self.disconnect(websocket)
+            asyncio.create_task(self.evict(websocket))
+
+    def _add(self, websocket: WebSocket, topics: Iterable[str]):
+        for topic in topics:
+            self.subscriptions[websocket].add(topic)
+            self.subscribers.setdefault(topic, set()).add(websocket)
+
+    def _remove(self, websocket: WebSocket, topics: Iterable[str]):
+        for topic in topics:
+            self.subscriptions.get(websocket, set()).discard(topic)
+            subscribers = self.subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(websocket)
+                if not subscribers:
+                    del self.subscribers[topic]
+
+    def subscribe(self, websocket: WebSocket, topics: Iterable[str]):
+        if websocket in self.implicit:
+            # The first explicit subscription replaces "everything"
+            self.implicit.discard(websocket)
+            self._remove(websocket, [ALL_TOPICS])
+        self._add(websocket, topics)
+
+    def unsubscribe(self, websocket: WebSocket, topics: Iterable[str]):
+        self._remove(websocket, topics)
+
+    async def handle(self, websocket: WebSocket, data: dict):
+        """Apply a subscribe/unsubscribe request sent by the client."""
+        action = data.get("action")
+        if action not in ("subscribe", "unsubscribe"):
+            return
+        topics = [str(topic) for topic in data.get("topics") or []]
+        if data.get("job_id"):
+            topics.append(f"job:{data['job_id']}")
+        if action == "subscribe":
+            new_topics = [t for t in topics if t not in self.subscriptions.get(websocket, ())]
+            self.subscribe(websocket, topics)
+        else:
+            self.unsubscribe(websocket, topics)
+        self.send(websocket, {"status": "subscribed", "topics": sorted(self.subscriptions.get(websocket, ())),
+                              "seq": self.log.seq})
+        if action == "subscribe" and new_topics:
+            self._catch_up(websocket, new_topics, parse_seq(data.get("since")), parse_seq(data.get("replay")) or 0)
+
+    def targets(self, message: dict) -> Set[WebSocket]:
+        targets = set(self.subscribers.get(ALL_TOPICS, ()))
+        for topic in message_topics(message):
+            targets |= self.subscribers.get(topic, set())
+        return targets
+
+    async def broadcast(self, message: dict):
+        """Publish an event to every worker and queue it for the local subscribers."""
+        if self.state is not None and self.state.shared:
+            try:
+                # It comes back through the shared feed, in seq order with the other workers' events
+                await self.state.publish(message)
+                return
+            except Exception as e:
+                print(f"[STATE] Publishing event failed, delivering locally only: {e}")
+        self.deliver(message)
+
+    def deliver(self, message: dict):
+        """Queue an event for the connections subscribed to any of its topics."""
+        message = self.log.record(message)
+        for connection in self.targets(message):
+            self.send(connection, message)
+        for stream in list(self.streams):
+            if matches(message, stream.topics) and not stream.offer(message):
+                # Too far behind; the client reconnects with Last-Event-ID
+                print("[SSE] Closing stream with a full queue")
+                self.close_stream(stream)
@@ -0,0 +1,255 @@
+"""
+HLS support for /api/proxy-stream.
+
+Playlists are rewritten so variant playlists, segments, init sections and
+keys are fetched back through the proxy with the session headers. Media
+segments are kept in an LRU disk cache and the next few segments of a
+playlist are prefetched while the current one plays. Only the most
+recently fetched playlists are remembered, and a refreshed live playlist
+replaces its previous segment list.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote, urljoin, urlparse
+
+from proxy import get_client
+
+HLS_CACHE_DIR = os.environ.get("HLS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "moviebox-hls"))
+HLS_CACHE_BYTES = int(float(os.environ.get("HLS_CACHE_MB", "512")) * 1024 * 1024)
+HLS_PREFETCH_SEGMENTS = int(os.environ.get("HLS_PREFETCH_SEGMENTS", "3"))
+# Playlists whose segment order is remembered for prefetching
+HLS_MAX_PLAYLISTS = 64
+
+PLAYLIST_TYPES = ("application/vnd.apple.mpegurl", "application/x-mpegurl", "audio/mpegurl", "audio/x-mpegurl")
+_URI_ATTRIBUTE = re.compile(r'URI="([^"]+)"')
+
+
+def looks_like_playlist(url: str) -> bool:
+    return urlparse(url).path.lower().endswith((".m3u8", ".m3u"))
+
+
+def is_playlist_type(content_type: Optional[str]) -> bool:
+    return bool(content_type) and content_type.split(";")[0].strip().lower() in PLAYLIST_TYPES
+
+
+class SegmentCache:
+    """Size-bounded LRU cache of segment bodies on disk, safe to use from executor threads."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, int]" = OrderedDict()  # key -> size, oldest first
+        self.size = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Pick up what a previous run left behind, least recently used first
+        files = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and not name.endswith(".tmp"):
+                files.append((os.path.getmtime(path), name, os.path.getsize(path)))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+        self._evict()
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha1(url.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def __contains__(self, url: str) -> bool:
+        return self.key(url) in self.entries
+
+    def get(self, url: str) -> Optional[bytes]:
+        key = self.key(url)
+        if key not in self.entries:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            with self.lock:
+                if key in self.entries:
+                    self.size -= self.entries.pop(key)
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return data
+
+    def put(self, url: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        key = self.key(url)
+        tmp_path = self._path(key) + f".{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        with self.lock:
+            os.replace(tmp_path, self._path(key))
+            if key in self.entries:
+                self.size -= self.entries.pop(key)
+            self.entries[key] = len(data)
+            self.size += len(data)
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+_cache: Optional[SegmentCache] = None
+# segment url -> (playlist url, position in that playlist)
+_segment_index: Dict[str, Tuple[str, int]] = {}
+# playlist url -> ordered segment urls, least recently fetched first
+_playlists: "OrderedDict[str, List[str]]" = OrderedDict()
+# segment url -> transfer shared by everyone asking for it
+_inflight: Dict[str, asyncio.Task] = {}
+
+
+def get_cache() -> SegmentCache:
+    global _cache
+    if _cache is None:
+        _cache = SegmentCache(HLS_CACHE_DIR, HLS_CACHE_BYTES)
+    return _cache
+
+
+def is_segment(url: str) -> bool:
+    return url in _segment_index
+
+
+def rewrite_playlist(text: str, playlist_url: str, proxy_path: str, client_id: Optional[str] = None) -> str:
+    """Point every URI in the playlist back at the proxy and remember the segment order."""
+    # Players cannot add headers to the URLs they follow, the client id rides along in the query
+    suffix = f"&client={quote(client_id, safe='')}" if client_id else ""
+
+    def proxied(uri: str) -> str:
+        return f"{proxy_path}?url={quote(urljoin(playlist_url, uri), safe='')}{suffix}"
+
+    is_master = "#EXT-X-STREAM-INF" in text
+    # Byte-range playlists share one URL between segments; leave those to the range proxy
+    cacheable = not is_master and "#EXT-X-BYTERANGE" not in text
+    segments = []
+    lines = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped:
+            lines.append(line)
+        elif stripped.startswith("#"):
+            if cacheable and stripped.startswith("#EXT-X-MAP"):
+                match = _URI_ATTRIBUTE.search(stripped)
+                if match:
+                    segments.append(urljoin(playlist_url, match.group(1)))
+            lines.append(_URI_ATTRIBUTE.sub(lambda m: f'URI="{proxied(m.group(1))}"', line))
+        else:
+            if cacheable:
+                segments.append(urljoin(playlist_url, stripped))
+            lines.append(proxied(stripped))
+
+    if segments:
+        _remember(playlist_url, segments)
+    return "\n".join(lines) + "\n"
+
+
+def _forget(playlist_url: str):
+    for segment_url in _playlists.pop(playlist_url, []):
+        if _segment_index.get(segment_url, (None,))[0] == playlist_url:
+            del _segment_index[segment_url]
+
+
+def _remember(playlist_url: str, segments: List[str]):
+    # A live playlist slides forward on every refresh, drop what it listed before
+    _forget(playlist_url)
+    _playlists[playlist_url] = segments
+    for position, segment_url in enumerate(segments):
+        _segment_index[segment_url] = (playlist_url, position)
+    while len(_playlists) > HLS_MAX_PLAYLISTS:
+        _forget(next(iter(_playlists)))
+
+
+async def fetch_playlist(url: str, headers: dict, proxy_path: str, client_id: Optional[str] = None) -> Tuple[int, str]:
+    response = await get_client().get(url, headers=headers)
+    if response.status_code != 200:
+        return response.status_code, ""
+    return 200, rewrite_playlist(response.text, str(response.url), proxy_path, client_id)
+
+
+async def _download(url: str, headers: dict) -> bytes:
+    response = await get_client().get(url, headers=headers)
+    if response.status_code != 200:
+        raise RuntimeError(f"Segment request returned {response.status_code}")
+    return response.content
+
+
+async def _fetch(url: str, headers: dict) -> bytes:
+    data = await _download(url, headers)
+    await asyncio.get_running_loop().run_in_executor(None, get_cache().put, url, data)
+    return data
+
+
+def _transfer_done(url: str, task: asyncio.Task):
+    if _inflight.get(url) is task:
+        del _inflight[url]
+    if not task.cancelled():
+        # Everyone waiting may have gone, keep the loop from warning about it
+        task.exception()
+
+
+async def _load(url: str, headers: dict) -> bytes:
+    """Fetch a segment into the cache, sharing the transfer with concurrent callers."""
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(None, get_cache().get, url)
+    if data is not None:
+        return data
+    task = _inflight.get(url)
+    if task is None:
+        # Its own task, so a client that goes away does not cancel it for the others
+        task = _inflight[url] = asyncio.create_task(_fetch(url, headers))
+        task.add_done_callback(lambda done: _transfer_done(url, done))
+    return await asyncio.shield(task)
+
+
+def _prefetch(url: str, headers: dict):
+    if url not in _segment_index:
+        return
+    playlist_url, position = _segment_index[url]
+    upcoming = _playlists.get(playlist_url, [])[position + 1:position + 1 + HLS_PREFETCH_SEGMENTS]
+    cache = get_cache()
+    for segment_url in upcoming:
+        if segment_url not in cache and segment_url not in _inflight:
+            asyncio.create_task(_prefetch_one(segment_url, headers))
+
+
+async def _prefetch_one(url: str, headers: dict):
+    try:
+        await _load(url, headers)
+    except Exception as e:
+        print(f"[HLS] Prefetch failed for {url}: {e}")
+
+
+async def serve_segment(url: str, headers: dict) -> bytes:
+    """Segment body from the cache or upstream, prefetching the ones after it."""
+    _prefetch(url, headers)
+    return await _load(url, headers)
+
+
+def segment_type(url: str) -> str:
+    path = urlparse(url).path.lower()
+    if path.endswith((".mp4", ".m4s", ".m4v")):
+        return "video/mp4"
+    if path.endswith(".aac"):
+        return "audio/aac"
+    return "video/mp2t"
@@ -0,0 +1,129 @@
+"""
+Adaptive concurrency limit for upstream moviebox calls (AIMD).
+
+The limit grows by about one slot per round of successful calls while
+latency stays close to its usual level and few calls fail, and is halved when upstream
+signals overload (429, 5xx, timeouts). Calls beyond the limit wait their
+turn in order.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from sessions import status_of
+
+UPSTREAM_CONCURRENCY_INITIAL = int(os.environ.get("UPSTREAM_CONCURRENCY_INITIAL", "4"))
+UPSTREAM_CONCURRENCY_MIN = int(os.environ.get("UPSTREAM_CONCURRENCY_MIN", "1"))
+UPSTREAM_CONCURRENCY_MAX = int(os.environ.get("UPSTREAM_CONCURRENCY_MAX", "32"))
+# A call slower than this multiple of the usual latency stops the limit from growing
+UPSTREAM_LATENCY_TOLERANCE = float(os.environ.get("UPSTREAM_LATENCY_TOLERANCE", "2"))
+# While more than this share of recent calls hit overload, the limit does not grow
+UPSTREAM_ERROR_RATE_MAX = float(os.environ.get("UPSTREAM_ERROR_RATE_MAX", "0.05"))
+DECREASE_FACTOR = 0.5
+# Weight of the newest sample in the latency and error averages
+SMOOTHING = 0.1
+
+
+def is_overload(exc: BaseException) -> bool:
+    import httpx
+
+    if isinstance(exc, httpx.TimeoutException):
+        return True
+    status = status_of(exc)
+    return status is not None and (status == 429 or status >= 500)
+
+
+class AdaptiveLimiter:
+    def __init__(self, initial: int = UPSTREAM_CONCURRENCY_INITIAL, minimum: int = UPSTREAM_CONCURRENCY_MIN,
+                 maximum: int = UPSTREAM_CONCURRENCY_MAX, tolerance: float = UPSTREAM_LATENCY_TOLERANCE,
+                 max_error_rate: float = UPSTREAM_ERROR_RATE_MAX):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.tolerance = tolerance
+        self.max_error_rate = max_error_rate
+        self.in_flight = 0
+        self.waiters = deque()
+        self.latency = None  # smoothed latency of successful calls, seconds
+        self.error_rate = 0.0
+        self.successes = 0
+        self.overloads = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+
+    def _wake(self):
+        while self.waiters and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def acquire(self):
+        if self.in_flight < int(self.limit) and not self.waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Granted just as we were cancelled, give the slot back
+                self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _on_success(self, elapsed: float):
+        self.successes += 1
+        self.error_rate *= 1 - SMOOTHING
+        healthy = self.latency is None or elapsed <= self.latency * self.tolerance
+        healthy = healthy and self.error_rate <= self.max_error_rate
+        self.latency = elapsed if self.latency is None else SMOOTHING * elapsed + (1 - SMOOTHING) * self.latency
+        # Only grow while the limit is actually what holds calls back
+        if healthy and self.in_flight >= int(self.limit) - 1:
+            self.limit = min(self.limit + 1 / self.limit, self.maximum)
+
+    def _on_overload(self):
+        self.overloads += 1
+        self.error_rate = SMOOTHING + (1 - SMOOTHING) * self.error_rate
+        now = time.monotonic()
+        # Calls that were already running when upstream pushed back count as one signal
+        if now - self._last_decrease < (self.latency or 1.0):
+            return
+        self._last_decrease = now
+        self.decreases += 1
+        self.limit = max(self.limit * DECREASE_FACTOR, self.minimum)
+        print(f"[LIMIT] Upstream overloaded, concurrency limit cut to {int(self.limit)}")
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one unit of upstream concurrency for the duration of a call."""
+        await self.acquire()
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            if is_overload(e):
+                self._on_overload()
+            raise
+        else:
+            self._on_success(time.monotonic() - started)
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "waiting": len(self.waiters),
+            "latency_ms": round(self.latency * 1000) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "successes": self.successes,
+            "overloads": self.overloads,
+            "decreases": self.decreases,
+        }
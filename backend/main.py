@@ -1,8 +1,28 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+import api
 from api import router as api_router
+import model_patches
 
-app = FastAPI(title="MovieBox Web App", description="API for MovieBox Web App")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The server starts accepting requests only once the models are patched and the sessions are warm
+    model_patches.apply()
+    # The queue and shared state open their databases here rather than at import
+    api.open_state()
+    # Events published by the other workers reach this worker's subscribers
+    await api.worker_state.start(api.manager.deliver)
+    await api.warmup_session()
+    keepalive = asyncio.create_task(api.session_keepalive())
+    await api.download_queue.start()
+    yield
+    keepalive.cancel()
+    await api.download_queue.stop()
+    await api.worker_state.close()
+
+app = FastAPI(title="MovieBox Web App", description="API for MovieBox Web App", lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -0,0 +1,129 @@
+"""
+Fixes for moviebox_api models that reject real upstream payloads.
+
+Some titles come back with `trailer: null`, which SubjectModel does not
+accept, so their details fail to validate. Instead of editing the
+library's classes in place and force-rebuilding their schemas on every
+start, subclasses with the relaxed field are built once, on first use,
+and put in place of the originals in the moviebox_api modules that
+validate with them. Instances still pass isinstance checks against the
+original classes.
+"""
+import functools
+import operator
+import sys
+import types
+from typing import Any, Dict, Optional, Set, Union, get_args, get_origin
+
+_applied = False
+# original class -> patched subclass
+replacements: Dict[type, type] = {}
+# moviebox_api modules already pointed at the patched classes
+_registered: Set[str] = set()
+
+
+def swap_annotation(annotation: Any, old: type, new: type) -> Any:
+    """The annotation with `old` replaced by `new`, also inside Optional/Union/List."""
+    if annotation is old:
+        return new
+    args = get_args(annotation)
+    if not args:
+        return annotation
+    new_args = tuple(swap_annotation(arg, old, new) for arg in args)
+    if new_args == args:
+        return annotation
+    origin = get_origin(annotation)
+    if origin is Union:
+        return Union[new_args]
+    if origin is types.UnionType:
+        return functools.reduce(operator.or_, new_args)
+    if hasattr(annotation, "copy_with"):
+        return annotation.copy_with(new_args)
+    return origin[new_args]
+
+
+def _subclass(model: type, field: str, annotation: Any, **overrides) -> type:
+    """Subclass of `model` with one field re-declared, keeping its alias and other settings."""
+    from pydantic import create_model
+    from pydantic.fields import FieldInfo
+
+    original = model.model_fields[field]
+    info = FieldInfo.merge_field_infos(original, annotation=annotation, **overrides)
+    return create_model(model.__name__, __base__=model, __module__=__name__, **{field: (annotation, info)})
+
+
+def _contains(annotation: Any, model: type) -> bool:
+    return annotation is model or any(_contains(arg, model) for arg in get_args(annotation))
+
+
+def _register():
+    """Point moviebox_api's module globals and class attributes at the patched classes."""
+    for name, module in list(sys.modules.items()):
+        if not name.startswith("moviebox_api") or module is None or name in _registered:
+            continue
+        _registered.add(name)
+        for attr, value in list(vars(module).items()):
+            if isinstance(value, type) and value in replacements:
+                setattr(module, attr, replacements[value])
+            elif isinstance(value, type) and value.__module__ == name:
+                # Providers may name the model they validate with as a class attribute
+                for class_attr, class_value in list(vars(value).items()):
+                    if isinstance(class_value, type) and class_value in replacements:
+                        setattr(value, class_attr, replacements[class_value])
+
+
+def register():
+    """
+    Patch the moviebox_api modules imported since apply(). Call it once right
+    after lazily importing one (e.g. moviebox_api.download), not per request.
+    """
+    if _applied:
+        _register()
+
+
+def apply() -> bool:
+    """Build and register the patched models, once from the app lifespan; returns True if patched."""
+    global _applied
+    if _applied:
+        return True
+    try:
+        from moviebox_api.extractor._core import ItemJsonDetailsModel
+        from moviebox_api.extractor.models.json import SubjectModel, SubjectTrailerModel
+
+        if "trailer" not in SubjectModel.model_fields:
+            return False
+        patched_subject = _subclass(SubjectModel, "trailer", Optional[Union[dict, SubjectTrailerModel]], default=None)
+        replacements[SubjectModel] = patched_subject
+
+        # Re-declare every field on the way down from ItemJsonDetailsModel to the subject
+        res_data_annotation = ItemJsonDetailsModel.model_fields["resData"].annotation
+        for res_data_model in (a for a in (res_data_annotation, *get_args(res_data_annotation)) if isinstance(a, type)):
+            if hasattr(res_data_model, "model_fields"):
+                break
+        else:
+            return False
+        for field, info in res_data_model.model_fields.items():
+            if _contains(info.annotation, SubjectModel):
+                res_data_model_patched = _subclass(
+                    res_data_model, field, swap_annotation(info.annotation, SubjectModel, patched_subject))
+                replacements[res_data_model] = res_data_model_patched
+                break
+        else:
+            return False
+        replacements[ItemJsonDetailsModel] = _subclass(
+            ItemJsonDetailsModel, "resData", swap_annotation(res_data_annotation, res_data_model, res_data_model_patched))
+
+        _register()
+        _applied = True
+        print("Patched SubjectModel.trailer to accept null")
+        return True
+    except Exception as e:
+        print(f"Failed to patch models: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def validator(model: type) -> type:
+    """The class to validate `model` payloads with: the patched one if there is one."""
+    return replacements.get(model, model)
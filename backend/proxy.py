@@ -0,0 +1,657 @@
+"""
+Upstream fan-out for /api/proxy-stream.
+
+Several devices playing the same title share one upstream reader per
+(URL, range window). The reader fills a bounded ring buffer and every
+downstream client drains it at its own pace. A client that falls behind
+the buffer detaches and continues on its own upstream connection, so it
+never stalls the others.
+
+While clients drain the buffer the reader keeps fetching ahead of the
+leading client. The read-ahead window starts small and grows while the
+access pattern stays sequential, and a client that seeks elsewhere
+cancels the prefetch it left behind.
+
+Optionally a reader splits its range into segments fetched over several
+parallel ranged connections, for CDNs that cap per-connection throughput.
+Segments are still delivered in order, with at most one segment per
+connection held in memory.
+
+Bandwidth is shared fairly: every client (and every upstream reader) gets
+a token bucket whose rate is recomputed by max-min water-filling over the
+optional global cap, so a greedy player cannot starve the others.
+"""
+import asyncio
+import itertools
+import os
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+CHUNK_SIZE = 64 * 1024
+# Bytes kept in memory per shared upstream reader
+TEE_BUFFER_BYTES = int(float(os.environ.get("PROXY_TEE_BUFFER_MB", "8")) * 1024 * 1024)
+# Upper bound for the read-ahead window in front of the leading client
+READAHEAD_BYTES = int(float(os.environ.get("PROXY_READAHEAD_MB", "4")) * 1024 * 1024)
+# Initial read-ahead window, doubled each time the client consumes a full window
+READAHEAD_MIN_BYTES = 256 * 1024
+# A new client may join a reader whose window starts at most this far behind it
+TEE_JOIN_SLACK = 1024 * 1024
+# Parallel ranged connections per upstream reader (1 disables segmented fetch)
+PROXY_CONNECTIONS = int(os.environ.get("PROXY_CONNECTIONS", "1"))
+PROXY_SEGMENT_BYTES = int(float(os.environ.get("PROXY_SEGMENT_MB", "1")) * 1024 * 1024)
+SEGMENT_ATTEMPTS = 3
+# Bandwidth caps in megabits per second, 0 means unlimited
+PROXY_MAX_RATE_MBIT = float(os.environ.get("PROXY_MAX_RATE_MBIT", "0"))
+PROXY_CLIENT_RATE_MBIT = float(os.environ.get("PROXY_CLIENT_RATE_MBIT", "0"))
+PROXY_UPSTREAM_RATE_MBIT = float(os.environ.get("PROXY_UPSTREAM_RATE_MBIT", "0"))
+# How long an unused reader is kept around for late joiners
+TEE_IDLE_SECONDS = 10.0
+
+_client = None
+
+
+def get_client():
+    """Shared pooled HTTP client for all proxy upstream connections."""
+    global _client
+    import httpx
+
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=httpx.Timeout(30.0, read=60.0),
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=16),
+        )
+        import recorder
+        recorder.install_client(_client)
+    return _client
+
+
+def parse_range(header: Optional[str]) -> Optional[Tuple[int, Optional[int]]]:
+    """Parse a single `bytes=start-[end]` range. Returns None if absent or unsupported."""
+    if not header or not header.startswith("bytes="):
+        return None
+    spec = header[len("bytes="):].split(",")[0].strip()
+    start, _, end = spec.partition("-")
+    if not start:
+        # Suffix ranges (bytes=-N) need the total size, not supported for sharing
+        return None
+    try:
+        start, end = int(start), (int(end) if end else None)
+    except ValueError:
+        return None
+    if end is not None and end < start:
+        # Syntactically invalid, the header is ignored
+        return None
+    return start, end
+
+
+def _total_size(status_code: int, headers, start: int) -> Optional[int]:
+    content_range = headers.get("content-range")
+    if content_range and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        if total.isdigit():
+            return int(total)
+    length = headers.get("content-length")
+    if length and length.isdigit():
+        return int(length) + (start if status_code == 206 else 0)
+    return None
+
+
+def _mbit(rate_mbit: float) -> Optional[float]:
+    """Megabits per second to bytes per second, None for unlimited."""
+    return rate_mbit * 1_000_000 / 8 if rate_mbit > 0 else None
+
+
+class TokenBucket:
+    """Paces a byte stream to `rate` bytes per second. A rate of None never waits."""
+
+    def __init__(self, rate: Optional[float] = None):
+        self.rate = None
+        self.burst = 0.0
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: Optional[float]):
+        self.rate = rate
+        # Allow a quarter second of burst so small chunks are not sliced up
+        self.burst = max(rate * 0.25, CHUNK_SIZE) if rate else 0.0
+        self.tokens = min(self.tokens, self.burst)
+
+    async def consume(self, amount: int) -> bool:
+        """Take `amount` tokens, sleeping if the bucket runs dry. Returns True if it waited."""
+        if self.rate is None:
+            return False
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return False
+        await asyncio.sleep(-self.tokens / self.rate)
+        return True
+
+
+class _Share:
+    def __init__(self):
+        self.refs = 0
+        self.bucket = TokenBucket()
+        self.since = time.monotonic()
+        self.bytes_total = 0
+        self.bytes_window = 0
+        self.measured = 0.0  # bytes per second over the last interval
+        self.throttled = False
+
+
+class BandwidthScheduler:
+    """
+    Fair-share bandwidth allocation across keys (clients or upstream readers).
+
+    Each key gets min(per-key cap, max-min fair share of the global cap).
+    Keys using less than their share leave the rest to the hungry ones.
+    """
+
+    RECOMPUTE_SECONDS = 1.0
+    # Floor for a key that is currently using very little bandwidth
+    MIN_RATE = 64 * 1024
+
+    def __init__(self, name: str, global_rate: Optional[float] = None, key_rate: Optional[float] = None):
+        self.name = name
+        self.global_rate = global_rate
+        self.key_rate = key_rate
+        self.shares: Dict[str, _Share] = {}
+        self._last_recompute = time.monotonic()
+
+    def register(self, key: str):
+        share = self.shares.get(key)
+        if share is None:
+            share = self.shares[key] = _Share()
+        share.refs += 1
+        self._recompute()
+
+    def release(self, key: str):
+        share = self.shares.get(key)
+        if share is None:
+            return
+        share.refs -= 1
+        if share.refs <= 0:
+            del self.shares[key]
+        self._recompute()
+
+    async def throttle(self, key: str, amount: int):
+        share = self.shares.get(key)
+        if share is None:
+            return
+        share.bytes_total += amount
+        share.bytes_window += amount
+        if time.monotonic() - self._last_recompute >= self.RECOMPUTE_SECONDS:
+            self._recompute()
+        if await share.bucket.consume(amount):
+            share.throttled = True
+
+    def _demand(self, share: _Share, now: float) -> float:
+        # Throttled or freshly started keys want as much as they can get
+        if share.throttled or now - share.since < self.RECOMPUTE_SECONDS * 2:
+            return float("inf")
+        return max(share.measured * 1.25, self.MIN_RATE)
+
+    def _recompute(self):
+        now = time.monotonic()
+        elapsed = max(now - self._last_recompute, 1e-3)
+        self._last_recompute = now
+        demands = {}
+        for key, share in self.shares.items():
+            share.measured = share.bytes_window / elapsed
+            share.bytes_window = 0
+            demands[key] = self._demand(share, now)
+            share.throttled = False
+
+        key_cap = self.key_rate if self.key_rate is not None else float("inf")
+        if self.global_rate is None:
+            for share in self.shares.values():
+                share.bucket.set_rate(self.key_rate)
+            return
+
+        # Max-min fair water-filling over the global cap
+        remaining = self.global_rate
+        ordered = sorted(demands, key=demands.get)
+        for index, key in enumerate(ordered):
+            fair = remaining / (len(ordered) - index)
+            rate = min(fair, demands[key], key_cap)
+            self.shares[key].bucket.set_rate(rate)
+            remaining -= rate
+
+    def allocation(self) -> dict:
+        return {
+            "global_limit": self.global_rate,
+            "per_key_limit": self.key_rate,
+            "keys": {
+                key: {
+                    "streams": share.refs,
+                    "allocated": share.bucket.rate,
+                    "measured": round(share.measured),
+                    "bytes": share.bytes_total,
+                }
+                for key, share in self.shares.items()
+            },
+        }
+
+
+downstream = BandwidthScheduler("downstream", _mbit(PROXY_MAX_RATE_MBIT), _mbit(PROXY_CLIENT_RATE_MBIT))
+upstream = BandwidthScheduler("upstream", _mbit(PROXY_UPSTREAM_RATE_MBIT))
+
+
+async def _fetch_segment(url: str, headers: dict, start: int, end: int) -> bytes:
+    headers = dict(headers)
+    headers["Range"] = f"bytes={start}-{end}"
+    last_error = None
+    for attempt in range(SEGMENT_ATTEMPTS):
+        try:
+            response = await get_client().get(url, headers=headers)
+            if response.status_code != 206:
+                raise RuntimeError(f"Segment request returned {response.status_code}")
+            data = response.content
+            if len(data) != end - start + 1:
+                raise RuntimeError(f"Short segment: got {len(data)} of {end - start + 1} bytes")
+            return data
+        except Exception as e:
+            last_error = e
+            await asyncio.sleep(0.2 * (attempt + 1))
+    raise last_error
+
+
+async def fetch_segments(url: str, headers: dict, start: int, end: int,
+                         connections: int, segment_size: int = PROXY_SEGMENT_BYTES):
+    """
+    Yield bytes [start, end] in order, fetched as parallel ranged segments.
+
+    At most `connections` segments are in flight or waiting to be delivered,
+    which bounds memory to connections * segment_size.
+    """
+    segments = [(offset, min(offset + segment_size - 1, end)) for offset in range(start, end + 1, segment_size)]
+    pending: Dict[int, asyncio.Task] = {}
+    scheduled = 0
+    try:
+        for index in range(len(segments)):
+            while scheduled < len(segments) and scheduled < index + connections:
+                pending[scheduled] = asyncio.create_task(_fetch_segment(url, headers, *segments[scheduled]))
+                scheduled += 1
+            yield await pending.pop(index)
+    finally:
+        for task in pending.values():
+            task.cancel()
+
+
+class _FellBehind(Exception):
+    """Raised when a consumer's position has been evicted from the buffer."""
+
+
+class StreamTee:
+    """One upstream reader feeding a ring buffer shared by many consumers."""
+
+    def __init__(self, url: str, headers: dict, start: int, connections: int = 1):
+        self.url = url
+        self.connections = max(connections, 1)
+        self.key = f"{url}@{start}"  # bandwidth accounting key
+        self.headers = headers
+        self.start = start
+        self.base = start  # absolute offset of the first buffered byte
+        self.end = start  # absolute offset just past the last buffered byte
+        self.chunks = deque()
+        self.buffered = 0
+        self.capacity = max(TEE_BUFFER_BYTES, CHUNK_SIZE * 2)
+        self.max_window = max(min(READAHEAD_BYTES, self.capacity - CHUNK_SIZE), CHUNK_SIZE)
+        self.window = min(READAHEAD_MIN_BYTES, self.max_window)
+        self._ramp_mark = start + self.window
+        self.superseded = False
+        self.consumers: Dict[int, int] = {}  # consumer id -> absolute cursor
+        self.status_code: Optional[int] = None
+        self.response_headers = {}
+        self.final_url = url  # after redirects
+        self.total: Optional[int] = None
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.ready = asyncio.Event()
+        self.cond = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+        self._ids = itertools.count()
+        self._reap_handle = None
+
+    def begin(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        upstream.register(self.key)
+        headers = dict(self.headers)
+        if self.connections > 1:
+            # The first segment doubles as a probe for the total size
+            headers["Range"] = f"bytes={self.start}-{self.start + PROXY_SEGMENT_BYTES - 1}"
+        elif self.start:
+            headers["Range"] = f"bytes={self.start}-"
+        try:
+            async with get_client().stream("GET", self.url, headers=headers) as response:
+                self.status_code = response.status_code
+                self.response_headers = response.headers
+                self.final_url = str(response.url)
+                if response.status_code == 200:
+                    # Upstream ignored the range, offsets now start at zero
+                    self.start = self.base = self.end = 0
+                self.total = _total_size(response.status_code, response.headers, self.start)
+                self.ready.set()
+                if response.status_code not in (200, 206):
+                    return
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    await self._push(chunk)
+            if self.connections > 1 and self.status_code == 206 and self.total is not None and self.end < self.total:
+                async for segment in fetch_segments(self.url, self.headers, self.end, self.total - 1, self.connections):
+                    for offset in range(0, len(segment), CHUNK_SIZE):
+                        await self._push(segment[offset:offset + CHUNK_SIZE])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[PROXY] Upstream reader failed for {self.url}: {e}")
+            self.error = e
+        finally:
+            upstream.release(self.key)
+            self.ready.set()
+            async with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def _lead(self) -> Optional[int]:
+        return max(self.consumers.values()) if self.consumers else None
+
+    def _evict(self, incoming: int):
+        # Only drop data the leading consumer is already past
+        lead = self._lead()
+        while self.chunks and self.buffered + incoming > self.capacity:
+            oldest = len(self.chunks[0])
+            if lead is None or lead < self.base + oldest:
+                break
+            self.chunks.popleft()
+            self.buffered -= oldest
+            self.base += oldest
+
+    def _ahead(self) -> int:
+        lead = self._lead()
+        return self.end - (lead if lead is not None else self.base)
+
+    async def _push(self, chunk: bytes):
+        await upstream.throttle(self.key, len(chunk))
+        async with self.cond:
+            while True:
+                self._evict(len(chunk))
+                if self.buffered + len(chunk) <= self.capacity and self._ahead() < self.window:
+                    break
+                await self.cond.wait()
+            self.chunks.append(chunk)
+            self.buffered += len(chunk)
+            self.end += len(chunk)
+            self.cond.notify_all()
+
+    def attach(self, position: int) -> int:
+        if self._reap_handle:
+            self._reap_handle.cancel()
+            self._reap_handle = None
+        consumer_id = next(self._ids)
+        self.consumers[consumer_id] = position
+        # The producer may be parked on a full window; a new lead lets it go on
+        asyncio.create_task(self._notify())
+        return consumer_id
+
+    def detach(self, consumer_id: int):
+        self.consumers.pop(consumer_id, None)
+        if not self.consumers:
+            if self.superseded:
+                registry.reap(self)
+            else:
+                self.schedule_reap()
+        else:
+            # The lead may have changed, the producer might be able to evict now
+            asyncio.create_task(self._notify())
+
+    def schedule_reap(self):
+        loop = asyncio.get_running_loop()
+        self._reap_handle = loop.call_later(TEE_IDLE_SECONDS, registry.reap, self)
+
+    async def _notify(self):
+        async with self.cond:
+            self.cond.notify_all()
+
+    def _ramp(self, position: int):
+        # Sequential reads past the current window earn a larger one
+        if position >= self._ramp_mark and position == self._lead():
+            self.window = min(self.window * 2, self.max_window)
+            self._ramp_mark = position + self.window
+
+    def can_join(self, position: int) -> bool:
+        if self.error or (self.status_code is not None and self.status_code not in (200, 206)):
+            return False
+        if self.done and position >= self.end:
+            return False
+        if position > self.end and (self.task is None or self.task.done()):
+            # Nothing will ever fill the gap up to the position
+            return False
+        return self.base <= position <= self.end + TEE_JOIN_SLACK
+
+    async def read(self, consumer_id: int) -> bytes:
+        """Next chunk for a consumer, b'' at end of stream."""
+        async with self.cond:
+            while True:
+                cursor = self.consumers[consumer_id]
+                if cursor < self.base:
+                    raise _FellBehind()
+                if cursor < self.end:
+                    offset = self.base
+                    for chunk in self.chunks:
+                        if cursor < offset + len(chunk):
+                            data = chunk[cursor - offset:]
+                            break
+                        offset += len(chunk)
+                    self.consumers[consumer_id] = cursor + len(data)
+                    self._ramp(cursor + len(data))
+                    self.cond.notify_all()
+                    return data
+                if self.done:
+                    if self.error:
+                        raise _FellBehind()
+                    return b""
+                await self.cond.wait()
+
+
+class TeeRegistry:
+    """Tracks live shared readers, keyed by URL."""
+
+    def __init__(self):
+        self.tees: Dict[str, List[StreamTee]] = {}
+        # (client, url) -> reader the client used last, to detect seeks
+        self.last_used: Dict[Tuple[str, str], StreamTee] = {}
+
+    def open(self, url: str, headers: dict, position: int, client_key: Optional[str] = None,
+             connections: int = 1) -> StreamTee:
+        tee = None
+        for candidate in self.tees.get(url, []):
+            if candidate.can_join(position):
+                tee = candidate
+                break
+        if tee is None:
+            tee = StreamTee(url, headers, position, connections)
+            self.tees.setdefault(url, []).append(tee)
+            tee.begin()
+            tee.schedule_reap()
+        if client_key is not None:
+            previous = self.last_used.get((client_key, url))
+            if previous is not None and previous is not tee:
+                # The client seeked away, stop prefetching for it
+                previous.superseded = True
+                if not previous.consumers:
+                    self.reap(previous)
+            self.last_used[(client_key, url)] = tee
+        return tee
+
+    def reap(self, tee: StreamTee):
+        if tee.consumers:
+            return
+        if tee.task and not tee.task.done():
+            tee.task.cancel()
+        tees = self.tees.get(tee.url, [])
+        if tee in tees:
+            tees.remove(tee)
+        if not tees:
+            self.tees.pop(tee.url, None)
+        for key, used in list(self.last_used.items()):
+            if used is tee:
+                del self.last_used[key]
+
+    def stats(self) -> List[dict]:
+        return [
+            {
+                "url": url,
+                "start": tee.start,
+                "buffered": tee.buffered,
+                "window": [tee.base, tee.end],
+                "readahead": tee.window,
+                "connections": tee.connections,
+                "consumers": len(tee.consumers),
+                "done": tee.done,
+            }
+            for url, tees in self.tees.items()
+            for tee in tees
+        ]
+
+
+registry = TeeRegistry()
+
+
+def final_url(url: str) -> str:
+    """Where a live reader of `url` ended up after redirects."""
+    for tee in registry.tees.get(url, []):
+        if tee.ready.is_set():
+            return tee.final_url
+    return url
+
+
+async def _direct(url: str, headers: dict, start: int, end: Optional[int]):
+    """Private upstream reader for a consumer that fell out of the shared buffer."""
+    headers = dict(headers)
+    headers["Range"] = f"bytes={start}-{end if end is not None else ''}"
+    async with get_client().stream("GET", url, headers=headers) as response:
+        if response.status_code not in (200, 206):
+            raise RuntimeError(f"Upstream returned {response.status_code}")
+        # A 200 is the whole file: skip to start and stop at end ourselves
+        skip = start if response.status_code == 200 else 0
+        remaining = end - start + 1 if end is not None else None
+        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+            if skip:
+                if len(chunk) <= skip:
+                    skip -= len(chunk)
+                    continue
+                chunk = chunk[skip:]
+                skip = 0
+            if remaining is not None:
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+            if chunk:
+                yield chunk
+            if remaining == 0:
+                return
+
+
+async def iter_direct(url: str, headers: dict, start: int, end: Optional[int], client_key: Optional[str] = None):
+    """Yield bytes [start, end] for one downstream client over its own upstream connection."""
+    client_key = client_key or "anonymous"
+    downstream.register(client_key)
+    try:
+        async for data in _direct(url, headers, start, end):
+            await downstream.throttle(client_key, len(data))
+            yield data
+    finally:
+        downstream.release(client_key)
+
+
+async def iter_range(tee: StreamTee, start: int, end: Optional[int], client_key: Optional[str] = None):
+    """Yield bytes [start, end] (end inclusive) for one downstream client."""
+    client_key = client_key or "anonymous"
+    downstream.register(client_key)
+    consumer_id = tee.attach(start)
+    position = start
+    try:
+        while end is None or position <= end:
+            try:
+                data = await tee.read(consumer_id)
+            except _FellBehind:
+                tee.detach(consumer_id)
+                consumer_id = None
+                print(f"[PROXY] Client fell behind at {position}, switching to its own upstream reader")
+                async for data in _direct(tee.url, tee.headers, position, end):
+                    await downstream.throttle(client_key, len(data))
+                    yield data
+                return
+            if not data:
+                return
+            if end is not None and position + len(data) > end + 1:
+                data = data[:end + 1 - position]
+            position += len(data)
+            await downstream.throttle(client_key, len(data))
+            yield data
+    finally:
+        downstream.release(client_key)
+        if consumer_id is not None:
+            tee.detach(consumer_id)
+
+
+async def open_stream(url: str, headers: dict, range_header: Optional[str], client_key: Optional[str] = None,
+                      connections: Optional[int] = None):
+    """
+    Attach a client to a shared upstream reader.
+
+    `connections` > 1 fetches the upstream range as parallel segments,
+    defaulting to PROXY_CONNECTIONS.
+
+    Returns (status_code, response_headers, body_iterator). A non-2xx status
+    comes back with body_iterator set to None.
+    """
+    requested = parse_range(range_header)
+    start, end = requested if requested else (0, None)
+    if connections is None:
+        connections = PROXY_CONNECTIONS
+    tee = registry.open(url, headers, start, client_key, connections)
+    await tee.ready.wait()
+
+    if tee.status_code not in (200, 206):
+        status_code = tee.status_code or 502
+        headers_out = {}
+        if status_code == 416 and "content-range" in tee.response_headers:
+            headers_out["Content-Range"] = tee.response_headers["content-range"]
+        if not tee.consumers:
+            registry.reap(tee)
+        return status_code, headers_out, None
+
+    content_type = tee.response_headers.get("content-type", "video/mp4")
+    total = tee.total
+    if requested and total is not None and start >= total:
+        return 416, {"Content-Range": f"bytes */{total}"}, None
+    if total is not None and (end is None or end >= total):
+        end = total - 1
+    headers_out = {"Accept-Ranges": "bytes", "Content-Type": content_type}
+    if end is not None:
+        headers_out["Content-Length"] = str(max(end - start + 1, 0))
+    if requested:
+        status_code = 206
+        last = end if end is not None else "*"
+        headers_out["Content-Range"] = f"bytes {start}-{last}/{total if total is not None else '*'}"
+    else:
+        status_code = 200
+    if not tee.can_join(start):
+        # Upstream ignored the range and the reader restarted at zero, too far behind this client
+        return status_code, headers_out, iter_direct(url, headers, start, end, client_key)
+    return status_code, headers_out, iter_range(tee, start, end, client_key)
+
+
+def bandwidth_stats() -> dict:
+    return {
+        "downstream": downstream.allocation(),
+        "upstream": upstream.allocation(),
+        "streams": registry.stats(),
+    }
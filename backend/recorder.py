@@ -0,0 +1,193 @@
+"""
+Record and replay upstream HTTP traffic.
+
+With UPSTREAM_MODE=record every exchange made by the moviebox sessions
+and the proxy client is saved as a JSON fixture under UPSTREAM_FIXTURES.
+With UPSTREAM_MODE=replay those fixtures are served instead of touching
+the network, so the backend (and benchmarks against it) run fully
+offline. Replay can add latency and inject errors to see how the rest of
+the stack copes.
+
+Both work at the httpx transport level, so moviebox_api's Session needs
+no changes: install() swaps the transport of its client. httpx itself is
+only imported once a client is handed over, importing this module stays
+cheap.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import time
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    import httpx
+
+UPSTREAM_MODE = os.environ.get("UPSTREAM_MODE", "live").lower()
+UPSTREAM_FIXTURES = os.environ.get("UPSTREAM_FIXTURES", "upstream_fixtures")
+# Larger responses (media) pass through unrecorded so streaming keeps working
+RECORD_MAX_BYTES = int(float(os.environ.get("RECORD_MAX_MB", "5")) * 1024 * 1024)
+# Added delay per replayed response; "recorded" reproduces the original timing
+REPLAY_LATENCY_MS = os.environ.get("REPLAY_LATENCY_MS", "0")
+REPLAY_JITTER_MS = float(os.environ.get("REPLAY_JITTER_MS", "0"))
+# Fraction of replayed requests that fail, with REPLAY_ERROR_STATUS or (0) a connection error
+REPLAY_ERROR_RATE = float(os.environ.get("REPLAY_ERROR_RATE", "0"))
+REPLAY_ERROR_STATUS = int(os.environ.get("REPLAY_ERROR_STATUS", "503"))
+
+# The stored body is already decoded, these no longer describe it
+_DROPPED_HEADERS = {"content-encoding", "transfer-encoding", "content-length", "connection"}
+
+
+def fixture_key(request: "httpx.Request") -> str:
+    url = request.url.copy_with(params=sorted(request.url.params.multi_items()))
+    parts = [request.method, str(url), request.headers.get("range", ""), request.content.decode("latin-1")]
+    return hashlib.sha1("\n".join(parts).encode()).hexdigest()
+
+
+def fixture_path(directory: str, request: "httpx.Request") -> str:
+    return os.path.join(directory, request.url.host or "local", fixture_key(request) + ".json")
+
+
+def _kept_headers(headers: "httpx.Headers") -> list:
+    return [[k, v] for k, v in headers.multi_items() if k.lower() not in _DROPPED_HEADERS]
+
+
+class _Transport:
+    """What httpx expects of an AsyncBaseTransport, without subclassing it."""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        pass
+
+
+class RecordingTransport(_Transport):
+    """Passes requests through and saves each exchange as a fixture."""
+
+    def __init__(self, inner: "httpx.AsyncBaseTransport", directory: str = UPSTREAM_FIXTURES,
+                 max_bytes: int = RECORD_MAX_BYTES):
+        self.inner = inner
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    async def handle_async_request(self, request: "httpx.Request") -> "httpx.Response":
+        import httpx
+
+        started = time.monotonic()
+        response = await self.inner.handle_async_request(request)
+        length = response.headers.get("content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_bytes:
+            return response
+        content_type = response.headers.get("content-type", "")
+        if length is None and content_type.startswith(("video/", "audio/")):
+            return response
+
+        # Wrap it so the body gets decoded, like the client would
+        wrapped = httpx.Response(response.status_code, headers=response.headers,
+                                 stream=response.stream, request=request)
+        body = await wrapped.aread()
+        elapsed_ms = round((time.monotonic() - started) * 1000)
+        self._save(request, response.status_code, wrapped.headers, body, elapsed_ms)
+        return httpx.Response(response.status_code, headers=_kept_headers(wrapped.headers),
+                              content=body, request=request)
+
+    def _save(self, request: "httpx.Request", status: int, headers: "httpx.Headers", body: bytes, elapsed_ms: int):
+        try:
+            text, encoding = body.decode("utf-8"), "utf-8"
+        except UnicodeDecodeError:
+            text, encoding = base64.b64encode(body).decode("ascii"), "base64"
+        fixture = {
+            "request": {"method": request.method, "url": str(request.url),
+                        "range": request.headers.get("range")},
+            "response": {"status": status, "headers": _kept_headers(headers),
+                         "body": text, "encoding": encoding},
+            "elapsed_ms": elapsed_ms,
+        }
+        path = fixture_path(self.directory, request)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(fixture, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+
+class ReplayTransport(_Transport):
+    """Serves recorded fixtures, with optional latency and error injection."""
+
+    def __init__(self, directory: str = UPSTREAM_FIXTURES, latency_ms: str = REPLAY_LATENCY_MS,
+                 jitter_ms: float = REPLAY_JITTER_MS, error_rate: float = REPLAY_ERROR_RATE,
+                 error_status: int = REPLAY_ERROR_STATUS):
+        self.directory = directory
+        self.recorded_latency = str(latency_ms).lower() == "recorded"
+        self.latency_ms = 0.0 if self.recorded_latency else float(latency_ms)
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, request: "httpx.Request") -> Optional[dict]:
+        try:
+            with open(fixture_path(self.directory, request), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    async def handle_async_request(self, request: "httpx.Request") -> "httpx.Response":
+        import httpx
+
+        fixture = self._load(request)
+        delay_ms = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if self.recorded_latency and fixture is not None:
+            delay_ms += fixture.get("elapsed_ms", 0)
+        if delay_ms > 0:
+            await asyncio.sleep(delay_ms / 1000)
+
+        if self.error_rate and random.random() < self.error_rate:
+            if not self.error_status:
+                raise httpx.ConnectError("Injected connection error", request=request)
+            return httpx.Response(self.error_status, json={"error": "injected"}, request=request)
+
+        if fixture is None:
+            self.misses += 1
+            print(f"[REPLAY] No fixture for {request.method} {request.url}")
+            return httpx.Response(404, json={"error": "no fixture recorded"}, request=request)
+
+        self.hits += 1
+        recorded = fixture["response"]
+        body = recorded["body"]
+        content = base64.b64decode(body) if recorded.get("encoding") == "base64" else body.encode("utf-8")
+        return httpx.Response(recorded["status"], headers=recorded["headers"], content=content, request=request)
+
+
+def install_client(client: "httpx.AsyncClient", mode: str = UPSTREAM_MODE) -> "httpx.AsyncClient":
+    """Point an httpx client at the recorder or the fixtures, depending on the mode."""
+    # httpx has no public way to swap the transport of an existing client
+    if mode == "record":
+        client._transport = RecordingTransport(client._transport)
+        client._mounts = {pattern: RecordingTransport(transport) if transport is not None else None
+                          for pattern, transport in client._mounts.items()}
+    elif mode == "replay":
+        client._transport = ReplayTransport()
+        client._mounts = {}
+    return client
+
+
+def install(session, mode: str = UPSTREAM_MODE):
+    """Record or replay the traffic of a moviebox_api Session."""
+    if mode == "live":
+        return session
+    import httpx
+
+    client = getattr(session, "_client", None)
+    if isinstance(client, httpx.AsyncClient):
+        install_client(client, mode)
+    return session
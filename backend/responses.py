@@ -0,0 +1,38 @@
+"""
+Fast JSON responses for routes that build their payload themselves.
+
+Returning a FastJSONResponse skips FastAPI's response validation and
+jsonable_encoder pass; the dict is encoded once, with orjson when it is
+installed and the standard library otherwise. Values orjson does not know
+(pydantic models from moviebox_api, for instance) are converted on the
+fly.
+"""
+import json
+from typing import Any
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value: Any) -> Any:
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json")
+    from fastapi.encoders import jsonable_encoder
+    return jsonable_encoder(value)
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,188 @@
+"""
+Pool of moviebox_api sessions.
+
+Each session has its own client, cookie jar and connection pool. Calls go
+to the session with the fewest requests in flight. A session that keeps
+failing with 403s or timeouts is retired and a fresh one takes its place;
+requests already running on it are left to finish.
+
+warm() runs a cheap request on every session, at startup so the first
+user request does not pay for cookies, DNS and TLS, and periodically on
+idle sessions so their connections and cookies stay fresh.
+
+If the pool is given a limiter, every call also holds one of its slots,
+which keeps the total number of concurrent upstream calls in check.
+"""
+import asyncio
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+SESSION_POOL_SIZE = int(os.environ.get("SESSION_POOL_SIZE", "2"))
+# Consecutive failures after which a session is replaced
+SESSION_MAX_FAILURES = int(os.environ.get("SESSION_MAX_FAILURES", "3"))
+# Statuses that mean the session itself is no longer welcome
+RETIRE_STATUSES = (401, 403)
+# Startup waits at most this long for the warmup before serving anyway
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT", "20"))
+# Sessions idle for this long get a keepalive request
+SESSION_KEEPALIVE_SECONDS = float(os.environ.get("SESSION_KEEPALIVE_SECONDS", "240"))
+
+
+def status_of(exc: BaseException) -> Optional[int]:
+    """HTTP status carried by an exception, if any."""
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None) or getattr(exc, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_session_failure(exc: BaseException) -> bool:
+    import httpx
+
+    return isinstance(exc, httpx.TimeoutException) or status_of(exc) in RETIRE_STATUSES
+
+
+class PooledSession:
+    def __init__(self, session: Any, number: int):
+        self.session = session
+        self.number = number
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.retired = False
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+    def stats(self) -> dict:
+        return {
+            "session": self.number,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "retired": self.retired,
+            "age": round(time.monotonic() - self.created),
+            "idle": round(time.monotonic() - self.last_used),
+        }
+
+
+class SessionPool:
+    def __init__(self, factory: Callable[[], Any], size: int = SESSION_POOL_SIZE,
+                 max_failures: int = SESSION_MAX_FAILURES, limiter: Any = None):
+        self.factory = factory
+        self.limiter = limiter
+        self.max_failures = max_failures
+        self.size = max(size, 1)
+        self._numbers = itertools.count(1)
+        self._turn = itertools.count()
+        self._members: Optional[List[PooledSession]] = None
+        # Retired sessions still finishing requests, and every session by identity
+        self.draining: List[PooledSession] = []
+        self._by_id: Dict[int, PooledSession] = {}
+        self.retired_count = 0
+
+    @property
+    def members(self) -> List[PooledSession]:
+        # Sessions are created on first use, not when the module is imported
+        if self._members is None:
+            self._members = [self._new() for _ in range(self.size)]
+            self._by_id.update((id(m.session), m) for m in self._members)
+        return self._members
+
+    def _new(self) -> PooledSession:
+        return PooledSession(self.factory(), next(self._numbers))
+
+    def pick(self) -> Any:
+        """The least loaded session, ties broken round-robin."""
+        return self._pick().session
+
+    def _pick(self) -> PooledSession:
+        start = next(self._turn) % len(self.members)
+        ordered = self.members[start:] + self.members[:start]
+        return min(ordered, key=lambda m: m.in_flight)
+
+    def _retire(self, member: PooledSession):
+        if member.retired:
+            return
+        member.retired = True
+        self.retired_count += 1
+        replacement = self._new()
+        self.members[self.members.index(member)] = replacement
+        self._by_id[id(replacement.session)] = replacement
+        print(f"[SESSION] Retiring session {member.number} after {member.failures} failures, "
+              f"replaced by session {replacement.number}")
+        if member.in_flight:
+            self.draining.append(member)
+        else:
+            self._by_id.pop(id(member.session), None)
+
+    @asynccontextmanager
+    async def use(self, session: Any = None):
+        """
+        Run upstream calls on a session and record how they went. Pass the
+        session an object was created with (e.g. a cached Search) to keep
+        using it; otherwise the least loaded one is chosen.
+        """
+        if self.limiter is None:
+            async with self._use(session) as chosen:
+                yield chosen
+        else:
+            async with self.limiter.slot():
+                async with self._use(session) as chosen:
+                    yield chosen
+
+    @asynccontextmanager
+    async def _use(self, session: Any = None):
+        member = self._by_id.get(id(session)) if session is not None else self._pick()
+        if member is None:
+            # Not one of ours (or long retired), just hand it back
+            yield session
+            return
+        member.in_flight += 1
+        member.requests += 1
+        member.last_used = time.monotonic()
+        try:
+            yield member.session
+        except Exception as e:
+            if is_session_failure(e):
+                member.failures += 1
+                if member.failures >= self.max_failures:
+                    self._retire(member)
+            raise
+        else:
+            member.failures = 0
+        finally:
+            member.in_flight -= 1
+            if member.retired and not member.in_flight and member in self.draining:
+                self.draining.remove(member)
+                self._by_id.pop(id(member.session), None)
+
+    async def warm(self, probe: Callable[[Any], Awaitable[Any]], idle_for: float = 0) -> Tuple[int, int]:
+        """
+        Run probe(session) on every session idle for at least `idle_for`
+        seconds. Returns how many probes succeeded and how many were run.
+        """
+        members = self.members
+        now = time.monotonic()
+        targets = [m for m in members if now - m.last_used >= idle_for and not m.in_flight]
+
+        async def run(member: PooledSession) -> bool:
+            try:
+                async with self.use(member.session) as session:
+                    await probe(session)
+                return True
+            except Exception as e:
+                print(f"[SESSION] Warming session {member.number} failed: {e}")
+                return False
+
+        results = await asyncio.gather(*(run(m) for m in targets))
+        return sum(results), len(targets)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.members),
+            "retired": self.retired_count,
+            "sessions": [m.stats() for m in self.members],
+            "draining": [m.stats() for m in self.draining],
+        }
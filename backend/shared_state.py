@@ -0,0 +1,359 @@
+"""
+State shared between uvicorn worker processes.
+
+With `--workers N` every worker has its own memory, so a search result
+cached by one worker is unknown to the next, and an event broadcast by one
+worker only reaches its own WebSocket clients. A SharedState backend holds
+serialized search items and fans events out to every worker:
+
+- "memory" (default): single process, nothing is shared.
+- "sqlite" or "sqlite:///path/to/state.db": a database file next to the
+  workers. Events are rows that every worker polls for.
+- "redis://[:password@]host[:port][/db]": any server speaking the Redis
+  protocol. Items are keys with a TTL, events use PUBLISH/SUBSCRIBE.
+
+Published events get a sequence number from the backend, and every
+worker, the publishing one included, delivers them from the backend's
+feed in that order. Replay and Last-Event-ID resume therefore work no
+matter which worker a client reconnects to.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+SHARED_STATE = os.environ.get("SHARED_STATE", "memory")
+# Search items stay resolvable by other workers for this long
+SHARED_ITEM_TTL = int(os.environ.get("SHARED_ITEM_TTL", str(24 * 3600)))
+SHARED_STATE_POLL_MS = float(os.environ.get("SHARED_STATE_POLL_MS", "100"))
+SHARED_STATE_PREFIX = os.environ.get("SHARED_STATE_PREFIX", "moviebox")
+# Event rows older than this are pruned from the SQLite backend
+EVENT_RETENTION_SECONDS = 300
+
+EventHandler = Callable[[dict], None]
+
+
+class MemoryState:
+    """Nothing to share: one process holds everything."""
+
+    shared = False
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+
+    async def start(self, on_event: EventHandler):
+        pass
+
+    async def close(self):
+        pass
+
+    async def put_items(self, records: Dict[str, dict]):
+        pass
+
+    async def get_item(self, item_id: str) -> Optional[dict]:
+        return None
+
+    async def publish(self, message: dict) -> dict:
+        # The local event log numbers it
+        return message
+
+
+class SQLiteState(MemoryState):
+    """
+    Every database call runs in a thread, one at a time on the shared
+    connection, so a busy database never blocks the event loop. Events
+    published while a write is in progress are committed together.
+    """
+
+    shared = True
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # All workers create the schema at once, one at a time under the write lock
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.execute("CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY, record TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS events (seq INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, "
+            "message TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.listener: Optional[asyncio.Task] = None
+        # (encoded message, created_at, future for its seq) waiting to be written
+        self.pending: List[Tuple[str, float, asyncio.Future]] = []
+        self.writer: Optional[asyncio.Task] = None
+
+    async def _run(self, function: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, self._locked, function, *args)
+
+    def _locked(self, function: Callable, *args):
+        with self.lock:
+            return function(*args)
+
+    def _query(self, sql: str, *params) -> list:
+        return self.db.execute(sql, params).fetchall()
+
+    async def start(self, on_event: EventHandler):
+        [(last_seq,)] = await self._run(self._query, "SELECT MAX(seq) FROM events")
+        self.listener = asyncio.create_task(self._poll(last_seq or 0, on_event))
+
+    async def close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            await asyncio.gather(self.listener, return_exceptions=True)
+        if self.writer is not None:
+            await asyncio.gather(self.writer, return_exceptions=True)
+        await self._run(self.db.close)
+
+    async def _poll(self, last_seq: int, on_event: EventHandler):
+        last_prune = time.monotonic()
+        while True:
+            await asyncio.sleep(SHARED_STATE_POLL_MS / 1000)
+            try:
+                rows = await self._run(
+                    self._query, "SELECT seq, origin, message FROM events WHERE seq > ? ORDER BY seq", last_seq)
+                # Writers are serialized, so rows become visible in seq order
+                for seq, _, message in rows:
+                    last_seq = seq
+                    on_event({**json.loads(message), "seq": seq})
+                if time.monotonic() - last_prune > 60:
+                    last_prune = time.monotonic()
+                    await self._run(self._prune, time.time())
+            except sqlite3.Error as e:
+                print(f"[STATE] Polling events failed: {e}")
+
+    def _prune(self, now: float):
+        self.db.execute("DELETE FROM events WHERE created_at < ?", (now - EVENT_RETENTION_SECONDS,))
+        self.db.execute("DELETE FROM items WHERE expires_at < ?", (now,))
+        self.db.commit()
+
+    def _put_items(self, rows: List[tuple]):
+        self.db.executemany("INSERT OR REPLACE INTO items (id, record, expires_at) VALUES (?, ?, ?)", rows)
+        self.db.commit()
+
+    async def put_items(self, records: Dict[str, dict]):
+        expires_at = time.time() + SHARED_ITEM_TTL
+        await self._run(self._put_items, [(item_id, json.dumps(record), expires_at) for item_id, record in records.items()])
+
+    async def get_item(self, item_id: str) -> Optional[dict]:
+        rows = await self._run(
+            self._query, "SELECT record FROM items WHERE id = ? AND expires_at >= ?", item_id, time.time())
+        return json.loads(rows[0][0]) if rows else None
+
+    def _insert_events(self, batch: List[Tuple[str, float]]) -> List[int]:
+        # The row id is the seq, added back when the event is read
+        try:
+            seqs = [
+                self.db.execute(
+                    "INSERT INTO events (origin, message, created_at) VALUES (?, ?, ?)", (self.origin, message, created_at)
+                ).lastrowid
+                for message, created_at in batch
+            ]
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+        return seqs
+
+    async def _write_events(self):
+        while self.pending:
+            batch, self.pending = self.pending, []
+            try:
+                seqs = await self._run(self._insert_events, [(message, created_at) for message, created_at, _ in batch])
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, _, future), seq in zip(batch, seqs):
+                if not future.done():
+                    future.set_result(seq)
+
+    async def publish(self, message: dict) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((json.dumps(message), time.time(), future))
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.create_task(self._write_events())
+        return {**message, "seq": await future}
+
+
+class RedisError(Exception):
+    pass
+
+
+def encode_command(*args) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Connection closed by server")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        raise RedisError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        count = int(rest)
+        if count < 0:
+            return None
+        return [await read_reply(reader) for _ in range(count)]
+    raise RedisError(f"Unexpected reply {line!r}")
+
+
+class RedisConnection:
+    """One connection speaking the Redis protocol (RESP2)."""
+
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.database = int(parsed.path.lstrip("/") or 0)
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            auth = ("AUTH", self.username, self.password) if self.username else ("AUTH", self.password)
+            await self._call(*auth)
+        if self.database:
+            await self._call("SELECT", self.database)
+
+    async def _call(self, *args):
+        self.writer.write(encode_command(*args))
+        await self.writer.drain()
+        return await read_reply(self.reader)
+
+    async def call(self, *args):
+        return (await self.pipeline([args]))[0]
+
+    async def pipeline(self, commands: List[tuple]) -> list:
+        """Send several commands in one write and read their replies in order."""
+        async with self.lock:
+            if self.writer is None or self.writer.is_closing():
+                await self.connect()
+            try:
+                self.writer.write(b"".join(encode_command(*args) for args in commands))
+                await self.writer.drain()
+                return [await read_reply(self.reader) for _ in commands]
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                raise
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+# Numbering and publishing in one script keeps the channel in seq order
+_PUBLISH_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+redis.call('PUBLISH', KEYS[2], seq .. ' ' .. ARGV[1])
+return seq
+"""
+
+
+class RedisState(MemoryState):
+    shared = True
+
+    def __init__(self, url: str, prefix: str = SHARED_STATE_PREFIX):
+        super().__init__()
+        self.url = url
+        self.prefix = prefix
+        self.channel = f"{prefix}:events"
+        self.connection = RedisConnection(url)
+        self.listener: Optional[asyncio.Task] = None
+        self.subscribed = asyncio.Event()
+
+    async def start(self, on_event: EventHandler):
+        await self.connection.call("PING")
+        self.listener = asyncio.create_task(self._listen(on_event))
+        try:
+            # Events published before the subscription is up would not come back to us
+            await asyncio.wait_for(self.subscribed.wait(), 5)
+        except asyncio.TimeoutError:
+            print("[STATE] Event subscription not ready yet, continuing")
+
+    async def close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            await asyncio.gather(self.listener, return_exceptions=True)
+        self.connection.close()
+
+    async def _listen(self, on_event: EventHandler):
+        delay = 0.5
+        while True:
+            subscriber = RedisConnection(self.url)
+            try:
+                await subscriber.connect()
+                await subscriber._call("SUBSCRIBE", self.channel)
+                self.subscribed.set()
+                delay = 0.5
+                while True:
+                    reply = await read_reply(subscriber.reader)
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                        seq, _, message = reply[2].partition(b" ")
+                        on_event({**json.loads(message), "seq": int(seq)})
+            except asyncio.CancelledError:
+                subscriber.close()
+                raise
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, RedisError) as e:
+                self.subscribed.clear()
+                print(f"[STATE] Event subscription lost ({e}), reconnecting in {delay:.1f}s")
+            finally:
+                subscriber.close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10)
+
+    def _item_key(self, item_id: str) -> str:
+        return f"{self.prefix}:item:{item_id}"
+
+    async def put_items(self, records: Dict[str, dict]):
+        if records:
+            await self.connection.pipeline([
+                ("SET", self._item_key(item_id), json.dumps(record), "EX", SHARED_ITEM_TTL)
+                for item_id, record in records.items()
+            ])
+
+    async def get_item(self, item_id: str) -> Optional[dict]:
+        data = await self.connection.call("GET", self._item_key(item_id))
+        return json.loads(data) if data is not None else None
+
+    async def publish(self, message: dict) -> dict:
+        seq = await self.connection.call(
+            "EVAL", _PUBLISH_SCRIPT, 2, f"{self.prefix}:event_seq", self.channel, json.dumps(message))
+        return {**message, "seq": seq}
+
+
+def create(url: str = SHARED_STATE) -> MemoryState:
+    if url.startswith("redis://"):
+        return RedisState(url)
+    if url == "sqlite" or url.startswith("sqlite:"):
+        path = url[len("sqlite:///"):] if url.startswith("sqlite:///") else "shared_state.db"
+        return SQLiteState(path)
+    return MemoryState()
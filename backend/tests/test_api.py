@@ -0,0 +1,119 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import api
+import downloads
+import events
+import proxy
+
+
+@pytest.fixture
+def jobs(monkeypatch, tmp_path):
+    monkeypatch.setattr(api, "manager", events.ConnectionManager())
+    monkeypatch.setattr(api, "download_queue", downloads.DownloadQueue(None, db_path=str(tmp_path / "jobs.db")))
+    monkeypatch.setattr(api, "upstream_headers", lambda: {})
+    return api.download_queue
+
+
+async def drain(stream):
+    messages = []
+    while True:
+        message = await stream.next(timeout=0.05)
+        if message is None:
+            return messages
+        messages.append(message)
+
+
+async def enqueue_episode(queue, parent, episode, tmp_path):
+    path = str(tmp_path / f"S01E{episode:02d}.mp4")
+    return await queue.enqueue({"season": 1, "episode": episode}, parent_id=parent["id"], title="Show",
+                               url=f"https://cdn.example/{episode}.mp4", path=path)
+
+
+def test_season_topic_carries_every_episode_event(jobs, monkeypatch, tmp_path):
+    async def fetch_segmented(queue, job_id, url, headers, path, connections, progress_hook):
+        if url.endswith("/2.mp4"):
+            raise RuntimeError("disk full")
+        return path
+
+    monkeypatch.setattr(downloads, "fetch_segmented", fetch_segmented)
+
+    async def scenario():
+        parent = await jobs.enqueue({"kind": "season", "season": 1})
+        stream = api.manager.open_stream([f"job:{parent['id']}"])
+        first = await enqueue_episode(jobs, parent, 1, tmp_path)
+        second = await enqueue_episode(jobs, parent, 2, tmp_path)
+        await api.download_task(job_id=first["id"])
+        with pytest.raises(RuntimeError):
+            await api.download_task(job_id=second["id"])
+
+        # Progress ticks come from ProgressReporter, which always tagged them
+        received = [(m["job_id"], m["status"]) for m in await drain(stream) if m["status"] != "downloading"]
+        assert received == [(first["id"], "started"), (first["id"], "completed"),
+                            (second["id"], "started"), (second["id"], "error")]
+        api.manager.close_stream(stream)
+
+        # A late subscriber to the season still learns how each episode ended
+        late = api.manager.open_stream([f"job:{parent['id']}"])
+        caught_up = {m["job_id"]: m["status"] for m in await drain(late)}
+        assert caught_up == {first["id"]: "completed", second["id"]: "error"}
+        api.manager.close_stream(late)
+
+    asyncio.run(scenario())
+
+
+def test_proxy_stream_tells_viewers_apart_by_client_id(monkeypatch):
+    payload = bytes(range(256)) * 16
+
+    def upstream(request: httpx.Request) -> httpx.Response:
+        start, end = proxy.parse_range(request.headers.get("range", "bytes=0-"))
+        end = len(payload) - 1 if end is None else end
+        return httpx.Response(206, content=payload[start:end + 1], headers={
+            "content-type": "video/mp4", "content-range": f"bytes {start}-{end}/{len(payload)}",
+        })
+
+    monkeypatch.setattr(proxy, "_client", httpx.AsyncClient(transport=httpx.MockTransport(upstream)))
+    monkeypatch.setattr(proxy, "registry", proxy.TeeRegistry())
+    monkeypatch.setattr(api, "upstream_headers", lambda: {})
+    app = FastAPI()
+    app.include_router(api.router, prefix="/api")
+    url = "https://cdn.example/movie.mp4"
+
+    # Both come through the same reverse proxy, so they share an address
+    with TestClient(app) as http:
+        for client in ("alice", "bob"):
+            response = http.get("/api/proxy-stream", params={"url": url, "client": client},
+                                headers={"range": "bytes=0-99"})
+            assert response.status_code == 206
+            assert response.content == payload[:100]
+        assert {key for key, _ in proxy.registry.last_used} == {"alice", "bob"}
+
+
+def test_resumed_download_survives_a_connection_drop(jobs, monkeypatch, tmp_path):
+    calls = []
+
+    async def fetch_segmented(queue, job_id, url, headers, path, connections, progress_hook):
+        calls.append(url)
+        if len(calls) == 1:
+            raise httpx.ConnectError("connection reset")
+        return path
+
+    monkeypatch.setattr(downloads, "fetch_segmented", fetch_segmented)
+    monkeypatch.setattr(api, "TRANSFER_RETRY_DELAY", 0)
+
+    async def scenario():
+        # A checkpoint left by a previous run: the job resumes without resolving again
+        job = await jobs.enqueue({}, title="Movie", url="https://cdn.example/movie.mp4",
+                                 path=str(tmp_path / "Movie.mp4"))
+        stream = api.manager.open_stream([f"job:{job['id']}"])
+        await api.download_task(job_id=job["id"])
+        assert calls == ["https://cdn.example/movie.mp4"] * 2
+        statuses = [m["status"] for m in await drain(stream)]
+        assert statuses[0] == "started" and statuses[-1] == "completed"
+        api.manager.close_stream(stream)
+
+    asyncio.run(scenario())
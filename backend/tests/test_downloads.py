@@ -0,0 +1,316 @@
+import asyncio
+import json
+import multiprocessing
+import sqlite3
+
+import httpx
+import pytest
+
+import downloads
+import proxy
+import shared_state
+
+
+def _open(kind: str, path: str, barrier):
+    barrier.wait()
+    if kind == "downloads":
+        downloads.DownloadQueue(None, db_path=path)
+    else:
+        shared_state.SQLiteState(path)
+
+
+def open_concurrently(kind: str, path: str, processes: int = 6):
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(processes)
+    workers = [context.Process(target=_open, args=(kind, path, barrier)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(30)
+    return [worker.exitcode for worker in workers]
+
+
+def test_workers_migrate_a_fresh_database_at_the_same_time(tmp_path):
+    for attempt in range(3):
+        path = str(tmp_path / f"downloads-{attempt}.db")
+        assert open_concurrently("downloads", path) == [0] * 6
+        columns = {row[1] for row in sqlite3.connect(path).execute("PRAGMA table_info(jobs)")}
+        assert set(downloads._ADDED_COLUMNS) <= columns
+
+
+def test_workers_open_a_fresh_shared_state_at_the_same_time(tmp_path):
+    for attempt in range(3):
+        assert open_concurrently("state", str(tmp_path / f"state-{attempt}.db")) == [0] * 6
+
+
+class Runner:
+    """Job runner driven by the test: each job waits until it is released."""
+
+    def __init__(self):
+        self.queue = None
+        self.started = {}
+        self.runs = []
+        self.release = {}
+
+    async def __call__(self, job):
+        name = job["params"]["name"]
+        self.started[name] = job["id"]
+        self.runs.append(name)
+        duplicate_of = job["params"].get("duplicate_of")
+        if duplicate_of:
+            await self.queue.attach(job["id"], self.started[duplicate_of])
+            return
+        outcome = await self.release.setdefault(name, asyncio.get_running_loop().create_future())
+        if outcome == "fail":
+            raise RuntimeError("transfer failed")
+        await self.queue.update(job["id"], path=f"/downloads/{name}.mp4")
+
+
+async def wait_until(condition, timeout=5):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not await condition() and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+    assert await condition()
+
+
+def state_of(queue, job_id, state):
+    async def condition():
+        return (await queue.get(job_id))["state"] == state
+    return condition
+
+
+def started(runner, name):
+    async def condition():
+        return name in runner.started
+    return condition
+
+
+@pytest.mark.parametrize("outcome, state", [("ok", downloads.COMPLETED), ("fail", downloads.FAILED)])
+def test_duplicate_job_ends_with_the_original(tmp_path, outcome, state):
+    async def scenario():
+        runner = Runner()
+        queue = runner.queue = downloads.DownloadQueue(runner, db_path=str(tmp_path / "jobs.db"), concurrency=2)
+        await queue.start()
+        original = await queue.enqueue({"name": "original"})
+        await wait_until(started(runner, "original"))
+        duplicate = await queue.enqueue({"name": "duplicate", "duplicate_of": "original"})
+        await wait_until(state_of(queue, duplicate["id"], downloads.ATTACHED))
+        await asyncio.sleep(0.05)
+        # Not done while the original is still transferring
+        job = await queue.get(duplicate["id"])
+        assert job["state"] == downloads.ATTACHED
+        assert job["attached_to"] == original["id"]
+
+        runner.release["original"].set_result(outcome)
+        await wait_until(state_of(queue, original["id"], state))
+        job = await queue.get(duplicate["id"])
+        assert job["state"] == state
+        assert job["path"] == (await queue.get(original["id"]))["path"]
+        await queue.stop()
+
+    asyncio.run(scenario())
+
+
+def test_duplicate_of_a_job_that_already_ended(tmp_path):
+    async def scenario():
+        queue = downloads.DownloadQueue(None, db_path=str(tmp_path / "jobs.db"))
+        original = await queue.enqueue({"name": "original"})
+        await queue.update(original["id"], state=downloads.COMPLETED, path="/downloads/original.mp4")
+        duplicate = await queue.enqueue({"name": "duplicate"})
+        await queue.attach(duplicate["id"], original["id"])
+        job = await queue.get(duplicate["id"])
+        assert (job["state"], job["path"]) == (downloads.COMPLETED, "/downloads/original.mp4")
+
+    asyncio.run(scenario())
+
+
+def test_second_worker_leaves_running_jobs_alone(tmp_path):
+    path = str(tmp_path / "jobs.db")
+
+    async def scenario():
+        runner_a, runner_b = Runner(), Runner()
+        a = runner_a.queue = downloads.DownloadQueue(runner_a, db_path=path, lease_seconds=0.3)
+        b = runner_b.queue = downloads.DownloadQueue(runner_b, db_path=path, lease_seconds=0.3)
+        await a.start()
+        job = await a.enqueue({"name": "movie"}, dedupe_key="subject:0:0:BEST")
+        await wait_until(started(runner_a, "movie"))
+
+        # B starts while A is transferring, and stays off the job as long as A renews its lease
+        await b.start()
+        await asyncio.sleep(1)
+        assert runner_b.runs == []
+        assert (await b.find("subject:0:0:BEST"))["job"]["id"] == job["id"]
+
+        # A dies without releasing the job: once the lease runs out B takes over
+        a.heartbeat.cancel()
+        await wait_until(started(runner_b, "movie"))
+        assert (await b.get(job["id"]))["owner"] == b.owner
+        runner_b.release["movie"].set_result("ok")
+        await wait_until(state_of(b, job["id"], downloads.COMPLETED))
+        for queue in (a, b):
+            await queue.stop()
+
+    asyncio.run(scenario())
+
+
+def test_claim_attaches_to_the_running_job(tmp_path):
+    path = str(tmp_path / "jobs.db")
+
+    async def scenario():
+        a = downloads.DownloadQueue(None, db_path=path)
+        b = downloads.DownloadQueue(None, db_path=path)
+        first = await a.enqueue({"name": "first"})
+        second = await b.enqueue({"name": "second"})
+        for queue, job in ((a, first), (b, second)):
+            assert await queue._run(queue._claim, job["id"], 0) is not None
+        # Both resolve to the same file; whichever claims second waits for the other
+        assert await a.claim(first["id"], "subject:1:2:BEST") is None
+        duplicate = await b.claim(second["id"], "subject:1:2:BEST")
+        assert duplicate["job"]["id"] == first["id"]
+        job = await b.get(second["id"])
+        assert (job["state"], job["attached_to"]) == (downloads.ATTACHED, first["id"])
+
+    asyncio.run(scenario())
+
+
+def test_listing_is_bounded(tmp_path):
+    async def scenario():
+        queue = downloads.DownloadQueue(None, db_path=str(tmp_path / "jobs.db"))
+        for n in range(30):
+            await queue.enqueue({"name": n})
+        jobs = await queue.list(limit=10)
+        assert [job["params"]["name"] for job in jobs] == list(range(29, 19, -1))
+        assert len(await queue.list(state=downloads.QUEUED, limit=5)) == 5
+
+    asyncio.run(scenario())
+
+
+PAYLOAD = bytes(range(256)) * 4096  # 1 MiB
+URL = "https://cdn.example/movie.mp4"
+
+
+class Upstream:
+    """Ranged file server that records requests and can misbehave on demand."""
+
+    def __init__(self, etag='"v1"'):
+        self.etag = etag
+        self.requests = []
+        self.fail_once = set()  # ranges that drop the connection the first time
+        self.status = None  # answer every request with this status
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        header = request.headers.get("range")
+        self.requests.append((header, request.headers.get("if-range")))
+        if self.status:
+            return httpx.Response(self.status)
+        if header in self.fail_once:
+            self.fail_once.discard(header)
+            raise httpx.ReadError("connection reset", request=request)
+        validator = request.headers.get("if-range")
+        if not header or (validator and validator != self.etag):
+            return httpx.Response(200, content=PAYLOAD, headers={"etag": self.etag})
+        start, _, end = header[len("bytes="):].partition("-")
+        start, end = int(start), int(end) if end else len(PAYLOAD) - 1
+        return httpx.Response(206, content=PAYLOAD[start:end + 1], headers={
+            "etag": self.etag, "content-range": f"bytes {start}-{end}/{len(PAYLOAD)}",
+        })
+
+    def ranges(self):
+        return [header for header, _ in self.requests]
+
+
+@pytest.fixture
+def transfer(monkeypatch):
+    server = Upstream()
+    monkeypatch.setattr(proxy, "_client", httpx.AsyncClient(transport=httpx.MockTransport(server)))
+    return server
+
+
+def run_transfer(tmp_path, connections, setup=None):
+    path = str(tmp_path / "movie.mp4")
+
+    async def scenario():
+        queue = downloads.DownloadQueue(None, db_path=str(tmp_path / "jobs.db"))
+        job = await queue.enqueue({})
+        if setup:
+            await setup(queue, job["id"], path)
+        result = await downloads.fetch_segmented(queue, job["id"], URL, {}, path, connections)
+        return result, await queue.get(job["id"])
+
+    return asyncio.run(scenario())
+
+
+def quarter_ranges():
+    size = len(PAYLOAD) // 4
+    return [[start, start + size - 1] for start in range(0, len(PAYLOAD), size)]
+
+
+def test_download_is_split_into_ranged_parts(transfer, tmp_path):
+    path, job = run_transfer(tmp_path, 4)
+    assert open(path, "rb").read() == PAYLOAD
+    assert transfer.ranges()[0] == "bytes=0-0"
+    assert sorted(transfer.ranges()[1:]) == sorted(f"bytes={a}-{b}" for a, b in quarter_ranges())
+    assert (job["bytes_written"], job["parts"]) == (len(PAYLOAD), None)
+
+
+async def half_done(queue, job_id, path):
+    # Every part got halfway before the process stopped
+    parts = [[start, end, (end - start + 1) // 2] for start, end in quarter_ranges()]
+    with open(path + ".part", "wb") as f:
+        f.write(bytes(len(PAYLOAD)))
+        for start, _, done in parts:
+            f.seek(start)
+            f.write(PAYLOAD[start:start + done])
+    await queue.update(job_id, url=URL, path=path, total_bytes=len(PAYLOAD), etag='"v1"', parts=json.dumps(parts))
+
+
+def test_resume_from_a_parts_checkpoint(transfer, tmp_path):
+    path, _ = run_transfer(tmp_path, 4, half_done)
+    assert open(path, "rb").read() == PAYLOAD
+    half = len(PAYLOAD) // 8
+    assert sorted(transfer.requests) == sorted((f"bytes={a + half}-{b}", '"v1"') for a, b in quarter_ranges())
+
+
+def test_part_is_retried_after_a_dropped_connection(transfer, tmp_path):
+    first, last = quarter_ranges()[1]
+    transfer.fail_once.add(f"bytes={first}-{last}")
+    path, _ = run_transfer(tmp_path, 4)
+    assert open(path, "rb").read() == PAYLOAD
+    assert transfer.ranges().count(f"bytes={first}-{last}") == 2
+
+
+def test_changed_file_restarts_clean(transfer, tmp_path):
+    transfer.etag = '"v2"'
+    path, _ = run_transfer(tmp_path, 4, half_done)
+    assert open(path, "rb").read() == PAYLOAD
+    # The checkpoint was dropped and the file probed and split again
+    assert "bytes=0-0" in transfer.ranges()
+    assert transfer.requests[-1][1] is None
+
+
+@pytest.mark.parametrize("status", [403, 410])
+@pytest.mark.parametrize("connections", [1, 4])
+def test_rejected_link_asks_for_a_new_one(transfer, tmp_path, status, connections):
+    transfer.status = status
+    with pytest.raises(downloads.LinkExpired):
+        run_transfer(tmp_path, connections)
+
+
+async def partly_written(queue, job_id, path):
+    with open(path + ".part", "wb") as f:
+        f.write(PAYLOAD[:1000])
+    await queue.update(job_id, url=URL, path=path, bytes_written=1000, total_bytes=len(PAYLOAD), etag='"v1"')
+
+
+def test_single_connection_resumes_with_if_range(transfer, tmp_path):
+    path, job = run_transfer(tmp_path, 1, partly_written)
+    assert open(path, "rb").read() == PAYLOAD
+    assert transfer.requests == [("bytes=1000-", '"v1"')]
+    assert job["bytes_written"] == len(PAYLOAD)
+
+
+def test_single_connection_starts_over_when_the_file_changed(transfer, tmp_path):
+    transfer.etag = '"v2"'
+    path, _ = run_transfer(tmp_path, 1, partly_written)
+    assert open(path, "rb").read() == PAYLOAD
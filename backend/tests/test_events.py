@@ -0,0 +1,253 @@
+import asyncio
+import threading
+
+import events
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def send_json(self, message):
+        self.sent.append(message)
+
+    async def close(self):
+        self.closed = True
+
+
+async def drain(manager):
+    """Let the writer tasks send everything queued."""
+    for _ in range(1000):
+        if not any(outbox.messages for outbox in manager.outboxes.values()):
+            break
+        await asyncio.sleep(0)
+    await asyncio.sleep(0.01)
+
+
+async def queue_jobs(manager, count):
+    for index in range(count):
+        await manager.broadcast({"job_id": f"job-{index}", "status": "queued"})
+
+
+def test_catch_up_longer_than_the_send_queue_is_delivered(monkeypatch):
+    async def scenario():
+        manager = events.ConnectionManager()
+        await queue_jobs(manager, events.WS_QUEUE_SIZE + 36)
+        websocket = FakeWebSocket()
+        await manager.connect(websocket)
+        # A live event right behind the catch-up does not count it against the bound
+        await manager.broadcast({"job_id": "job-0", "status": "completed"})
+        await drain(manager)
+        assert websocket in manager.active_connections
+        assert not websocket.closed
+        assert [m["job_id"] for m in websocket.sent[:-1]] == [f"job-{i}" for i in range(events.WS_QUEUE_SIZE + 36)]
+        assert all(m["replay"] for m in websocket.sent[:-1])
+        assert websocket.sent[-1]["status"] == "completed" and "replay" not in websocket.sent[-1]
+        manager.disconnect(websocket)
+
+    asyncio.run(scenario())
+
+
+def test_resume_since_keeps_every_missed_event(monkeypatch):
+    monkeypatch.setattr(events, "WS_QUEUE_SIZE", 2)
+
+    async def scenario():
+        manager = events.ConnectionManager()
+        await queue_jobs(manager, 10)
+        websocket = FakeWebSocket()
+        await manager.connect(websocket, since=3)
+        await drain(manager)
+        assert [m["seq"] for m in websocket.sent] == list(range(4, 11))
+
+        await manager.handle(websocket, {"action": "subscribe", "topics": ["job:job-1"], "replay": 5})
+        await drain(manager)
+        assert websocket in manager.active_connections
+        assert [(m["status"], m["seq"]) for m in websocket.sent[7:]] == [("subscribed", 10), ("queued", 2)]
+        manager.disconnect(websocket)
+
+    asyncio.run(scenario())
+
+
+def test_sse_catch_up_is_not_held_to_the_bound(monkeypatch):
+    monkeypatch.setattr(events, "WS_QUEUE_SIZE", 2)
+
+    async def scenario():
+        manager = events.ConnectionManager()
+        await queue_jobs(manager, 10)
+        stream = manager.open_stream([events.ALL_TOPICS], since=0)
+        await manager.broadcast({"job_id": "job-0", "status": "completed"})
+        assert stream in manager.streams
+        received = [await stream.next(timeout=1) for _ in range(11)]
+        assert [m["seq"] for m in received] == list(range(1, 12))
+
+    asyncio.run(scenario())
+
+
+def test_event_log_stays_in_seq_order_when_events_arrive_late():
+    log = events.EventLog(size=3)
+    for seq in (1, 2, 5, 3):
+        log.record({"job_id": "job", "status": "queued" if seq < 5 else "completed", "seq": seq})
+    assert [m["seq"] for m in log.events] == [2, 3, 5]
+    # The late event does not replace the newer state of its job
+    assert log.snapshot([events.ALL_TOPICS])[0]["seq"] == 5
+    assert log.since(0, [events.ALL_TOPICS]) is None
+    assert [m["seq"] for m in log.since(1, [events.ALL_TOPICS])] == [2, 3, 5]
+
+
+class FeedState:
+    """Shared state whose feed is driven by the test."""
+
+    shared = True
+
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, message):
+        self.published.append(message)
+        return message
+
+
+def test_shared_events_are_delivered_from_the_feed_in_seq_order():
+    async def scenario():
+        state = FeedState()
+        manager = events.ConnectionManager(state)
+        websocket = FakeWebSocket()
+        await manager.connect(websocket)
+        await manager.broadcast({"job_id": "local", "status": "queued"})
+        assert state.published and not manager.log.events
+
+        # Another worker's event numbered first, then ours
+        manager.deliver({"job_id": "remote", "status": "queued", "seq": 7})
+        manager.deliver({"job_id": "local", "status": "queued", "seq": 8})
+        await drain(manager)
+        assert [m["seq"] for m in websocket.sent] == [7, 8]
+        manager.disconnect(websocket)
+
+    asyncio.run(scenario())
+
+
+class Published(list):
+    async def __call__(self, message):
+        self.append(message)
+
+
+def test_progress_ticks_are_coalesced_to_the_rate():
+    async def scenario():
+        published = Published()
+        reporter = events.ProgressReporter(published, "job-1", rate_hz=10)
+        for downloaded in range(1, 101):
+            reporter.update(downloaded, 100)
+        await asyncio.sleep(0)
+        # The first tick goes out at once, the rest wait for the next interval
+        assert [m["progress"]["bytes"] for m in published] == [1]
+        await asyncio.sleep(0.15)
+        assert [m["progress"]["bytes"] for m in published] == [1, 100]
+        assert published[-1]["progress"]["percent"] == 100.0
+        await reporter.close()
+        assert len(published) == 2
+
+    asyncio.run(scenario())
+
+
+def test_close_publishes_the_final_numbers_at_once():
+    async def scenario():
+        published = Published()
+        reporter = events.ProgressReporter(published, "job-1", rate_hz=0.1, title="Movie")
+        reporter.update(10, 100)
+        reporter.update(60, 100)
+        await asyncio.wait_for(reporter.close(), 1)
+        assert [m["progress"]["bytes"] for m in published] == [10, 60]
+        assert published[-1]["title"] == "Movie"
+        # Nothing is left scheduled to fire after the job ended
+        await asyncio.sleep(0.05)
+        assert len(published) == 2
+
+    asyncio.run(scenario())
+
+
+def test_progress_from_a_worker_thread_is_handed_to_the_loop():
+    async def scenario():
+        published = Published()
+        reporter = events.ProgressReporter(published, "job-1")
+        worker = threading.Thread(target=reporter.update, args=(42, 100))
+        worker.start()
+        worker.join()
+        # Applied by the loop, not by the thread that reported it
+        assert reporter.downloaded == 0
+        await asyncio.sleep(0.01)
+        assert reporter.downloaded == 42
+        assert [m["progress"]["bytes"] for m in published] == [42]
+        await reporter.close()
+
+    asyncio.run(scenario())
+
+
+def progress(job_id, downloaded):
+    return {"job_id": job_id, "status": "downloading", "progress": {"bytes": downloaded}}
+
+
+def test_full_buffer_gives_up_the_oldest_progress_update(monkeypatch):
+    monkeypatch.setattr(events, "WS_QUEUE_SIZE", 3)
+
+    async def scenario():
+        buffer = events._Buffer()
+        buffer.replay([progress("job-0", 0)])
+        for message in ({"job_id": "job-1", "status": "queued"}, progress("job-1", 1), progress("job-1", 2)):
+            assert buffer.offer(message)
+        assert buffer.offer({"job_id": "job-1", "status": "completed"})
+        assert buffer.dropped == 1
+        # The catch-up is kept and so is the newer progress update
+        assert [(m["status"], m.get("progress")) for m in buffer.messages] == [
+            ("downloading", {"bytes": 0}), ("queued", None), ("downloading", {"bytes": 2}), ("completed", None),
+        ]
+
+    asyncio.run(scenario())
+
+
+def test_buffer_full_of_state_changes_refuses_more(monkeypatch):
+    monkeypatch.setattr(events, "WS_QUEUE_SIZE", 2)
+
+    async def scenario():
+        buffer = events._Buffer()
+        assert buffer.offer({"job_id": "job-1", "status": "queued"})
+        assert buffer.offer({"job_id": "job-2", "status": "queued"})
+        assert not buffer.offer(progress("job-1", 1))
+        assert len(buffer.messages) == 2
+
+    asyncio.run(scenario())
+
+
+class HangingWebSocket(FakeWebSocket):
+    async def send_json(self, message):
+        await asyncio.sleep(60)
+
+
+class BrokenWebSocket(FakeWebSocket):
+    async def send_json(self, message):
+        raise RuntimeError("connection reset")
+
+
+def test_connection_is_evicted_when_a_send_times_out_or_fails(monkeypatch):
+    monkeypatch.setattr(events, "WS_SEND_TIMEOUT", 0.05)
+
+    async def scenario():
+        manager = events.ConnectionManager()
+        healthy, hanging, broken = FakeWebSocket(), HangingWebSocket(), BrokenWebSocket()
+        for websocket in (healthy, hanging, broken):
+            await manager.connect(websocket)
+        await manager.broadcast({"job_id": "job-1", "status": "queued"})
+        await asyncio.sleep(0.2)
+        assert manager.active_connections == [healthy]
+        assert set(manager.outboxes) == {healthy}
+        assert hanging.closed and broken.closed and not healthy.closed
+        # Later events still reach the connection that kept up
+        await manager.broadcast({"job_id": "job-1", "status": "completed"})
+        await drain(manager)
+        assert [m["status"] for m in healthy.sent] == ["queued", "completed"]
+        manager.disconnect(healthy)
+
+    asyncio.run(scenario())
@@ -0,0 +1,113 @@
+import asyncio
+
+import httpx
+import pytest
+
+import hls
+import proxy
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch, tmp_path):
+    monkeypatch.setattr(hls, "_cache", hls.SegmentCache(str(tmp_path), 1024 * 1024))
+    monkeypatch.setattr(hls, "_segment_index", {})
+    monkeypatch.setattr(hls, "_playlists", hls.OrderedDict())
+    monkeypatch.setattr(hls, "_inflight", {})
+
+
+def live_playlist(first: int, count: int = 5) -> str:
+    lines = ["#EXTM3U", f"#EXT-X-MEDIA-SEQUENCE:{first}"]
+    for n in range(first, first + count):
+        lines += ["#EXTINF:4.0,", f"seg{n}.ts"]
+    return "\n".join(lines) + "\n"
+
+
+def test_refreshed_playlist_replaces_its_segments():
+    for first in range(200):
+        hls.rewrite_playlist(live_playlist(first), "https://cdn.example/live/index.m3u8", "/api/proxy-stream")
+    assert len(hls._segment_index) == 5
+    assert hls.is_segment("https://cdn.example/live/seg199.ts")
+    assert not hls.is_segment("https://cdn.example/live/seg0.ts")
+
+
+def test_rewritten_playlist_keeps_the_client_id():
+    playlist = hls.rewrite_playlist(live_playlist(0, 1), "https://cdn.example/live/index.m3u8", "/api/proxy-stream", "a b")
+    assert "/api/proxy-stream?url=https%3A%2F%2Fcdn.example%2Flive%2Fseg0.ts&client=a%20b" in playlist
+
+
+def test_only_recent_playlists_are_remembered():
+    for n in range(hls.HLS_MAX_PLAYLISTS + 10):
+        hls.rewrite_playlist(live_playlist(0), f"https://cdn.example/{n}/index.m3u8", "/api/proxy-stream")
+    assert len(hls._playlists) == hls.HLS_MAX_PLAYLISTS
+    assert len(hls._segment_index) == hls.HLS_MAX_PLAYLISTS * 5
+    assert not hls.is_segment("https://cdn.example/0/seg0.ts")
+
+
+def test_cancelled_client_does_not_strand_other_waiters(monkeypatch):
+    url = "https://cdn.example/live/seg0.ts"
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def slow_download(url, headers):
+            await release.wait()
+            return b"segment"
+
+        monkeypatch.setattr(hls, "_download", slow_download)
+        first = asyncio.create_task(hls._load(url, {}))
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(hls._load(url, {}))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await asyncio.wait_for(second, 5) == b"segment"
+        assert first.cancelled()
+        assert url not in hls._inflight
+        assert url in hls.get_cache()
+
+    asyncio.run(scenario())
+
+
+def test_failed_transfer_is_forgotten(monkeypatch):
+    url = "https://cdn.example/live/seg0.ts"
+
+    async def scenario():
+        async def failing_download(url, headers):
+            raise RuntimeError("Segment request returned 503")
+
+        monkeypatch.setattr(hls, "_download", failing_download)
+        with pytest.raises(RuntimeError):
+            await hls._load(url, {})
+        assert url not in hls._inflight
+
+    asyncio.run(scenario())
+
+
+def test_content_type_playlist_resolves_against_redirect(monkeypatch):
+    url = "https://cdn.example/play?id=1"
+
+    def upstream(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/play":
+            return httpx.Response(302, headers={"location": "https://edge.example/hls/main.m3u8"})
+        return httpx.Response(200, content=live_playlist(0).encode(), headers={
+            "content-type": "application/vnd.apple.mpegurl",
+        })
+
+    monkeypatch.setattr(proxy, "_client", httpx.AsyncClient(
+        transport=httpx.MockTransport(upstream), follow_redirects=True,
+    ))
+    monkeypatch.setattr(proxy, "registry", proxy.TeeRegistry())
+
+    async def scenario():
+        status, headers, body = await proxy.open_stream(url, {}, None)
+        assert status == 200
+        assert hls.is_playlist_type(headers["Content-Type"])
+        playlist_url = proxy.final_url(url)
+        raw = b"".join([chunk async for chunk in body])
+        hls.rewrite_playlist(raw.decode(), playlist_url, "/api/proxy-stream")
+        assert hls.is_segment("https://edge.example/hls/seg0.ts")
+        for tee in list(proxy.registry.tees.get(url, [])):
+            proxy.registry.reap(tee)
+
+    asyncio.run(scenario())
@@ -0,0 +1,128 @@
+import asyncio
+
+import httpx
+import pytest
+
+import limiter
+
+
+def saturated(**kwargs) -> limiter.AdaptiveLimiter:
+    """Limiter whose every slot is taken, so the limit is what holds calls back."""
+    adaptive = limiter.AdaptiveLimiter(**kwargs)
+    adaptive.in_flight = int(adaptive.limit)
+    return adaptive
+
+
+def overload(kind: str) -> Exception:
+    request = httpx.Request("GET", "https://api.example/search")
+    if kind == "timeout":
+        return httpx.ReadTimeout("timed out", request=request)
+    response = httpx.Response(int(kind), request=request)
+    return httpx.HTTPStatusError(kind, request=request, response=response)
+
+
+async def fail(adaptive, exc):
+    with pytest.raises(type(exc)):
+        async with adaptive.slot():
+            raise exc
+
+
+def test_limit_grows_by_about_one_slot_per_round():
+    adaptive = saturated(initial=4, maximum=8)
+    for _ in range(4):
+        adaptive._on_success(0.1)
+    assert 4.9 < adaptive.limit < 5
+
+    adaptive.in_flight = 5
+    for _ in range(5):
+        adaptive._on_success(0.1)
+    assert 5.8 < adaptive.limit < 6
+
+
+def test_limit_does_not_grow_while_slots_are_idle_or_calls_slow():
+    adaptive = limiter.AdaptiveLimiter(initial=4, maximum=8)
+    for _ in range(20):
+        adaptive._on_success(0.1)
+    assert adaptive.limit == 4
+
+    adaptive.in_flight = 4
+    adaptive._on_success(0.1 * adaptive.tolerance * 2)
+    assert adaptive.limit == 4
+
+
+@pytest.mark.parametrize("kind", ["429", "503", "timeout"])
+def test_overload_halves_the_limit_once_per_latency_window(kind):
+    adaptive = limiter.AdaptiveLimiter(initial=16, maximum=32)
+    adaptive.latency = 60.0
+
+    async def scenario():
+        for _ in range(3):
+            await fail(adaptive, overload(kind))
+        assert (adaptive.limit, adaptive.decreases, adaptive.overloads) == (8, 1, 3)
+
+        # Once a latency window has passed, upstream pushing back cuts again
+        adaptive._last_decrease -= adaptive.latency
+        await fail(adaptive, overload(kind))
+        assert (adaptive.limit, adaptive.decreases) == (4, 2)
+
+    asyncio.run(scenario())
+
+
+def test_client_errors_do_not_cut_the_limit():
+    adaptive = limiter.AdaptiveLimiter(initial=16, maximum=32)
+    asyncio.run(fail(adaptive, overload("404")))
+    assert (adaptive.limit, adaptive.overloads) == (16, 0)
+
+
+def test_limit_does_not_grow_while_calls_keep_failing():
+    adaptive = saturated(initial=4, maximum=8)
+    adaptive._last_decrease = float("inf")  # keep the limit where it is
+    adaptive._on_overload()
+    for _ in range(4):
+        adaptive._on_success(0.1)
+    assert adaptive.limit == 4
+
+    # Growth resumes once the error rate has decayed
+    while adaptive.error_rate > adaptive.max_error_rate:
+        adaptive._on_success(0.1)
+    adaptive._on_success(0.1)
+    assert adaptive.limit > 4
+
+
+def test_waiters_are_served_in_order_and_may_give_up():
+    adaptive = limiter.AdaptiveLimiter(initial=1, minimum=1, maximum=1)
+    served = []
+
+    async def waiter(name):
+        async with adaptive.slot():
+            served.append(name)
+
+    async def scenario():
+        await adaptive.acquire()
+        tasks = {name: asyncio.create_task(waiter(name)) for name in "abc"}
+        await asyncio.sleep(0)
+        assert len(adaptive.waiters) == 3
+        tasks["b"].cancel()
+        adaptive.release()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        assert served == ["a", "c"]
+        assert adaptive.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def test_slot_granted_to_a_cancelled_waiter_is_given_back():
+    adaptive = limiter.AdaptiveLimiter(initial=1, minimum=1, maximum=1)
+
+    async def scenario():
+        await adaptive.acquire()
+        task = asyncio.create_task(adaptive.acquire())
+        await asyncio.sleep(0)
+        adaptive.release()  # hands the slot to the waiter before it runs again
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert adaptive.in_flight == 0
+        await asyncio.wait_for(adaptive.acquire(), 1)
+
+    asyncio.run(scenario())
@@ -0,0 +1,46 @@
+import sys
+import types
+
+import pytest
+
+import model_patches
+
+
+class Original:
+    pass
+
+
+class Patched(Original):
+    pass
+
+
+@pytest.fixture
+def patched(monkeypatch):
+    monkeypatch.setattr(model_patches, "_applied", True)
+    monkeypatch.setattr(model_patches, "replacements", {Original: Patched})
+    monkeypatch.setattr(model_patches, "_registered", set())
+
+
+def fake_module(monkeypatch, name):
+    module = types.ModuleType(name)
+    module.Model = Original
+    monkeypatch.setitem(sys.modules, name, module)
+    return module
+
+
+def test_apply_does_not_walk_modules_again(patched, monkeypatch):
+    module = fake_module(monkeypatch, "moviebox_api.lazy")
+    assert model_patches.apply()
+    assert module.Model is Original
+
+
+def test_register_patches_each_new_module_once(patched, monkeypatch):
+    first = fake_module(monkeypatch, "moviebox_api.first")
+    model_patches.register()
+    assert first.Model is Patched
+
+    # Already registered modules are skipped, later imports are picked up
+    first.Model = Original
+    second = fake_module(monkeypatch, "moviebox_api.second")
+    model_patches.register()
+    assert (first.Model, second.Model) == (Original, Patched)
@@ -0,0 +1,207 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import proxy
+
+URL = "https://cdn.example/video.mp4"
+PAYLOAD = bytes(range(256)) * 8192  # 2 MiB
+
+
+def ranged_upstream(request: httpx.Request) -> httpx.Response:
+    header = request.headers.get("range")
+    if not header:
+        return httpx.Response(200, content=PAYLOAD, headers={"content-type": "video/mp4"})
+    start, end = proxy.parse_range(header)
+    if start >= len(PAYLOAD):
+        return httpx.Response(416, headers={"content-range": f"bytes */{len(PAYLOAD)}"})
+    end = min(end if end is not None else len(PAYLOAD) - 1, len(PAYLOAD) - 1)
+    return httpx.Response(206, content=PAYLOAD[start:end + 1], headers={
+        "content-type": "video/mp4",
+        "content-range": f"bytes {start}-{end}/{len(PAYLOAD)}",
+    })
+
+
+def range_ignoring_upstream(request: httpx.Request) -> httpx.Response:
+    return httpx.Response(200, content=PAYLOAD, headers={"content-type": "video/mp4"})
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    def install(handler):
+        monkeypatch.setattr(proxy, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(proxy, "registry", proxy.TeeRegistry())
+    return install
+
+
+async def read_all(body) -> bytes:
+    return b"".join([chunk async for chunk in body])
+
+
+async def settle(tee: proxy.StreamTee):
+    """Wait until the reader stops filling its read-ahead window."""
+    end = -1
+    while tee.end != end:
+        end = tee.end
+        await asyncio.sleep(0.02)
+
+
+def test_shared_readers_serve_the_requested_range(upstream):
+    upstream(ranged_upstream)
+
+    async def scenario():
+        status, headers, body = await proxy.open_stream(URL, {}, "bytes=1000-")
+        assert status == 206
+        assert headers["Content-Range"] == f"bytes 1000-{len(PAYLOAD) - 1}/{len(PAYLOAD)}"
+        assert await asyncio.wait_for(read_all(body), 5) == PAYLOAD[1000:]
+
+    asyncio.run(scenario())
+
+
+def test_join_past_the_buffered_end_of_an_idle_reader(upstream):
+    upstream(ranged_upstream)
+
+    async def scenario():
+        _, _, body = await proxy.open_stream(URL, {}, None)
+        first = await body.__anext__()
+        await body.aclose()
+        [tee] = proxy.registry.tees[URL]
+        await settle(tee)
+
+        position = tee.end + proxy.TEE_JOIN_SLACK // 2
+        assert tee.can_join(position)
+        status, _, body = await proxy.open_stream(URL, {}, f"bytes={position}-")
+        assert status == 206
+        assert proxy.registry.tees[URL] == [tee]
+        data = await asyncio.wait_for(body.__anext__(), 5)
+        assert first == PAYLOAD[:len(first)]
+        assert data == PAYLOAD[position:position + len(data)]
+        await body.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_no_join_past_the_end_of_a_finished_reader(upstream):
+    upstream(ranged_upstream)
+
+    async def scenario():
+        _, _, body = await proxy.open_stream(URL, {}, "bytes=0-99")
+        await read_all(body)
+        [tee] = proxy.registry.tees[URL]
+        tee.task.cancel()
+        await asyncio.gather(tee.task, return_exceptions=True)
+        assert not tee.can_join(tee.end + 1)
+
+    asyncio.run(scenario())
+
+
+def test_range_ignored_by_upstream_is_served_from_the_requested_offset(upstream):
+    upstream(range_ignoring_upstream)
+
+    async def scenario():
+        start = len(PAYLOAD) - 300_000
+        status, headers, body = await proxy.open_stream(URL, {}, f"bytes={start}-")
+        assert status == 206
+        assert headers["Content-Range"] == f"bytes {start}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}"
+        assert headers["Content-Length"] == "300000"
+        assert await asyncio.wait_for(read_all(body), 5) == PAYLOAD[start:]
+        # The shared reader restarted at zero; it did not have to catch up with this client
+        [tee] = proxy.registry.tees[URL]
+        assert (tee.base, tee.consumers) == (0, {})
+        assert tee.end < start
+
+        status, _, body = await proxy.open_stream(URL, {}, "bytes=100-199")
+        assert status == 206
+        assert await asyncio.wait_for(read_all(body), 5) == PAYLOAD[100:200]
+
+    asyncio.run(scenario())
+
+
+def test_range_past_the_end_is_not_satisfiable(upstream):
+    upstream(ranged_upstream)
+
+    async def scenario():
+        # Joins the reader started by the first request, which knows the size
+        _, _, body = await proxy.open_stream(URL, {}, None)
+        await body.__anext__()
+        await body.aclose()
+        status, headers, body = await proxy.open_stream(URL, {}, f"bytes={len(PAYLOAD) + 10}-")
+        assert (status, body) == (416, None)
+        assert headers["Content-Range"] == f"bytes */{len(PAYLOAD)}"
+
+        # A fresh reader gets the 416 from upstream
+        proxy.registry = proxy.TeeRegistry()
+        status, headers, body = await proxy.open_stream(URL, {}, f"bytes={len(PAYLOAD) * 4}-")
+        assert (status, body) == (416, None)
+        assert headers["Content-Range"] == f"bytes */{len(PAYLOAD)}"
+
+    asyncio.run(scenario())
+
+
+def steady(scheduler: proxy.BandwidthScheduler, key: str, measured: float):
+    """Make `key` look like it has been running for a while at `measured` bytes/s."""
+    share = scheduler.shares[key]
+    share.since -= 60
+    share.bytes_window = measured * (time.monotonic() - scheduler._last_recompute)
+
+
+def test_global_cap_is_water_filled_across_mixed_demand():
+    scheduler = proxy.BandwidthScheduler("test", global_rate=1_000_000)
+    for key in ("light", "hungry-1", "hungry-2"):
+        scheduler.register(key)
+    scheduler._last_recompute -= 1
+    steady(scheduler, "light", 80_000)
+    for key in ("hungry-1", "hungry-2"):
+        steady(scheduler, key, 0)
+        scheduler.shares[key].throttled = True
+    scheduler._recompute()
+
+    rates = {key: info["allocated"] for key, info in scheduler.allocation()["keys"].items()}
+    # The light key gets its demand (measured plus headroom), the rest is split evenly
+    assert rates["light"] == pytest.approx(100_000, rel=0.01)
+    assert rates["hungry-1"] == rates["hungry-2"] == pytest.approx(450_000, rel=0.01)
+    assert sum(rates.values()) == pytest.approx(1_000_000)
+
+
+def test_per_key_cap_applies_under_the_global_cap():
+    scheduler = proxy.BandwidthScheduler("test", global_rate=1_000_000, key_rate=300_000)
+    for key in ("a", "b"):
+        scheduler.register(key)
+    rates = {key: info["allocated"] for key, info in scheduler.allocation()["keys"].items()}
+    assert rates == {"a": 300_000, "b": 300_000}
+
+
+def test_single_key_is_paced_at_its_cap():
+    rate = 1024 * 1024
+    scheduler = proxy.BandwidthScheduler("test", key_rate=rate)
+    scheduler.register("viewer")
+
+    async def send(total):
+        started = time.monotonic()
+        for _ in range(total // proxy.CHUNK_SIZE):
+            await scheduler.throttle("viewer", proxy.CHUNK_SIZE)
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(send(rate // 2))
+    assert 0.4 <= elapsed < 0.8
+    assert scheduler.allocation()["keys"]["viewer"]["bytes"] == rate // 2
+    assert scheduler.shares["viewer"].throttled
+
+
+def test_bandwidth_stats_list_clients_and_readers(upstream):
+    upstream(ranged_upstream)
+
+    async def scenario():
+        status, _, body = await proxy.open_stream(URL, {}, "bytes=0-", client_key="viewer")
+        await body.__anext__()
+        stats = proxy.bandwidth_stats()
+        assert stats["downstream"]["keys"]["viewer"]["streams"] == 1
+        assert [stream["url"] for stream in stats["streams"]] == [URL]
+        await body.aclose()
+        assert "viewer" not in proxy.bandwidth_stats()["downstream"]["keys"]
+        for tee in list(proxy.registry.tees.get(URL, [])):
+            proxy.registry.reap(tee)
+
+    asyncio.run(scenario())
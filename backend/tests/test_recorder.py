@@ -0,0 +1,114 @@
+import asyncio
+import glob
+import json
+import os
+import time
+
+import httpx
+import pytest
+
+import recorder
+
+
+def search_upstream(request: httpx.Request) -> httpx.Response:
+    return httpx.Response(200, json={"query": request.url.params["q"]})
+
+
+def record(tmp_path, handler, url, max_bytes=recorder.RECORD_MAX_BYTES) -> httpx.Response:
+    async def scenario():
+        transport = recorder.RecordingTransport(httpx.MockTransport(handler), str(tmp_path), max_bytes)
+        async with httpx.AsyncClient(transport=transport) as client:
+            response = await client.get(url)
+            await response.aread()
+            return response
+
+    return asyncio.run(scenario())
+
+
+def replay(tmp_path, url, **options) -> httpx.Response:
+    async def scenario():
+        async with httpx.AsyncClient(transport=recorder.ReplayTransport(str(tmp_path), **options)) as client:
+            return await client.get(url)
+
+    return asyncio.run(scenario())
+
+
+def fixtures(tmp_path):
+    return glob.glob(os.path.join(str(tmp_path), "*", "*.json"))
+
+
+def test_recorded_exchange_replays_offline(tmp_path):
+    async def scenario():
+        async with recorder.install_client(httpx.AsyncClient(transport=httpx.MockTransport(search_upstream)),
+                                           mode="record") as client:
+            client._transport.directory = str(tmp_path)
+            assert (await client.get("https://api.example/search?q=a")).json() == {"query": "a"}
+
+        async with recorder.install_client(httpx.AsyncClient(), mode="replay") as client:
+            client._transport.directory = str(tmp_path)
+            assert (await client.get("https://api.example/search?q=a")).json() == {"query": "a"}
+            assert (await client.get("https://api.example/search?q=b")).status_code == 404
+
+    asyncio.run(scenario())
+
+
+def test_replay_adds_latency(tmp_path):
+    url = "https://api.example/search?q=a"
+    record(tmp_path, search_upstream, url)
+    started = time.monotonic()
+    assert replay(tmp_path, url, latency_ms="100").status_code == 200
+    assert time.monotonic() - started >= 0.1
+
+
+def test_replay_can_reproduce_the_recorded_timing(tmp_path):
+    url = "https://api.example/search?q=a"
+    record(tmp_path, search_upstream, url)
+    [path] = fixtures(tmp_path)
+    with open(path, encoding="utf-8") as f:
+        fixture = json.load(f)
+    fixture["elapsed_ms"] = 150
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(fixture, f)
+
+    started = time.monotonic()
+    assert replay(tmp_path, url, latency_ms="recorded").json() == {"query": "a"}
+    assert time.monotonic() - started >= 0.15
+
+
+def test_replay_injects_error_responses(tmp_path):
+    url = "https://api.example/search?q=a"
+    record(tmp_path, search_upstream, url)
+    assert replay(tmp_path, url, error_rate=1, error_status=429).status_code == 429
+    assert replay(tmp_path, url, error_rate=0, error_status=429).status_code == 200
+
+
+def test_replay_error_status_zero_drops_the_connection(tmp_path):
+    with pytest.raises(httpx.ConnectError):
+        replay(tmp_path, "https://api.example/search?q=a", error_rate=1, error_status=0)
+
+
+def test_media_larger_than_the_limit_is_not_recorded(tmp_path):
+    payload = bytes(1000)
+
+    def media(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=payload, headers={"content-type": "video/mp4"})
+
+    response = record(tmp_path, media, "https://cdn.example/movie.mp4", max_bytes=100)
+    assert response.content == payload
+    assert fixtures(tmp_path) == []
+
+    record(tmp_path, media, "https://cdn.example/movie.mp4", max_bytes=len(payload))
+    assert len(fixtures(tmp_path)) == 1
+
+
+def test_media_of_unknown_length_passes_through(tmp_path):
+    async def chunks():
+        for _ in range(4):
+            yield bytes(256)
+
+    def media(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=chunks(), headers={"content-type": "video/mp4"})
+
+    response = record(tmp_path, media, "https://cdn.example/movie.mp4")
+    assert len(response.content) == 1024
+    assert fixtures(tmp_path) == []
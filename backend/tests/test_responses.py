@@ -0,0 +1,55 @@
+import datetime
+import json
+from typing import Optional
+
+import pytest
+from pydantic import BaseModel, HttpUrl
+
+import responses
+
+
+class Trailer(BaseModel):
+    url: HttpUrl
+    duration: Optional[int] = None
+
+
+class Cover(BaseModel):
+    url: HttpUrl
+    width: int
+
+
+SEARCH = {
+    "results": [
+        {"id": "5b0f", "title": "Amélie", "year": 2001, "poster_url": "https://img.example/a.jpg", "type": "movie"},
+        {"id": "91c2", "title": "進撃の巨人", "year": None, "poster_url": None, "type": "anime"},
+    ],
+    "stale": True,
+}
+
+DETAILS = {
+    "title": "Dune",
+    "year": datetime.date(2021, 10, 22),
+    "plot": "A \"desert\" planet.\nSpice\tflows",
+    "rating": 8.0,
+    "trailer": Trailer(url="https://cdn.example/trailer.mp4", duration=180),
+    "cover": Cover(url="https://img.example/dune.jpg", width=600),
+    "link": HttpUrl("https://moviebox.example/dune"),
+    "type": "series",
+    "seasons": [{"season_number": 1, "max_episodes": 10}, {"season_number": 2, "max_episodes": 8}],
+}
+
+
+@pytest.mark.skipif(responses.orjson is None, reason="orjson is not installed")
+@pytest.mark.parametrize("payload", [SEARCH, DETAILS], ids=["search", "details"])
+def test_orjson_and_stdlib_encode_the_same(monkeypatch, payload):
+    fast = responses.FastJSONResponse(payload).body
+    monkeypatch.setattr(responses, "orjson", None)
+    assert responses.FastJSONResponse(payload).body == fast
+
+
+def test_pydantic_values_are_encoded_in_json_mode(monkeypatch):
+    monkeypatch.setattr(responses, "orjson", None)
+    encoded = json.loads(responses.dumps(DETAILS))
+    assert encoded["trailer"] == {"url": "https://cdn.example/trailer.mp4", "duration": 180}
+    assert encoded["link"] == "https://moviebox.example/dune"
+    assert encoded["year"] == "2021-10-22"
@@ -0,0 +1,102 @@
+import asyncio
+import itertools
+
+import httpx
+import pytest
+
+import sessions
+
+
+class FakeSession:
+    numbers = itertools.count(1)
+
+    def __init__(self):
+        self.number = next(self.numbers)
+
+
+def status_error(status: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("GET", "https://api.example/search")
+    return httpx.HTTPStatusError(str(status), request=request, response=httpx.Response(status, request=request))
+
+
+async def fail(pool, exc, session=None):
+    with pytest.raises(type(exc)):
+        async with pool.use(session):
+            raise exc
+
+
+def test_calls_go_to_the_least_loaded_session():
+    pool = sessions.SessionPool(FakeSession, size=3)
+
+    async def scenario():
+        async with pool.use() as first, pool.use() as second, pool.use() as third:
+            assert len({first, second, third}) == 3
+            async with pool.use() as fourth:
+                assert fourth in (first, second, third)
+        busy = pool._by_id[id(first)]
+        busy.in_flight = 5
+        picked = {pool.pick() for _ in range(10)}
+        assert first not in picked and len(picked) == 2
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("error", [status_error(403), httpx.ReadTimeout("timed out")])
+def test_session_is_retired_after_repeated_failures(error):
+    pool = sessions.SessionPool(FakeSession, size=1, max_failures=3)
+    original = pool.pick()
+
+    async def scenario():
+        for _ in range(2):
+            await fail(pool, error, original)
+        assert pool.pick() is original
+        await fail(pool, error, original)
+
+    asyncio.run(scenario())
+    assert pool.pick() is not original
+    assert pool.retired_count == 1
+    assert id(original) not in pool._by_id
+
+
+def test_success_resets_the_failure_count():
+    pool = sessions.SessionPool(FakeSession, size=1, max_failures=2)
+    original = pool.pick()
+
+    async def scenario():
+        await fail(pool, status_error(403), original)
+        async with pool.use(original):
+            pass
+        await fail(pool, status_error(403), original)
+        # A 404 is about the request, not the session
+        await fail(pool, status_error(404), original)
+
+    asyncio.run(scenario())
+    assert pool.pick() is original
+    assert pool.retired_count == 0
+
+
+def test_retired_session_finishes_its_running_calls():
+    pool = sessions.SessionPool(FakeSession, size=1, max_failures=1)
+    original = pool.pick()
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def long_call():
+            async with pool.use(original) as session:
+                await release.wait()
+                return session
+
+        running = asyncio.create_task(long_call())
+        await asyncio.sleep(0)
+        await fail(pool, status_error(403), original)
+
+        # New calls go to the replacement while the old session drains
+        assert pool.pick() is not original
+        assert [m.session for m in pool.draining] == [original]
+        release.set()
+        assert await running is original
+        assert pool.draining == []
+        assert id(original) not in pool._by_id
+
+    asyncio.run(scenario())
@@ -0,0 +1,146 @@
+import asyncio
+import sqlite3
+
+import shared_state
+
+
+class Collector:
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, message):
+        self.events.append(message)
+
+
+async def wait_for_events(collector, count, timeout=5):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while len(collector.events) < count and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+
+
+def test_sqlite_workers_share_items_and_events(tmp_path, monkeypatch):
+    monkeypatch.setattr(shared_state, "SHARED_STATE_POLL_MS", 10)
+    path = str(tmp_path / "state.db")
+
+    async def scenario():
+        a, b = shared_state.SQLiteState(path), shared_state.SQLiteState(path)
+        seen_a, seen_b = Collector(), Collector()
+        await a.start(seen_a)
+        await b.start(seen_b)
+
+        await a.put_items({"item-1": {"title": "One"}})
+        assert await b.get_item("item-1") == {"title": "One"}
+        assert await b.get_item("missing") is None
+
+        published = await asyncio.gather(
+            *(a.publish({"job_id": f"a-{i}"}) for i in range(20)),
+            *(b.publish({"job_id": f"b-{i}"}) for i in range(20)),
+        )
+        seqs = [message["seq"] for message in published]
+        assert len(set(seqs)) == 40
+
+        await wait_for_events(seen_a, 40)
+        await wait_for_events(seen_b, 40)
+        # Both workers get every event, their own included, in seq order
+        assert seen_a.events == seen_b.events == sorted(published, key=lambda m: m["seq"])
+        await a.close()
+        await b.close()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_publish_does_not_block_the_event_loop(tmp_path):
+    path = str(tmp_path / "state.db")
+
+    async def scenario():
+        state = shared_state.SQLiteState(path)
+        other = sqlite3.connect(path, check_same_thread=False)
+        other.execute("BEGIN IMMEDIATE")
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticking = asyncio.create_task(ticker())
+        publishing = asyncio.gather(*(state.publish({"job_id": "j", "n": n}) for n in range(10)))
+        await asyncio.sleep(0.3)
+        # Another worker holds the write lock; the loop keeps running meanwhile
+        assert not publishing.done()
+        assert ticks >= 10
+        other.rollback()
+        published = await asyncio.wait_for(publishing, 5)
+        assert [m["n"] for m in published] == list(range(10))
+        ticking.cancel()
+        await state.close()
+
+    asyncio.run(scenario())
+
+
+# A few commands of the Redis protocol, enough to stand in for a server
+class FakeRedis:
+    def __init__(self):
+        self.store = {}
+        self.subscribers = []
+
+    async def handle(self, reader, writer):
+        while True:
+            try:
+                command, *args = await shared_state.read_reply(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                return
+            command = command.decode().upper()
+            if command == "PING":
+                writer.write(b"+PONG\r\n")
+            elif command == "SET":
+                self.store[args[0]] = args[1]
+                writer.write(b"+OK\r\n")
+            elif command == "GET":
+                value = self.store.get(args[0])
+                writer.write(b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value))
+            elif command == "SUBSCRIBE":
+                self.subscribers.append(writer)
+                writer.write(b"*3\r\n$9\r\nsubscribe\r\n$%d\r\n%s\r\n:1\r\n" % (len(args[0]), args[0]))
+            elif command == "EVAL" and args[0].decode() == shared_state._PUBLISH_SCRIPT:
+                seq_key, channel, message = args[2:5]
+                seq = int(self.store.get(seq_key, b"0")) + 1
+                self.store[seq_key] = str(seq).encode()
+                for subscriber in self.subscribers:
+                    subscriber.write(shared_state.encode_command("message", channel, b"%d %s" % (seq, message)))
+                writer.write(b":%d\r\n" % seq)
+            else:
+                writer.write(b"-ERR unknown command\r\n")
+            await writer.drain()
+
+
+def test_redis_protocol_backend_against_a_stand_in():
+    async def scenario():
+        fake = FakeRedis()
+        server = await asyncio.start_server(fake.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        a = shared_state.create(f"redis://127.0.0.1:{port}/0")
+        b = shared_state.create(f"redis://127.0.0.1:{port}/0")
+        seen_a, seen_b = Collector(), Collector()
+        await a.start(seen_a)
+        await b.start(seen_b)
+        assert len(fake.subscribers) == 2
+
+        await a.put_items({"x": {"k": 1}, "y": {"k": 2}})
+        assert await b.get_item("y") == {"k": 2}
+        assert await b.get_item("z") is None
+
+        first = await a.publish({"job_id": "j", "status": "queued"})
+        second = await b.publish({"job_id": "j", "status": "running"})
+        assert (first["seq"], second["seq"]) == (1, 2)
+        await wait_for_events(seen_a, 2)
+        await wait_for_events(seen_b, 2)
+        assert seen_a.events == seen_b.events == [first, second]
+
+        await a.close()
+        await b.close()
+        server.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,16 @@
+import os
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_importing_the_app_is_cheap(tmp_path):
+    env = dict(os.environ, PYTHONPATH=BACKEND_DIR, SHARED_STATE="sqlite")
+    code = "import sys, main; print(sorted(m for m in ('httpx', 'moviebox_api') if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=tmp_path, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "[]"
+    # The download queue and shared state open their databases in the lifespan
+    assert os.listdir(tmp_path) == []
+
@@ -0,0 +1,248 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import api
+import upstream
+
+
+@pytest.fixture(autouse=True)
+def fresh_operations(monkeypatch):
+    monkeypatch.setattr(upstream, "_operations", {})
+
+
+def warmed(name: str, latency: float) -> upstream.Operation:
+    """Operation with enough history for hedging to kick in."""
+    op = upstream.operation(name)
+    op.latencies.extend([latency] * upstream.HEDGE_MIN_SAMPLES)
+    return op
+
+
+class Attempts:
+    """Attempt factory answering after the given delays, one per call."""
+
+    def __init__(self, *delays):
+        self.delays = list(delays)
+        self.started = 0
+        self.cancelled = 0
+
+    async def __call__(self):
+        number = self.started
+        self.started += 1
+        try:
+            await asyncio.sleep(self.delays[min(number, len(self.delays) - 1)])
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return number
+
+
+def test_slow_attempt_is_hedged_after_the_usual_latency():
+    op = warmed("search", 0.01)
+    attempts = Attempts(5, 0)
+
+    async def scenario():
+        assert await upstream.call("search", attempts) == 1
+        await asyncio.sleep(0)
+        assert (op.hedges, op.hedge_wins, attempts.cancelled) == (1, 1, 1)
+        # The caller waited for the hedge delay as well
+        assert op.latencies[-1] >= upstream.HEDGE_MIN_DELAY
+
+    asyncio.run(scenario())
+
+
+def test_no_hedging_without_latency_history():
+    attempts = Attempts(0.1)
+    asyncio.run(upstream.call("search", attempts))
+    assert attempts.started == 1
+    assert upstream.operation("search").hedges == 0
+
+
+def test_hedges_stay_within_budget():
+    op = warmed("search", 0.001)
+    attempts = Attempts(0.1)
+
+    async def scenario():
+        for _ in range(3):
+            await upstream.call("search", attempts)
+        # The first call may hedge, then one in ten calls is the limit
+        assert op.hedges == 1
+        assert attempts.started == 4
+
+    asyncio.run(scenario())
+
+
+def test_breaker_opens_probes_and_closes():
+    breaker = upstream.CircuitBreaker(failures=2, reset_seconds=60)
+    breaker.failure()
+    assert breaker.state == upstream.CLOSED
+    breaker.failure()
+    assert breaker.state == upstream.OPEN
+    with pytest.raises(upstream.CircuitOpen):
+        breaker.before()
+
+    # After the reset time a single probe goes through
+    breaker.opened_at -= 60
+    breaker.before()
+    assert breaker.state == upstream.HALF_OPEN
+    with pytest.raises(upstream.CircuitOpen):
+        breaker.before()
+    breaker.success()
+    assert (breaker.state, breaker.failures) == (upstream.CLOSED, 0)
+    breaker.before()
+
+
+def test_failed_probe_opens_the_breaker_again():
+    breaker = upstream.CircuitBreaker(failures=2, reset_seconds=60)
+    breaker.failure()
+    breaker.failure()
+    breaker.opened_at -= 60
+    breaker.before()
+    breaker.failure()
+    assert breaker.state == upstream.OPEN
+    with pytest.raises(upstream.CircuitOpen):
+        breaker.before()
+
+
+def test_open_breaker_fails_fast_without_calling_upstream(monkeypatch):
+    monkeypatch.setattr(upstream, "RETRY_ATTEMPTS", 1)
+    upstream.operation("details").breaker = upstream.CircuitBreaker(failures=2, reset_seconds=60)
+    calls = []
+
+    async def attempt():
+        calls.append(1)
+        raise httpx.ConnectError("connection refused")
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(httpx.ConnectError):
+                await upstream.call("details", attempt)
+        with pytest.raises(upstream.CircuitOpen):
+            await upstream.call("details", attempt)
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(upstream, "RETRY_ATTEMPTS", 1)
+    monkeypatch.setattr(api, "stale_responses", upstream.StaleCache())
+    app = FastAPI()
+    app.include_router(api.router, prefix="/api")
+    with TestClient(app) as http:
+        yield http
+
+
+def cache_item(monkeypatch, outcomes):
+    """Search result whose details lookups answer with `outcomes` in turn."""
+
+    async def get_content_model():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, float):
+            await asyncio.sleep(outcome)
+        elif isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    search_instance = SimpleNamespace(get_item_details=lambda item: SimpleNamespace(get_content_model=get_content_model))
+    item = SimpleNamespace(title="Dune", year=2021)
+    monkeypatch.setitem(api.search_cache, "dune", {"item": item, "search_instance": search_instance,
+                                                  "session": object(), "type": "movie"})
+
+
+def test_details_fall_back_to_the_last_good_answer(app, monkeypatch):
+    details = SimpleNamespace(title="Dune", year=2021, plot="Spice", rating=8.0, trailer=None)
+    cache_item(monkeypatch, [details, httpx.ConnectError("connection refused")])
+    fresh = app.get("/api/details/dune").json()
+    assert "stale" not in fresh
+    assert app.get("/api/details/dune").json() == {**fresh, "stale": True}
+
+
+def test_details_errors_of_the_request_itself_are_not_masked(app, monkeypatch):
+    details = SimpleNamespace(title="Dune", year=2021, plot="Spice", rating=8.0, trailer=None)
+    cache_item(monkeypatch, [details, ValueError("bad item")])
+    app.get("/api/details/dune")
+    assert app.get("/api/details/dune").status_code == 500
+
+
+def test_search_falls_back_to_the_last_good_answer(app, monkeypatch):
+    pytest.importorskip("moviebox_api")
+    results = {"results": [{"id": "1", "title": "Dune", "year": 2021, "poster_url": None, "type": "movie"}]}
+    api.stale_responses.put(("search", "dune", 1, "all"), results)
+
+    async def run_search(*args):
+        raise httpx.ConnectError("connection refused")
+
+    monkeypatch.setattr(api, "run_search", run_search)
+    assert app.get("/api/search", params={"query": "dune"}).json() == {**results, "stale": True}
+
+
+def status_error(status: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("GET", "https://api.example/search")
+    return httpx.HTTPStatusError(str(status), request=request, response=httpx.Response(status, request=request))
+
+
+@pytest.mark.parametrize("error, tries", [
+    (status_error(503), upstream.RETRY_ATTEMPTS),
+    (status_error(429), upstream.RETRY_ATTEMPTS),
+    (httpx.ConnectError("connection refused"), upstream.RETRY_ATTEMPTS),
+    (status_error(404), 1),
+    (ValueError("unexpected answer"), 1),
+])
+def test_only_upstream_failures_are_retried(monkeypatch, error, tries):
+    monkeypatch.setattr(upstream, "backoff", lambda attempt: 0)
+    calls = []
+
+    async def attempt():
+        calls.append(1)
+        raise error
+
+    with pytest.raises(type(error)):
+        asyncio.run(upstream.call("search", attempt))
+    assert len(calls) == tries
+
+
+def test_no_retry_is_scheduled_past_the_deadline(monkeypatch):
+    monkeypatch.setattr(upstream, "backoff", lambda attempt: 1.0)
+    calls = []
+
+    async def attempt():
+        calls.append(1)
+        raise status_error(503)
+
+    started = time.monotonic()
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(upstream.call("search", attempt, time.monotonic() + 0.5))
+    # Gave up with the upstream error instead of sleeping into the deadline
+    assert time.monotonic() - started < 0.5
+    assert (len(calls), upstream.operation("search").retries) == (1, 0)
+
+
+def test_deadline_header_is_seconds_or_a_timestamp():
+    now = time.monotonic()
+    assert upstream.deadline_from("5", "search") == pytest.approx(now + 5, abs=0.5)
+    assert upstream.deadline_from(str(time.time() + 5), "search") == pytest.approx(now + 5, abs=0.5)
+    assert upstream.deadline_from(None, "stream") == pytest.approx(now + upstream.DEFAULT_DEADLINES["stream"], abs=0.5)
+    assert upstream.deadline_from("soon", "search") == pytest.approx(now + upstream.DEFAULT_DEADLINES["search"], abs=0.5)
+    assert upstream.deadline_from(None, "files") is None
+
+
+def test_call_stops_at_the_deadline():
+    async def scenario():
+        with pytest.raises(upstream.DeadlineExceeded):
+            await upstream.call("details", Attempts(5), time.monotonic() + 0.05)
+        assert upstream.operation("details").deadline_exceeded == 1
+
+    asyncio.run(scenario())
+
+
+def test_endpoint_answers_504_once_the_client_deadline_passes(app, monkeypatch):
+    cache_item(monkeypatch, [5.0])
+    response = app.get("/api/details/dune", headers={"x-request-deadline": "0.05"})
+    assert response.status_code == 504
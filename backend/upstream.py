@@ -0,0 +1,303 @@
+"""
+Call policies for idempotent moviebox API lookups (search, details, file
+metadata).
+
+Hedging: if an attempt has not answered by the usual p95 latency of that
+kind of call, a second attempt is started and whichever finishes first
+wins. Hedges are capped at a small fraction of calls so a slow upstream is
+not hit twice as hard.
+
+Circuit breaker: after several consecutive upstream failures, calls fail
+fast with CircuitOpen for a while; then one probe call is let through to
+see whether upstream has recovered. Callers can answer from StaleCache in
+the meantime.
+
+Retries: transport errors, 429s, 5xx and timeouts are retried with
+exponential backoff and full jitter, within the deadline of the request
+that needs the answer. That deadline comes from the client's
+X-Request-Deadline header or a default per endpoint, so no work is done
+after the client has given up.
+"""
+import asyncio
+import os
+import random
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from limiter import is_overload
+
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "95"))
+# Fraction of calls that may be hedged
+HEDGE_BUDGET = float(os.environ.get("HEDGE_BUDGET", "0.1"))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.05
+LATENCY_SAMPLES = 200
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.environ.get("BREAKER_RESET_SECONDS", "30"))
+STALE_CACHE_SIZE = int(os.environ.get("STALE_CACHE_SIZE", "500"))
+RETRY_ATTEMPTS = int(os.environ.get("RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", "0.25"))
+RETRY_MAX_DELAY = 4.0
+# Time budget of an endpoint when the client does not send X-Request-Deadline
+DEFAULT_DEADLINES = {
+    "search": float(os.environ.get("SEARCH_DEADLINE", "10")),
+    "details": float(os.environ.get("DETAILS_DEADLINE", "10")),
+    "stream": float(os.environ.get("STREAM_DEADLINE", "30")),
+}
+# Header values above this are Unix timestamps rather than seconds from now
+_EPOCH_THRESHOLD = 1e9
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpen(Exception):
+    """Upstream is considered down, the call was not attempted."""
+
+
+class DeadlineExceeded(Exception):
+    """The request's time budget ran out before upstream answered."""
+
+
+def is_upstream_failure(exc: BaseException) -> bool:
+    """Failures that say something about upstream health, not about the request."""
+    import httpx
+
+    return isinstance(exc, (CircuitOpen, httpx.TransportError)) or is_overload(exc)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    # An open circuit is meant to fail fast
+    return not isinstance(exc, CircuitOpen) and is_upstream_failure(exc)
+
+
+def backoff(attempt: int) -> float:
+    """Full-jitter exponential delay before retry number `attempt` (1-based)."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+def deadline_from(header: Optional[str], endpoint: str) -> Optional[float]:
+    """
+    Monotonic deadline for a request. X-Request-Deadline is either seconds
+    from now or an absolute Unix timestamp; without it the endpoint default
+    applies.
+    """
+    budget = None
+    if header:
+        try:
+            value = float(header)
+            budget = value - time.time() if value > _EPOCH_THRESHOLD else value
+        except ValueError:
+            pass
+    if budget is None:
+        budget = DEFAULT_DEADLINES.get(endpoint)
+    return time.monotonic() + budget if budget is not None else None
+
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    return deadline - time.monotonic() if deadline is not None else None
+
+
+def check_deadline(deadline: Optional[float]):
+    remaining = time_left(deadline)
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+
+
+class CircuitBreaker:
+    def __init__(self, failures: int = BREAKER_FAILURES, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.max_failures = failures
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def before(self):
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                raise CircuitOpen("Upstream unavailable, retry later")
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self.probing:
+                raise CircuitOpen("Upstream unavailable, retry later")
+            self.probing = True
+
+    def success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == HALF_OPEN or self.failures >= self.max_failures:
+            if self.state != OPEN:
+                print(f"[UPSTREAM] Circuit opened after {self.failures} failures")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """The call ended without telling us anything (cancelled, bad request)."""
+        self.probing = False
+
+
+class Operation:
+    """Latency history, hedging counters and breaker for one kind of call."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.breaker = CircuitBreaker()
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.retries = 0
+        self.deadline_exceeded = 0
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+    def hedge_delay(self) -> Optional[float]:
+        if self.hedges >= HEDGE_BUDGET * self.calls:
+            return None
+        delay = self.percentile(HEDGE_PERCENTILE)
+        return max(delay, HEDGE_MIN_DELAY) if delay is not None else None
+
+    def stats(self) -> dict:
+        p50 = self.percentile(50)
+        p95 = self.percentile(95)
+        return {
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "retries": self.retries,
+            "deadline_exceeded": self.deadline_exceeded,
+            "p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000) if p95 is not None else None,
+            "breaker": self.breaker.state,
+        }
+
+
+_operations: Dict[str, Operation] = {}
+
+
+def operation(name: str) -> Operation:
+    if name not in _operations:
+        _operations[name] = Operation(name)
+    return _operations[name]
+
+
+async def _hedged(op: Operation, attempt: Callable[[], Awaitable[Any]]):
+    # Latency of the whole call as the caller sees it, hedge delay included
+    started = time.monotonic()
+    first = asyncio.ensure_future(attempt())
+    delay = op.hedge_delay()
+    if delay is None:
+        result = await first
+        op.latencies.append(time.monotonic() - started)
+        return result
+
+    pending = {first}
+    second = None
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            op.hedges += 1
+            second = asyncio.ensure_future(attempt())
+            pending.add(second)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    op.latencies.append(time.monotonic() - started)
+                    if task is second:
+                        op.hedge_wins += 1
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in (first, second):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+async def _call_once(op: Operation, attempt: Callable[[], Awaitable[Any]], deadline: Optional[float]) -> Any:
+    check_deadline(deadline)
+    op.breaker.before()
+    op.calls += 1
+    try:
+        remaining = time_left(deadline)
+        if remaining is None:
+            result = await _hedged(op, attempt)
+        else:
+            try:
+                result = await asyncio.wait_for(_hedged(op, attempt), remaining)
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded("Request deadline exceeded") from None
+    except Exception as e:
+        if is_upstream_failure(e):
+            op.breaker.failure()
+        else:
+            op.breaker.release()
+        raise
+    except BaseException:
+        op.breaker.release()
+        raise
+    op.breaker.success()
+    return result
+
+
+async def call(name: str, attempt: Callable[[], Awaitable[Any]], deadline: Optional[float] = None) -> Any:
+    """
+    Run an idempotent upstream lookup with hedging and retries behind the
+    breaker for `name`, giving up at `deadline` (monotonic time). `attempt`
+    must be safe to run twice at the same time.
+    """
+    op = operation(name)
+    tries = 0
+    while True:
+        tries += 1
+        try:
+            return await _call_once(op, attempt, deadline)
+        except DeadlineExceeded:
+            op.deadline_exceeded += 1
+            raise
+        except Exception as e:
+            if tries >= RETRY_ATTEMPTS or not is_retryable(e):
+                raise
+            delay = backoff(tries)
+            remaining = time_left(deadline)
+            if remaining is not None and delay >= remaining:
+                raise
+            op.retries += 1
+            print(f"[UPSTREAM] {op.name} failed ({e!r}), retry {tries} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+
+class StaleCache:
+    """Last good responses, served while upstream is unavailable."""
+
+    def __init__(self, max_entries: int = STALE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Any, Any]" = OrderedDict()
+
+    def get(self, key) -> Any:
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+def stats() -> dict:
+    return {name: op.stats() for name, op in _operations.items()}
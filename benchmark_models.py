@@ -0,0 +1,119 @@
+"""
+Cost of the moviebox_api model patch.
+
+Compares the old in-place patch (edit SubjectModel.trailer, then
+model_rebuild(force=True) on SubjectModel, ResDataModel and
+ItemJsonDetailsModel) with the patched subclasses from
+backend/model_patches.py: time to apply the patch, and, given a details
+payload, time per validation with the original, in-place and subclassed
+schemas. Every variant runs in a fresh interpreter.
+
+    python benchmark_models.py [--runs 5] [--payload details.json] [--validations 2000]
+
+The payload is the dict ItemJsonDetailsModel is built from, or a fixture
+recorded with UPSTREAM_MODE=record.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+
+SETUP = """
+import json, sys, time
+from typing import Optional, Union, get_args, get_origin
+from moviebox_api.extractor._core import ItemJsonDetailsModel
+from moviebox_api.extractor.models.json import SubjectModel, SubjectTrailerModel
+payload = json.loads(sys.argv[1]) if len(sys.argv) > 1 else None
+started = time.perf_counter()
+"""
+
+PATCHES = {
+    "original": """
+model = ItemJsonDetailsModel
+""",
+    "in-place": """
+from pydantic.fields import FieldInfo
+SubjectModel.model_fields['trailer'] = FieldInfo(annotation=Optional[Union[dict, SubjectTrailerModel]], default=None)
+SubjectModel.model_rebuild(force=True)
+annotation = ItemJsonDetailsModel.model_fields['resData'].annotation
+ResDataModel = next((a for a in (annotation, *get_args(annotation)) if isinstance(a, type)), annotation)
+ResDataModel.model_rebuild(force=True)
+ItemJsonDetailsModel.model_rebuild(force=True)
+model = ItemJsonDetailsModel
+""",
+    "subclass": """
+import model_patches
+model_patches.apply()
+model = model_patches.validator(ItemJsonDetailsModel)
+""",
+}
+
+MEASURE = """
+patch_ms = (time.perf_counter() - started) * 1000
+validation_us = None
+if payload is not None:
+    try:
+        model(**payload)
+        count = {validations}
+        started = time.perf_counter()
+        for _ in range(count):
+            model(**payload)
+        validation_us = (time.perf_counter() - started) * 1e6 / count
+    except Exception as e:
+        validation_us = repr(e).splitlines()[0][:80]
+print(json.dumps({{"patch_ms": patch_ms, "validation_us": validation_us}}))
+"""
+
+
+def load_payload(path):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if "response" in data and "request" in data:
+        # Recorder fixture: the model is built from the response body
+        data = json.loads(data["response"]["body"])
+    if "resData" not in data and isinstance(data.get("data"), dict):
+        data = data["data"]
+    return data
+
+
+def run_variant(name, payload, validations):
+    code = SETUP + PATCHES[name] + MEASURE.format(validations=validations)
+    args = [sys.executable, "-c", code]
+    if payload is not None:
+        args.append(json.dumps(payload))
+    result = subprocess.run(args, cwd=BACKEND_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--payload")
+    parser.add_argument("--validations", type=int, default=2000)
+    args = parser.parse_args()
+    payload = load_payload(args.payload) if args.payload else None
+
+    for name in PATCHES:
+        try:
+            samples = [run_variant(name, payload, args.validations) for _ in range(args.runs)]
+        except RuntimeError as e:
+            print(f"{name:>9}: could not run ({e})")
+            continue
+        patch_ms = statistics.median(s["patch_ms"] for s in samples)
+        line = f"{name:>9}: patch {patch_ms:7.2f} ms"
+        validation = samples[-1]["validation_us"]
+        if isinstance(validation, str):
+            line += f", validation fails: {validation}"
+        elif validation is not None:
+            line += f", {statistics.median(s['validation_us'] for s in samples):7.1f} us per validation"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
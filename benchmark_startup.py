@@ -0,0 +1,83 @@
+"""
+Startup cost of the backend.
+
+Prints the slowest imports of `import main` (from python -X importtime),
+grouped per top-level package, then times a cold import over several runs
+and compares the median against a budget. Exits with status 1 when the
+budget is exceeded, 2 when the backend does not import at all.
+
+    python benchmark_startup.py [--runs 5] [--budget-ms 2000] [--top 20]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+STARTUP_BUDGET_MS = float(os.environ.get("STARTUP_BUDGET_MS", "2000"))
+
+
+def run_python(code, *flags):
+    return subprocess.run([sys.executable, *flags, "-c", code], cwd=BACKEND_DIR,
+                          capture_output=True, text=True)
+
+
+def import_report(top):
+    result = run_python("import main", "-X", "importtime")
+    if result.returncode != 0:
+        print("Backend failed to import:")
+        print(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "(no output)")
+        return False
+
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+
+    packages = defaultdict(int)
+    for name, self_us, _ in modules:
+        packages[name.split(".")[0]] += self_us
+
+    print(f"Slowest imports (cumulative, {len(modules)} modules):")
+    for name, _, cumulative_us in sorted(modules, key=lambda m: m[2], reverse=True)[:top]:
+        print(f"  {cumulative_us / 1000:9.1f} ms  {name}")
+    print("\nTime per top-level package (self):")
+    for name, self_us in sorted(packages.items(), key=lambda p: p[1], reverse=True)[:top]:
+        print(f"  {self_us / 1000:9.1f} ms  {name}")
+    return True
+
+
+def timed(code):
+    started = time.perf_counter()
+    run_python(code)
+    return (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=STARTUP_BUDGET_MS)
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    if not import_report(args.top):
+        sys.exit(2)
+
+    interpreter = statistics.median(timed("pass") for _ in range(args.runs))
+    samples = [timed("import main") - interpreter for _ in range(args.runs)]
+    median = statistics.median(samples)
+    print(f"\nimport main: median {median:.0f} ms, min {min(samples):.0f} ms, max {max(samples):.0f} ms "
+          f"(interpreter start {interpreter:.0f} ms excluded, {args.runs} runs)")
+    if median > args.budget_ms:
+        print(f"Over budget: {median:.0f} ms > {args.budget_ms:.0f} ms")
+        sys.exit(1)
+    print(f"Within budget of {args.budget_ms:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -139,6 +139,8 @@ function App() {
                 try {
                     const data = JSON.parse(event.data);
                     console.log('WS Message:', data);
+                    // Jobs that ended earlier are replayed on every (re)connect, only live ones get an alert
+                    if (data.replay && data.status !== 'downloading') return;
                     if (data.status === 'downloading') {
                         setDownloadProgress(data.progress);
                     } else if (data.status === 'completed') {
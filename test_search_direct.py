@@ -6,8 +6,10 @@ import asyncio
 sys.path.insert(0, os.path.join(os.getcwd(), 'backend'))
 
 try:
-    from api import search
+    from api import search, open_state
     print("Successfully imported search function")
+    # Normally done by the app lifespan
+    open_state()
     
     # Test the search function directly
     async def test_search():